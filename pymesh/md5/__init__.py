@@ -4,6 +4,16 @@ an easy to read and process format.
 
 import mesh
 import anim
+import skeleton
+import blend
+import skinning
+import bake
 
 MD5_Mesh = mesh.MD5_Mesh
 MD5_Anim = anim.MD5_Anim
+MD5_Skeleton = skeleton.MD5_Skeleton
+MD5_Blender = blend.MD5_Blender
+MD5_Layer = blend.MD5_Layer
+MD5_Skin = skinning.MD5_Skin
+MD5_Palette = skinning.MD5_Palette
+MD5_Baker = bake.MD5_Baker
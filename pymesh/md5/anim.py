@@ -1,12 +1,31 @@
+import re
+import multiprocessing
+import multiprocessing.pool
 from collections import namedtuple
+from StringIO import StringIO
 
 import numpy
 
 import pymesh.utils as utils
-from common import MD5, process_md5_buffer, parse_to, compute_quaternion_w
+from common import MD5, process_md5_buffer, parse_to, skip_block, compute_quaternion_w, compute_quaternions
+from common import quaternion_to_matrix
+from skeleton import MD5_Skeleton
 
 
 class MD5_Hierarchy( object ):
+    """Processes and stores MD5 Anim hierarchy data.
+
+    The object is usable as an iterator that yields joint_layout
+    tuples. This is provided for compatibility.
+    The hierarchy is also available as a numpy record array
+    through 'records', which can be indexed and sliced directly
+    from the object.
+    Ie.
+    hierarchy[ 1:5 ].start_index
+
+    The 'flags' field is hidden by the numpy 'flags' attribute
+    and must be accessed by key, ie. hierarchy[ 1:5 ][ 'flags' ].
+    """
 
     joint_layout = namedtuple(
         'MD5_Joint',
@@ -18,20 +37,42 @@ class MD5_Hierarchy( object ):
             ]
         )
 
+    joint_dtype = numpy.dtype(
+        [
+            ('name', 'object'),
+            ('parent', 'int'),
+            ('flags', 'int'),
+            ('start_index', 'int'),
+            ]
+        )
+
     def __init__( self, buffer, num_joints, seek_to = True ):
         super( MD5_Hierarchy, self ).__init__()
 
+        self.records = None
         self.names = None
         self.parent_indices = None
         self.flags = None
         self.start_indices = None
 
+        self._skeleton = None
+
         self._process_hierarchy( buffer, num_joints, seek_to )
 
     @property
     def num_joints( self ):
         return len( self.names )
 
+    @property
+    def skeleton( self ):
+        """Returns an MD5_Skeleton for the joint hierarchy.
+
+        The skeleton is built on first access and re-used.
+        """
+        if self._skeleton is None:
+            self._skeleton = MD5_Skeleton( self.names, self.parent_indices )
+        return self._skeleton
+
     def joint( self, index ):
         return MD5_Hierarchy.joint_layout(
             self.names[ index ],
@@ -43,6 +84,14 @@ class MD5_Hierarchy( object ):
     def __iter__( self ):
         return self.next()
 
+    def __len__( self ):
+        return self.num_joints
+
+    def __getitem__( self, index ):
+        """Returns the joint records for the specified index or slice.
+        """
+        return self.records[ index ]
+
     def next( self ):
         for index in range( self.num_joints ):
             yield self.joint( index )
@@ -90,13 +139,13 @@ class MD5_Hierarchy( object ):
         if seek_to:
             parse_to( buffer, 'hierarchy' )
 
-        #
-        # TODO: convert this to a single N * 3 array and then extract using slices
-        #
+        # store the values in a record array and expose
+        # each field as a column
+        self.records = numpy.recarray( num_joints, dtype = MD5_Hierarchy.joint_dtype )
         self.names = []
-        self.parent_indices = numpy.empty( num_joints, dtype = 'int' )
-        self.flags = numpy.empty( num_joints, dtype = 'int' )
-        self.start_indices = numpy.empty( num_joints, dtype = 'int' )
+        self.parent_indices = self.records[ 'parent' ]
+        self.flags = self.records[ 'flags' ]
+        self.start_indices = self.records[ 'start_index' ]
 
         # iterate through our specified number of joints
         for index in range( num_joints ):
@@ -107,8 +156,16 @@ class MD5_Hierarchy( object ):
             self.flags[ index ] = flags
             self.start_indices[ index ] = start_index
 
+        self.records[ 'name' ][:] = self.names
+
 
 class MD5_Bounds( object ):
+    """Processes and stores the MD5 Anim bounds block.
+
+    These are the whole model bounds of each frame, as exported
+    by the author. See MD5_Anim.compute_bounds to calculate the
+    bounds of a mesh.
+    """
 
     def __init__( self, buffer, num_frames, seek_to = True ):
         super( MD5_Bounds, self ).__init__()
@@ -121,7 +178,12 @@ class MD5_Bounds( object ):
     def num_bounds( self ):
         return len( self.bounds )
 
-    def bounds( self, index ):
+    def bound( self, index ):
+        """Returns the bounds of the specified frame.
+
+        This was previously named 'bounds', which was hidden
+        by the attribute of the same name.
+        """
         return self.bounds[ index ]
 
     def __iter__( self ):
@@ -181,6 +243,16 @@ class MD5_Bounds( object ):
 
 
 class MD5_BaseFrame( object ):
+    """Processes and stores MD5 Anim base frame data.
+
+    The object is usable as an iterator that yields bone_layout
+    tuples. This is provided for compatibility.
+    The bones are also available as a numpy record array
+    through 'records', which can be indexed and sliced directly
+    from the object.
+    Ie.
+    base_frame[ 1:5 ].orientation
+    """
 
     bone_layout = namedtuple(
         'MD5_Bone',
@@ -190,9 +262,17 @@ class MD5_BaseFrame( object ):
             ]
         )
 
+    bone_dtype = numpy.dtype(
+        [
+            ('position', 'float', (3,)),
+            ('orientation', 'float', (4,)),
+            ]
+        )
+
     def __init__( self, buffer, num_joints, seek_to = True ):
         super( MD5_BaseFrame, self ).__init__()
 
+        self.records = None
         self.positions = None
         self.orientations = None
 
@@ -211,6 +291,14 @@ class MD5_BaseFrame( object ):
     def __iter__( self ):
         return self.next()
 
+    def __len__( self ):
+        return self.num_bones
+
+    def __getitem__( self, index ):
+        """Returns the bone records for the specified index or slice.
+        """
+        return self.records[ index ]
+
     def next( self ):
         for index in range( self.num_bones ):
             yield self.bone( index )
@@ -259,8 +347,11 @@ class MD5_BaseFrame( object ):
         if seek_to:
             parse_to( buffer, 'baseframe' )
 
-        self.positions = numpy.empty( (num_joints, 3 ), dtype = 'float' )
-        self.orientations = numpy.empty( (num_joints, 4 ), dtype = 'float' )
+        # store the values in a record array and expose
+        # each field as a column
+        self.records = numpy.recarray( num_joints, dtype = MD5_BaseFrame.bone_dtype )
+        self.positions = self.records[ 'position' ]
+        self.orientations = self.records[ 'orientation' ]
 
         # iterate through our specified number of joints
         for position, orientation in zip( self.positions, self.orientations ):
@@ -269,12 +360,18 @@ class MD5_BaseFrame( object ):
 
 class MD5_Frame( object ):
 
-    def __init__( self, buffer, seek_to = True ):
+    def __init__( self, buffer, seek_to = True, values = None ):
+        """Parses a frame block from the buffer.
+
+        If 'values' is provided, the frame wraps the values
+        and the buffer is not read.
+        """
         super( MD5_Frame, self ).__init__()
 
-        self.values = None
+        self.values = values
 
-        self._process_frame( buffer, seek_to )
+        if values is None:
+            self._process_frame( buffer, seek_to )
 
     @property
     def num_animated_components( self ):
@@ -319,8 +416,78 @@ class MD5_Frame( object ):
         self.values = numpy.array( values, dtype = 'float' )
 
 
+# matches the start of a 'frame N {' block
+_frame_block = re.compile( r'^[ \t]*frame[ \t]+(\d+)[ \t]*\{', re.M )
+
+# the frame array of process pool workers
+_worker_frame_values = None
+
+def _find_frame_blocks( data ):
+    """Scans the text of an MD5 Anim for 'frame N { ... }' blocks.
+
+    Returns the offset of the first block, or None if there are no
+    blocks, and a list of (frame index, start, end) tuples.
+    'start' and 'end' delimit the values inside the braces.
+    """
+    blocks = []
+    first = None
+    for match in _frame_block.finditer( data ):
+        start = match.end()
+        end = data.find( '}', start )
+        if end < 0:
+            raise ValueError( 'Frame block is not closed' )
+
+        if first is None:
+            first = match.start()
+        blocks.append( (int( match.group( 1 ) ), start, end) )
+    return first, blocks
+
+def _parse_frame_blocks( data, offset, blocks, frame_values ):
+    """Parses frame blocks into the rows of 'frame_values'.
+
+    'offset' is the position of 'data' within the file.
+    """
+    num_frames, num_animated_components = frame_values.shape
+    for index, start, end in blocks:
+        if index >= num_frames:
+            raise ValueError( "Frame '%i' is out of range" % index )
+
+        text = data[ start - offset : end - offset ]
+        if '//' in text:
+            # remove any comments
+            text = '\n'.join( line.split( '//' )[ 0 ] for line in text.splitlines() )
+
+        values = numpy.fromstring( text, dtype = 'float', sep = ' ' )
+        if values.size != num_animated_components:
+            raise ValueError( "Number of animated components doesn't match" )
+        frame_values[ index ] = values
+
+def _init_frame_worker( shared, shape ):
+    global _worker_frame_values
+    _worker_frame_values = numpy.frombuffer( shared, dtype = 'float' ).reshape( shape )
+
+def _parse_frame_task( args ):
+    """Process pool task that reads a byte range of the file and
+    parses its frame blocks into the shared frame array.
+    """
+    filename, start, end, blocks = args
+    with open( filename, 'rb' ) as f:
+        f.seek( start )
+        data = f.read( end - start )
+    _parse_frame_blocks( data, start, blocks, _worker_frame_values )
+
+
 class MD5_Anim( MD5 ):
 
+    computed_bounds_layout = namedtuple(
+        'MD5_ComputedBounds',
+        [
+            'frames',
+            'joints',
+            'clip',
+            'weighted'
+            ]
+        )
 
     def __init__( self ):
         super( MD5_Anim, self ).__init__()
@@ -330,39 +497,327 @@ class MD5_Anim( MD5 ):
         self.bounds = None
         self.base_frame = None
         self.frames = None
+        self.frame_values = None
+        self.frame_indices = None
+
+        self._local_poses = None
 
-    def load_from_buffer( self, buffer ):
+    def load( self, filename, workers = None, pool = 'process', frames = None ):
+        """
+        Reads the MD5 data from the existing
+        specified filename.
+
+        Frame blocks are independent of each other, so they
+        can be parsed in parallel. The file is scanned for frame
+        blocks and the blocks are parsed into a single frame array
+        by a pool of workers.
+
+        @param filename: the filename of the md5anim file
+        to load.
+        @param workers: the number of workers used to parse frames.
+        If None, frames are parsed sequentially.
+        If 0, the number of CPUs is used.
+        @param pool: 'process' or 'thread'.
+        @param frames: the frames to load, see load_from_buffer.
+        """
+        if workers is None:
+            return super( MD5_Anim, self ).load( filename, frames = frames )
+
+        if pool not in ( 'process', 'thread' ):
+            raise ValueError( "Unknown pool type '%s'" % pool )
+
+        workers = workers or multiprocessing.cpu_count()
+
+        with open( filename, 'rb' ) as f:
+            data = f.read()
+
+        try:
+            self._process_parallel( filename, data, workers, pool, frames )
+        except Exception as e:
+            self._clear()
+            raise
+
+    def load_from_buffer( self, buffer, frames = None ):
         """
         Reads the MD5 data from a stream object.
 
         Can be called instead of load() if data
         is not present in a file.
 
+        A subset of the frames can be loaded by passing a slice or a
+        list of frame indices. Other frame blocks are skipped without
+        being parsed, and reading stops after the last frame that
+        is required. The bounds are reduced to the loaded frames.
+        The original index of each loaded frame is stored in
+        'frame_indices'.
+
         @param f: the stream object, usually a file.
+        @param frames: a slice or list of frame indices to load.
+        If None, all frames are loaded.
         """
         statements = process_md5_buffer( buffer )
 
         try:
-            self._process_buffer( statements )
+            self._process_buffer( statements, frames )
         except Exception as e:
-            # clear our data
-            self.frame_rate = None
-            self.hierarchy = None
-            self.bounds = None
-            self.base_frame = None
-            self.frames = None
+            self._clear()
             raise
 
+    def _clear( self ):
+        # clear our data
+        self.frame_rate = None
+        self.hierarchy = None
+        self.bounds = None
+        self.base_frame = None
+        self.frames = None
+        self.frame_values = None
+        self.frame_indices = None
+
     @property
     def num_frames( self ):
         return len( self.frames )
 
+    @property
+    def skeleton( self ):
+        return self.hierarchy.skeleton
+
     def frame( self, index ):
         return self.frames[ index ]
 
-    def _process_buffer( self, buffer ):
+    def local_poses( self ):
+        """Returns the joint local positions and orientations
+        of every frame.
+
+        Frame values are applied over the base frame according
+        to the flags and start index of each joint.
+
+        Returns a tuple of arrays with the shapes
+        (frames, joints, 3) and (frames, joints, 4).
+        The arrays are calculated once and cached, they should
+        not be modified.
+        """
+        if self._local_poses is None:
+            hierarchy = self.hierarchy
+            num_joints = hierarchy.num_joints
+
+            # the 6 components of each joint
+            # position x, y, z and orientation x, y, z
+            components = numpy.empty( (self.num_frames, num_joints, 6), dtype = 'float' )
+            components[ :, :, :3 ] = self.base_frame.positions
+            components[ :, :, 3: ] = self.base_frame.orientations[ :, :3 ]
+
+            # each flag bit indicates the component is animated
+            # animated components are stored consecutively from
+            # the joint's start index
+            bits = (hierarchy.flags[ :, numpy.newaxis ] >> numpy.arange( 6 )) & 1
+            animated = bits.astype( 'bool' )
+            columns = hierarchy.start_indices[ :, numpy.newaxis ] + numpy.cumsum( bits, axis = 1 ) - bits
+
+            components[ :, animated ] = self.frame_values[ :, columns[ animated ] ]
+
+            positions = components[ :, :, :3 ].copy()
+            orientations = compute_quaternions( components[ :, :, 3: ] )
+            self._local_poses = (positions, orientations)
+
+        return self._local_poses
+
+    def model_poses( self, frames = None ):
+        """Returns the model space joint positions and orientations
+        of the specified frames.
+
+        @param frames: an index, slice or array of frame indices.
+        Defaults to all frames.
+        @return: a tuple of arrays with the shapes
+        (frames, joints, 3) and (frames, joints, 4).
+        """
+        positions, orientations = self.local_poses()
+        if frames is not None:
+            positions = positions[ frames ]
+            orientations = orientations[ frames ]
+        return self.skeleton.to_model( positions, orientations )
+
+    def compute_bounds( self, mesh ):
+        """Computes bounding boxes of the mesh for every frame
+        of the animation.
+
+        Each joint's box contains the positions of the weights
+        that reference the joint. As every vertex is a weighted
+        average of its weight positions, the joint boxes contain
+        the mesh in any pose without skinning it.
+
+        Joints that no weight references have an empty box at the
+        joint's position and are excluded from the model bounds.
+
+        Boxes are stored as [ [ minX, minY, minZ ], [ maxX, maxY, maxZ ] ].
+
+        @param mesh: the MD5_Mesh the animation is applied to.
+        @return: a computed_bounds_layout named tuple containing:
+        frames      whole model boxes (frames, 2, 3).
+        joints      per-joint boxes in mesh joint order (frames, joints, 2, 3).
+        clip        the union of all frame boxes (2, 3).
+        weighted    boolean array of joints that are referenced by weights.
+        """
+        remap = mesh.skeleton.remap( self.skeleton )
+        if (remap < 0).any():
+            raise ValueError( "Animation does not contain all joints of the mesh" )
+
+        local = mesh.joint_bounds()
+        weighted = numpy.isfinite( local[ :, 0, 0 ] )
+        local[ ~weighted ] = 0.0
+
+        positions, orientations = self.model_poses()
+        positions = positions[ :, remap ]
+        orientations = orientations[ :, remap ]
+
+        # transform the centre of each box and calculate
+        # the extent of the rotated box
+        centres = 0.5 * (local[ :, 0 ] + local[ :, 1 ])
+        extents = 0.5 * (local[ :, 1 ] - local[ :, 0 ])
+        rotations = quaternion_to_matrix( orientations )
+
+        centres = numpy.einsum( 'fjab,jb->fja', rotations, centres ) + positions
+        extents = numpy.einsum( 'fjab,jb->fja', numpy.abs( rotations ), extents )
+
+        joints = numpy.stack( [ centres - extents, centres + extents ], axis = -2 )
+
+        frames = numpy.empty( (self.num_frames, 2, 3), dtype = 'float' )
+        if weighted.any():
+            frames[ :, 0 ] = joints[ :, weighted, 0 ].min( axis = 1 )
+            frames[ :, 1 ] = joints[ :, weighted, 1 ].max( axis = 1 )
+        else:
+            frames[:] = numpy.nan
+
+        clip = numpy.array( [ frames[ :, 0 ].min( axis = 0 ), frames[ :, 1 ].max( axis = 0 ) ] )
+
+        return MD5_Anim.computed_bounds_layout(
+            frames,
+            joints,
+            clip,
+            weighted
+            )
+
+    def _select_frames( self, num_frames, frames ):
+        """Converts the frame selection into an array of frame indices
+        and reduces the bounds to the selected frames.
+        """
+        self.frame_indices = numpy.arange( num_frames )
+        if frames is not None:
+            self.frame_indices = numpy.atleast_1d( self.frame_indices[ frames ] )
+            self.bounds.bounds = self.bounds.bounds[ self.frame_indices ]
+        return self.frame_indices
+
+    def _process_buffer( self, buffer, frames = None ):
         """Processes the MD5 Mesh file from the specified buffer.
         """
+        num_frames, num_animated_components = self._process_header( buffer )
+        selected = self._select_frames( num_frames, frames )
+
+        # process frames
+        # each frame is processed individually
+        # frames that are not selected are skipped
+        wanted = set( selected )
+        parsed = {}
+        for index in range( max( wanted ) + 1 if wanted else 0 ):
+            parse_to( buffer, 'frame' )
+            if index in wanted:
+                parsed[ index ] = MD5_Frame( buffer, False )
+            else:
+                skip_block( buffer )
+
+        self.frames = [ parsed[ index ] for index in selected ]
+        num_frames = len( self.frames )
+
+        # validate our frame data
+        for frame in self.frames:
+            if frame.num_animated_components != num_animated_components:
+                raise ValueError("Number of animated components doesn't match")
+
+        # store the frames in a single array
+        # each frame's values become a view of its row
+        self.frame_values = numpy.empty( (num_frames, num_animated_components), dtype = 'float' )
+        for values, frame in zip( self.frame_values, self.frames ):
+            values[:] = frame.values
+            frame.values = values
+        self._local_poses = None
+
+    def _process_parallel( self, filename, data, workers, pool, frames = None ):
+        """Processes the MD5 Anim file with the frame blocks
+        parsed by a pool of workers.
+        """
+        first, blocks = _find_frame_blocks( data )
+
+        # the header is everything before the first frame
+        header = data[ :first ] if first is not None else data
+        statements = process_md5_buffer( StringIO( header ) )
+        num_frames, num_animated_components = self._process_header( statements )
+
+        if len( blocks ) != num_frames or \
+            len( set( index for index, start, end in blocks ) ) != num_frames:
+            raise ValueError( "Number of frames doesn't match" )
+
+        # only parse the selected frames
+        # blocks are re-indexed by their row in the frame array
+        selected = self._select_frames( num_frames, frames )
+        positions = dict( (index, (start, end)) for index, start, end in blocks )
+        blocks = [
+            (row, positions[ index ][ 0 ], positions[ index ][ 1 ])
+            for row, index in enumerate( selected )
+            ]
+        blocks.sort( key = lambda block: block[ 1 ] )
+        num_frames = len( selected )
+
+        shape = (num_frames, num_animated_components)
+
+        # split the blocks into a few tasks per worker
+        num_tasks = max( 1, min( len( blocks ), workers * 4 ) )
+        size = (len( blocks ) + num_tasks - 1) // num_tasks
+        tasks = [ blocks[ index : index + size ] for index in range( 0, len( blocks ), size ) ]
+
+        if pool == 'thread':
+            self.frame_values = numpy.empty( shape, dtype = 'float' )
+
+            def parse( task ):
+                _parse_frame_blocks( data, 0, task, self.frame_values )
+
+            threads = multiprocessing.pool.ThreadPool( workers )
+            try:
+                threads.map( parse, tasks )
+            finally:
+                threads.close()
+        else:
+            # workers write directly into shared memory
+            shared = multiprocessing.RawArray( 'd', num_frames * num_animated_components )
+            processes = multiprocessing.Pool(
+                workers,
+                initializer = _init_frame_worker,
+                initargs = (shared, shape)
+                )
+            try:
+                processes.map(
+                    _parse_frame_task,
+                    [
+                        (filename, task[ 0 ][ 1 ], task[ -1 ][ 2 ], task)
+                        for task in tasks
+                        ]
+                    )
+            finally:
+                processes.close()
+                processes.join()
+            self.frame_values = numpy.frombuffer( shared, dtype = 'float' ).reshape( shape )
+
+        self.frames = [
+            MD5_Frame( None, values = values )
+            for values in self.frame_values
+            ]
+        self._local_poses = None
+
+    def _process_header( self, buffer ):
+        """Processes the MD5 Anim header, hierarchy, bounds
+        and base frame.
+
+        Returns the number of frames and the number of animated
+        components per frame.
+        """
         # Processes the MD5 Anim header.
         line = parse_to( buffer, 'MD5Version' )
         values = line.split( None )
@@ -407,15 +862,5 @@ class MD5_Anim( MD5 ):
         # process the base frame
         self.base_frame = MD5_BaseFrame( buffer, num_joints )
 
-        # process frames
-        # each frame is processed individually
-        self.frames = [
-            MD5_Frame( buffer )
-            for index in range( num_frames )
-            ]
-
-        # validate our frame data
-        for frame in self.frames:
-            if frame.num_animated_components != num_animated_components:
-                raise ValueError("Number of animated components doesn't match")
+        return num_frames, num_animated_components
 
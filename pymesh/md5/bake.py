@@ -0,0 +1,176 @@
+"""Bakes MD5 Mesh animations into vertex animation arrays.
+
+Render paths that cannot perform skeletal skinning can play
+back the baked positions and normals of each frame instead.
+"""
+
+from collections import namedtuple
+
+import numpy
+from numpy.lib.format import open_memmap
+
+from skinning import MD5_Skin
+
+
+class MD5_Baker( object ):
+    """Skins an MD5_Mesh with every frame of MD5_Anim objects.
+
+    Frames are evaluated in chunks, so memory use is bounded by
+    the chunk size and the output arrays.
+
+    Vertices of all sub-meshes are stored consecutively, as in
+    MD5_Skin.
+
+    Positions can be quantized to unsigned 16 bit integers within
+    the clip's bounds, and normals to signed 8 bit integers.
+    The original positions are:
+    positions * scale + offset
+    and the normals are:
+    normals / 127.0
+    """
+
+    baked_layout = namedtuple(
+        'MD5_Baked',
+        [
+            'positions',
+            'normals',
+            'scale',
+            'offset',
+            'nbytes'
+            ]
+        )
+
+    def __init__( self, mesh, mode = 'linear' ):
+        """
+        @param mesh: the MD5_Mesh to bake.
+        @param mode: the skinning mode, see MD5_Skin.
+        """
+        super( MD5_Baker, self ).__init__()
+
+        self.mesh = mesh
+        self.skin = MD5_Skin( mesh, mode )
+
+        # all triangles indexing the combined vertices
+        self.triangles = numpy.concatenate(
+            [
+                submesh.tris + offset
+                for submesh, offset in zip( mesh.meshes, self.skin.vertex_offsets )
+                ]
+            ).reshape( -1, 3 )
+
+        # sort the triangle corners by vertex so normals can
+        # be accumulated with a single reduction
+        corners = self.triangles.ravel()
+        self._corner_order = numpy.argsort( corners, kind = 'mergesort' )
+        self._corner_faces = self._corner_order // 3
+        sorted_corners = corners[ self._corner_order ]
+        self._corner_starts = numpy.concatenate(
+            [ [ 0 ], numpy.nonzero( numpy.diff( sorted_corners ) )[ 0 ] + 1 ]
+            ) if len( sorted_corners ) else numpy.zeros( 0, dtype = 'int' )
+        self._corner_vertices = sorted_corners[ self._corner_starts ]
+
+    def normals( self, vertices ):
+        """Calculates area weighted vertex normals.
+
+        @param vertices: skinned vertices with the shape (..., vertices, 3).
+        @return: unit normals with the same shape.
+        """
+        result = numpy.zeros( vertices.shape, dtype = 'float' )
+        if len( self.triangles ) == 0:
+            return result
+
+        corners = vertices[ ..., self.triangles, : ]
+
+        # md5 triangles are wound clockwise
+        faces = numpy.cross(
+            corners[ ..., 2, : ] - corners[ ..., 0, : ],
+            corners[ ..., 1, : ] - corners[ ..., 0, : ]
+            )
+
+        result[ ..., self._corner_vertices, : ] = numpy.add.reduceat(
+            faces[ ..., self._corner_faces, : ],
+            self._corner_starts,
+            axis = -2
+            )
+
+        length = numpy.sqrt( numpy.sum( result * result, axis = -1 ) )[ ..., numpy.newaxis ]
+        length[ length == 0.0 ] = 1.0
+        result /= length
+        return result
+
+    def bake( self, anim, chunk_size = 32, quantize = False, filename = None ):
+        """Bakes every frame of the animation.
+
+        @param anim: the MD5_Anim to apply to the mesh.
+        @param chunk_size: the number of frames evaluated at once.
+        @param quantize: stores positions as uint16 and normals
+        as int8 when True.
+        @param filename: when provided, the arrays are memory-mapped
+        into the files '<filename>_positions.npy' and
+        '<filename>_normals.npy' instead of being held in memory.
+        @return: a baked_layout named tuple. 'positions' and 'normals'
+        have the shape (frames, vertices, 3). 'nbytes' is the size
+        of both arrays.
+        """
+        remap = self.mesh.skeleton.remap( anim.skeleton )
+        if (remap < 0).any():
+            raise ValueError( "Animation does not contain all joints of the mesh" )
+
+        shape = (anim.num_frames, self.skin.num_verts, 3)
+
+        if quantize:
+            position_type, normal_type = numpy.uint16, numpy.int8
+
+            # quantize against the bounds of the whole clip
+            clip = anim.compute_bounds( self.mesh ).clip
+            offset = clip[ 0 ]
+            scale = (clip[ 1 ] - clip[ 0 ]) / 65535.0
+            scale[ scale == 0.0 ] = 1.0
+        else:
+            position_type, normal_type = numpy.float32, numpy.float32
+            offset = numpy.zeros( 3 )
+            scale = numpy.ones( 3 )
+
+        if filename:
+            positions = open_memmap(
+                '%s_positions.npy' % filename,
+                mode = 'w+', dtype = position_type, shape = shape
+                )
+            normals = open_memmap(
+                '%s_normals.npy' % filename,
+                mode = 'w+', dtype = normal_type, shape = shape
+                )
+        else:
+            positions = numpy.empty( shape, dtype = position_type )
+            normals = numpy.empty( shape, dtype = normal_type )
+
+        for start in range( 0, anim.num_frames, chunk_size ):
+            frames = slice( start, min( start + chunk_size, anim.num_frames ) )
+
+            joint_positions, joint_orientations = anim.model_poses( frames )
+            vertices = self.skin.skin(
+                joint_positions[ :, remap ],
+                joint_orientations[ :, remap ]
+                )
+            vertex_normals = self.normals( vertices )
+
+            if quantize:
+                vertices -= offset
+                vertices /= scale
+                positions[ frames ] = numpy.clip( numpy.rint( vertices ), 0, 65535 )
+                normals[ frames ] = numpy.rint( vertex_normals * 127.0 )
+            else:
+                positions[ frames ] = vertices
+                normals[ frames ] = vertex_normals
+
+        if filename:
+            positions.flush()
+            normals.flush()
+
+        return MD5_Baker.baked_layout(
+            positions,
+            normals,
+            scale,
+            offset,
+            positions.nbytes + normals.nbytes
+            )
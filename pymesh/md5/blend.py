@@ -0,0 +1,197 @@
+"""Blends multiple MD5 Anim layers into a single local pose.
+
+Layers are blended in order over a rest pose.
+Override layers interpolate towards their pose by their weight.
+Additive layers apply their difference from a reference frame.
+
+Evaluation is vectorized over the joints and over a batch of
+characters. A batch is created by passing arrays of times and
+weights to the layers.
+
+For example, a locomotion clip with an additive lean over
+the upper body:
+
+    skeleton = mesh.skeleton
+    blender = MD5_Blender( skeleton, *mesh.joints.local_pose() )
+    layers = [
+        MD5_Layer( walk, times ),
+        MD5_Layer( lean, times, weight = 0.5, additive = True,
+            mask = skeleton.subtree_mask( 'spine' ) ),
+        ]
+    pose = blender.blend( layers )
+    positions, orientations = blender.to_model( pose )
+"""
+
+import numpy
+
+from common import quaternion_conjugate, quaternion_multiply
+from common import quaternion_nlerp, quaternion_slerp
+
+
+class MD5_Layer( object ):
+    """A single animation layer.
+
+    anim        The MD5_Anim to sample.
+    time        Time in seconds, a scalar or an array with one
+                value per character.
+    weight      Blend weight, a scalar or an array with one
+                value per character.
+    mask        Optional per-joint weights of the blender's
+                skeleton, ie. from MD5_Skeleton.subtree_mask.
+    additive    Applies the difference between the sampled pose and
+                the reference frame instead of overriding the pose.
+    reference   The frame additive layers are relative to.
+    loop        Wraps the time around the clip when True,
+                otherwise the time is clamped to the clip.
+    """
+
+    def __init__(
+        self,
+        anim,
+        time = 0.0,
+        weight = 1.0,
+        mask = None,
+        additive = False,
+        reference = 0,
+        loop = True
+        ):
+        super( MD5_Layer, self ).__init__()
+
+        self.anim = anim
+        self.time = time
+        self.weight = weight
+        self.mask = mask
+        self.additive = additive
+        self.reference = reference
+        self.loop = loop
+
+
+class MD5_Blender( object ):
+    """Blends MD5_Layer objects into local poses of a skeleton.
+
+    Poses are returned as a single array with the shape
+    (characters, joints, 7). The last dimension contains the
+    joint's position (x, y, z) followed by the orientation
+    quaternion (x, y, z, w).
+    """
+
+    def __init__( self, skeleton, positions, orientations, interpolation = 'nlerp' ):
+        """
+        @param skeleton: the MD5_Skeleton that poses are created for.
+        @param positions: rest pose local joint positions.
+        @param orientations: rest pose local joint orientations.
+        @param interpolation: 'nlerp' or 'slerp'.
+        """
+        super( MD5_Blender, self ).__init__()
+
+        if interpolation == 'nlerp':
+            self._interpolate = quaternion_nlerp
+        elif interpolation == 'slerp':
+            self._interpolate = quaternion_slerp
+        else:
+            raise ValueError( "Unknown interpolation '%s'" % interpolation )
+
+        self.skeleton = skeleton
+        self.rest = numpy.empty( (skeleton.num_joints, 7), dtype = 'float' )
+        self.rest[ :, :3 ] = positions
+        self.rest[ :, 3: ] = orientations
+
+    def sample( self, anim, time, loop = True ):
+        """Samples an animation at the specified times.
+
+        Joints are in the order of the animation's hierarchy.
+
+        Returns an array with the shape (characters, joints, 7).
+        """
+        positions, orientations = anim.local_poses()
+        num_frames = anim.num_frames
+
+        frame = numpy.atleast_1d( numpy.asarray( time, dtype = 'float' ) ) * anim.frame_rate
+        if loop:
+            frame = numpy.mod( frame, num_frames )
+            start = numpy.floor( frame ).astype( 'int' )
+            end = (start + 1) % num_frames
+        else:
+            frame = numpy.clip( frame, 0.0, num_frames - 1 )
+            start = numpy.floor( frame ).astype( 'int' )
+            end = numpy.minimum( start + 1, num_frames - 1 )
+        alpha = (frame - start)[ :, numpy.newaxis ]
+
+        result = numpy.empty( (len( frame ), anim.hierarchy.num_joints, 7), dtype = 'float' )
+        result[ ..., :3 ] = positions[ start ]
+        result[ ..., :3 ] += (positions[ end ] - positions[ start ]) * alpha[ ..., numpy.newaxis ]
+        result[ ..., 3: ] = self._interpolate( orientations[ start ], orientations[ end ], alpha )
+        return result
+
+    def blend( self, layers, out = None ):
+        """Blends the layers in order over the rest pose.
+
+        The number of characters is taken from the largest
+        time or weight array of the layers.
+        Joints of the skeleton that are not present in a layer's
+        animation are not affected by that layer.
+
+        @param layers: a list of MD5_Layer objects.
+        @param out: an optional array to store the result in.
+        @return: an array with the shape (characters, joints, 7).
+        """
+        num_characters = 1
+        for layer in layers:
+            num_characters = max(
+                num_characters,
+                numpy.size( layer.time ),
+                numpy.size( layer.weight )
+                )
+
+        if out is None:
+            out = numpy.empty( (num_characters, self.skeleton.num_joints, 7), dtype = 'float' )
+        out[:] = self.rest
+
+        for layer in layers:
+            # map our joints to the joints of the animation
+            remap = self.skeleton.remap( layer.anim.skeleton )
+            valid = remap >= 0
+            remap = remap[ valid ]
+
+            # per character, per joint weights
+            weights = numpy.empty( (num_characters, self.skeleton.num_joints), dtype = 'float' )
+            weights[:] = numpy.reshape( layer.weight, (-1, 1) )
+            if layer.mask is not None:
+                weights *= layer.mask
+            weights = weights[ :, valid ]
+
+            pose = self.sample( layer.anim, layer.time, layer.loop )[ :, remap ]
+            current = out[ :, valid ]
+
+            if layer.additive:
+                positions, orientations = layer.anim.local_poses()
+                reference_positions = positions[ layer.reference, remap ]
+                reference_orientations = orientations[ layer.reference, remap ]
+
+                # the difference between the pose and the reference
+                # is scaled from the identity quaternion by the weight
+                delta = quaternion_multiply(
+                    quaternion_conjugate( reference_orientations ),
+                    pose[ ..., 3: ]
+                    )
+                identity = numpy.zeros_like( delta )
+                identity[ ..., 3 ] = 1.0
+                delta = self._interpolate( identity, delta, weights )
+
+                current[ ..., :3 ] += (pose[ ..., :3 ] - reference_positions) * weights[ ..., numpy.newaxis ]
+                current[ ..., 3: ] = quaternion_multiply( current[ ..., 3: ], delta )
+            else:
+                current[ ..., :3 ] += (pose[ ..., :3 ] - current[ ..., :3 ]) * weights[ ..., numpy.newaxis ]
+                current[ ..., 3: ] = self._interpolate( current[ ..., 3: ], pose[ ..., 3: ], weights )
+
+            out[ :, valid ] = current
+
+        return out
+
+    def to_model( self, pose ):
+        """Converts a blended pose into model space.
+
+        Returns a tuple of positions and orientations with the shapes
+        (characters, joints, 3) and (characters, joints, 4).
+        """
+        return self.skeleton.to_model( pose[ ..., :3 ], pose[ ..., 3: ] )
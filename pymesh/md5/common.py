@@ -1,5 +1,7 @@
 import math
 
+import numpy
+
 
 def process_md5_buffer( buffer ):
     """Generator that processes a buffer and returns
@@ -60,18 +62,153 @@ def parse_to( buffer, keyword ):
         if values[ 0 ] == keyword:
             return line
 
+def skip_block( buffer ):
+    """Continues through the buffer until the end of the
+    current block.
+
+    Lines are not tokenized, this only looks for the closing
+    brace, so unwanted blocks can be skipped quickly.
+    """
+    while True:
+        line = buffer.next()
+
+        if line == '':
+            return
+
+        if line.startswith( '}' ):
+            return
+
 def compute_quaternion_w( x, y, z ):
     """Computes the Quaternion W component from the
     Quaternion X, Y and Z components.
+
+    MD5 files store unit quaternions with a negative
+    W component.
     """
     # extract our W quaternion component
     w = 1.0 - (x ** 2) - (y ** 2) - (z ** 2)
     if w < 0.0:
         w = 0.0
     else:
-        w = math.sqrt( w )
+        w = -math.sqrt( w )
     return w
 
+def compute_quaternions( xyz ):
+    """Computes full quaternions from an array of
+    Quaternion X, Y and Z components.
+
+    This is the vectorized equivalent of compute_quaternion_w.
+    The array has the shape (..., 3) and the result (..., 4).
+    """
+    xyz = numpy.asarray( xyz, dtype = 'float' )
+    result = numpy.empty( xyz.shape[ :-1 ] + (4,), dtype = 'float' )
+    result[ ..., :3 ] = xyz
+    w = 1.0 - numpy.sum( xyz * xyz, axis = -1 )
+    numpy.maximum( w, 0.0, out = w )
+    result[ ..., 3 ] = -numpy.sqrt( w )
+    return result
+
+def quaternion_multiply( a, b ):
+    """Multiplies two arrays of quaternions.
+
+    Quaternions are in the format [x, y, z, w].
+    The arrays are broadcast against each other, so any number of
+    leading dimensions is supported.
+    The result rotates by 'b' and then by 'a'.
+    """
+    ax, ay, az, aw = a[ ..., 0 ], a[ ..., 1 ], a[ ..., 2 ], a[ ..., 3 ]
+    bx, by, bz, bw = b[ ..., 0 ], b[ ..., 1 ], b[ ..., 2 ], b[ ..., 3 ]
+
+    return numpy.stack(
+        [
+            aw * bx + ax * bw + ay * bz - az * by,
+            aw * by - ax * bz + ay * bw + az * bx,
+            aw * bz + ax * by - ay * bx + az * bw,
+            aw * bw - ax * bx - ay * by - az * bz,
+            ],
+        axis = -1
+        )
+
+def quaternion_conjugate( q ):
+    """Returns the conjugate of an array of quaternions.
+
+    For unit quaternions this is the inverse rotation.
+    """
+    result = numpy.array( q, dtype = 'float' )
+    result[ ..., :3 ] *= -1.0
+    return result
+
+def quaternion_normalise( q ):
+    """Returns an array of quaternions scaled to unit length.
+    """
+    length = numpy.sqrt( numpy.sum( q * q, axis = -1 ) )
+    return q / length[ ..., numpy.newaxis ]
+
+def quaternion_nlerp( a, b, t ):
+    """Normalised linear interpolation between two arrays of
+    unit quaternions.
+
+    't' is broadcast against the quaternions without their last
+    dimension, so a value per quaternion can be passed.
+    'b' is negated where required so the interpolation takes
+    the shortest path.
+    """
+    t = numpy.asarray( t, dtype = 'float' )[ ..., numpy.newaxis ]
+    dot = numpy.sum( a * b, axis = -1 )[ ..., numpy.newaxis ]
+    b = numpy.where( dot < 0.0, -b, b )
+    return quaternion_normalise( a + (b - a) * t )
+
+def quaternion_slerp( a, b, t ):
+    """Spherical linear interpolation between two arrays of
+    unit quaternions.
+
+    Arguments are the same as quaternion_nlerp.
+    Nearly identical quaternions fall back to nlerp.
+    """
+    t = numpy.asarray( t, dtype = 'float' )[ ..., numpy.newaxis ]
+    dot = numpy.sum( a * b, axis = -1 )[ ..., numpy.newaxis ]
+    b = numpy.where( dot < 0.0, -b, b )
+    dot = numpy.clip( numpy.abs( dot ), 0.0, 1.0 )
+
+    angle = numpy.arccos( dot )
+    sin_angle = numpy.sin( angle )
+    linear = sin_angle < 1e-6
+    sin_angle[ linear ] = 1.0
+
+    scale_a = numpy.where( linear, 1.0 - t, numpy.sin( (1.0 - t) * angle ) / sin_angle )
+    scale_b = numpy.where( linear, t, numpy.sin( t * angle ) / sin_angle )
+    return quaternion_normalise( a * scale_a + b * scale_b )
+
+def quaternion_rotate( q, v ):
+    """Rotates an array of vectors by an array of unit quaternions.
+
+    The arrays are broadcast against each other.
+    """
+    u = q[ ..., :3 ]
+    w = q[ ..., 3: ]
+    t = 2.0 * numpy.cross( u, v )
+    return v + w * t + numpy.cross( u, t )
+
+def quaternion_to_matrix( q ):
+    """Converts an array of unit quaternions into rotation matrices.
+
+    The array has the shape (..., 4) and the result (..., 3, 3).
+    Matrices are applied to column vectors.
+    """
+    x, y, z, w = q[ ..., 0 ], q[ ..., 1 ], q[ ..., 2 ], q[ ..., 3 ]
+
+    result = numpy.empty( q.shape[ :-1 ] + (3, 3), dtype = 'float' )
+    result[ ..., 0, 0 ] = 1.0 - 2.0 * (y * y + z * z)
+    result[ ..., 0, 1 ] = 2.0 * (x * y - z * w)
+    result[ ..., 0, 2 ] = 2.0 * (x * z + y * w)
+    result[ ..., 1, 0 ] = 2.0 * (x * y + z * w)
+    result[ ..., 1, 1 ] = 1.0 - 2.0 * (x * x + z * z)
+    result[ ..., 1, 2 ] = 2.0 * (y * z - x * w)
+    result[ ..., 2, 0 ] = 2.0 * (x * z - y * w)
+    result[ ..., 2, 1 ] = 2.0 * (y * z + x * w)
+    result[ ..., 2, 2 ] = 1.0 - 2.0 * (x * x + y * y)
+    return result
+
 
 class MD5( object ):
 
@@ -82,17 +219,18 @@ class MD5( object ):
 
         self.md5_version = None
 
-    def load( self, filename ):
+    def load( self, filename, **kwargs ):
         """
         Reads the MD2 data from the existing
         specified filename.
 
         @param filename: the filename of the md2 file
         to load.
+        Any keyword arguments are passed to load_from_buffer.
         """
         with open( filename, 'r' ) as f:
-            self.load_from_buffer( f )
+            self.load_from_buffer( f, **kwargs )
     
-    def load_from_buffer( self, buffer ):
+    def load_from_buffer( self, buffer, **kwargs ):
         raise NotImplementedError
 
@@ -6,7 +6,10 @@ from collections import namedtuple
 
 import numpy
 
-from common import MD5, process_md5_buffer, parse_to, compute_quaternion_w
+from common import MD5, process_md5_buffer, parse_to, skip_block, compute_quaternion_w
+from common import quaternion_conjugate, quaternion_multiply, quaternion_rotate
+from common import quaternion_to_matrix
+from skeleton import MD5_Skeleton
 
 
 class MD5_SubMesh( object ):
@@ -36,8 +39,31 @@ class MD5_SubMesh( object ):
         )
     
 
+    # record layouts used to store the vertex and weight data
+    # the column arrays (tcs, start_weights, ...) are views
+    # of the fields of these records
+    vertex_dtype = numpy.dtype(
+        [
+            ('tcs', 'float', (2,)),
+            ('start_weight', 'int'),
+            ('weight_count', 'int'),
+            ]
+        )
+
+    weight_dtype = numpy.dtype(
+        [
+            ('joint', 'int'),
+            ('bias', 'float'),
+            ('position', 'float', (3,)),
+            ]
+        )
+
     class Vertices( object ):
         """Provides an iterator over MD5 SubMesh vertex data.
+
+        This yields a vertex_layout tuple per vertex and is
+        only provided for compatibility.
+        Use the 'vertices' record array for batch access.
         """
 
         def __init__( self, submesh ):
@@ -54,6 +80,10 @@ class MD5_SubMesh( object ):
 
     class Weights( object ):
         """Provides an iterator over MD5 SubMesh weight data.
+
+        This yields a weight_layout tuple per weight and is
+        only provided for compatibility.
+        Use the 'weights' record array for batch access.
         """
 
         def __init__( self, submesh ):
@@ -68,10 +98,29 @@ class MD5_SubMesh( object ):
             for index in range( self.submesh.num_weights ):
                 yield self.submesh.weight( index )
 
-    def __init__( self, buffer, seek_to = True ):
+    optimise_layout = namedtuple(
+        "MD5_WeightOptimisation",
+        [
+            'removed',
+            'max_error',
+            'mean_error'
+            ]
+        )
+
+    def __init__( self, buffer, seek_to = True, shader = None ):
+        """Parses a 'mesh' block from the buffer.
+
+        If 'shader' is provided, the shader statement is expected
+        to have already been read from the buffer.
+        See MD5_SubMesh.read_shader.
+        """
         super( MD5_SubMesh, self ).__init__()
 
-        self.shader = None
+        self.shader = shader
+
+        # record arrays
+        self._vertices = None
+        self._weights = None
 
         # vertices
         self.tcs = None
@@ -87,7 +136,7 @@ class MD5_SubMesh( object ):
         self.positions = None
 
         # load the joint data
-        self._process_mesh( buffer, seek_to )
+        self._process_mesh( buffer, seek_to, shader is None )
 
     @property
     def num_verts( self ):
@@ -103,15 +152,30 @@ class MD5_SubMesh( object ):
 
     @property
     def vertices( self ):
-        """Returns an iterator that yields vertex_layout tuples.
+        """Returns the vertex data as a numpy record array.
+
+        The array has the fields 'tcs', 'start_weight' and
+        'weight_count'.
+        Slicing returns a batch of vertices, ie.
+        mesh.vertices[ 10:20 ].start_weight
+
+        Use MD5_SubMesh.Vertices( mesh ) to iterate over
+        vertex_layout tuples.
         """
-        return MD5_SubMesh.Vertices( self  )
+        return self._vertices
 
     @property
     def weights( self ):
-        """Returns an iterator that yields weight_layout tuples.
+        """Returns the weight data as a numpy record array.
+
+        The array has the fields 'joint', 'bias' and 'position'.
+        Slicing returns a batch of weights, ie.
+        mesh.weights[ 10:20 ].bias
+
+        Use MD5_SubMesh.Weights( mesh ) to iterate over
+        weight_layout tuples.
         """
-        return MD5_SubMesh.Weights( self )
+        return self._weights
 
     def vertex( self, index ):
         """Returns a vertex_layout tuple for the specified vertex index.
@@ -136,7 +200,129 @@ class MD5_SubMesh( object ):
             self.positions[ index ]
             )
 
-    def _process_mesh( self, buffer, seek_to = True ):
+    def bind_vertices( self, joints ):
+        """Returns the vertex positions in the bind pose.
+
+        @param joints: the MD5_Joints of the mesh.
+        @return: an array with the shape (vertices, 3).
+        """
+        vertices, weights = self._vertex_weights()
+        return self._sum_weights( joints, vertices, weights )
+
+    def _vertex_weights( self ):
+        """Returns the vertex and weight index of every
+        vertex influence.
+        """
+        counts = self.weight_counts
+        vertices = numpy.repeat( numpy.arange( self.num_verts ), counts )
+
+        # the position of each influence within its vertex
+        firsts = numpy.cumsum( counts ) - counts
+        offsets = numpy.arange( counts.sum() ) - numpy.repeat( firsts, counts )
+        weights = numpy.repeat( self.start_weights, counts ) + offsets
+        return vertices, weights
+
+    def _sum_weights( self, joints, vertices, weights, biases = None ):
+        if biases is None:
+            biases = self.biases[ weights ]
+        joint_indices = self.joints[ weights ]
+        positions = joints.positions[ joint_indices ] + quaternion_rotate(
+            joints.orientations[ joint_indices ],
+            self.positions[ weights ]
+            )
+        positions *= biases[ :, numpy.newaxis ]
+
+        result = numpy.empty( (self.num_verts, 3), dtype = 'float' )
+        for axis in range( 3 ):
+            result[ :, axis ] = numpy.bincount(
+                vertices,
+                positions[ :, axis ],
+                minlength = self.num_verts
+                )
+        return result
+
+    def optimise_weights( self, joints, min_bias = 0.0, max_influences = None ):
+        """Removes insignificant weights and sorts the remainder.
+
+        Weights with a bias below 'min_bias' are removed, and only
+        the 'max_influences' weights with the largest bias are kept
+        for each vertex. The largest weight of a vertex is always
+        kept. The remaining biases of each vertex are renormalised
+        to sum to 1.
+
+        The weights are then re-ordered so each vertex's weights are
+        contiguous and sorted by joint. 'start_weights' and
+        'weight_counts' are updated to match.
+
+        @param joints: the MD5_Joints of the mesh, used to measure
+        the error in the bind pose.
+        @param min_bias: the smallest bias to keep.
+        @param max_influences: the maximum number of weights per vertex.
+        @return: an optimise_layout named tuple with the number of
+        weights removed and the maximum and mean distance the vertices
+        moved in the bind pose.
+        """
+        vertices, weights = self._vertex_weights()
+        before = self._sum_weights( joints, vertices, weights )
+        num_influences = len( weights )
+
+        # rank the weights of each vertex by decreasing bias
+        biases = self.biases[ weights ]
+        order = numpy.lexsort( (-biases, vertices) )
+        vertices, weights, biases = vertices[ order ], weights[ order ], biases[ order ]
+        firsts = numpy.cumsum( self.weight_counts ) - self.weight_counts
+        ranks = numpy.arange( len( weights ) ) - firsts[ vertices ]
+
+        keep = biases >= min_bias
+        if max_influences is not None:
+            keep &= ranks < max_influences
+        keep |= ranks == 0
+        vertices, weights, biases = vertices[ keep ], weights[ keep ], biases[ keep ]
+
+        # renormalise the biases of each vertex
+        totals = numpy.bincount( vertices, biases, minlength = self.num_verts )
+        totals[ totals == 0.0 ] = 1.0
+        biases = biases / totals[ vertices ]
+
+        # sort by vertex and then by joint
+        order = numpy.lexsort( (self.joints[ weights ], vertices) )
+        vertices, weights, biases = vertices[ order ], weights[ order ], biases[ order ]
+
+        # store the new weights
+        records = numpy.recarray( len( weights ), dtype = MD5_SubMesh.weight_dtype )
+        records[ 'joint' ] = self.joints[ weights ]
+        records[ 'bias' ] = biases
+        records[ 'position' ] = self.positions[ weights ]
+
+        self._weights = records
+        self.joints = records[ 'joint' ]
+        self.biases = records[ 'bias' ]
+        self.positions = records[ 'position' ]
+
+        self.weight_counts[:] = numpy.bincount( vertices, minlength = self.num_verts )
+        self.start_weights[:] = numpy.cumsum( self.weight_counts ) - self.weight_counts
+
+        # measure the error in the bind pose
+        vertices, weights = self._vertex_weights()
+        after = self._sum_weights( joints, vertices, weights )
+        errors = numpy.sqrt( numpy.sum( (after - before) ** 2, axis = -1 ) )
+
+        return MD5_SubMesh.optimise_layout(
+            num_influences - len( weights ),
+            errors.max() if len( errors ) else 0.0,
+            errors.mean() if len( errors ) else 0.0
+            )
+
+    @staticmethod
+    def read_shader( buffer ):
+        """Reads the 'shader' parameter of a mesh block.
+        """
+        line = parse_to( buffer, 'shader' )
+        values = line.split( None, 1 )
+        # remove quotes
+        return values[ 1 ][ 1:-1 ]
+
+    def _process_mesh( self, buffer, seek_to = True, process_shader = True ):
         """Processes a single 'mesh' block.
 
         If 'seek_to' is True, the first step will be to seek to the next mesh block
@@ -146,7 +332,8 @@ class MD5_SubMesh( object ):
         if seek_to:
             parse_to( buffer, 'mesh' )
 
-        self._process_shader( buffer )
+        if process_shader:
+            self._process_shader( buffer )
         self._process_vertices( buffer )
         self._process_triangles( buffer )
         self._process_weights( buffer )
@@ -154,10 +341,7 @@ class MD5_SubMesh( object ):
     def _process_shader( self, buffer ):
         """Extracts the 'shader' parameter from a mesh block.
         """
-        line = parse_to( buffer, 'shader' )
-        values = line.split( None, 1 )
-        # remove quotes
-        self.shader = values[ 1 ][ 1:-1 ]
+        self.shader = MD5_SubMesh.read_shader( buffer )
 
     def _process_vertices( self, buffer ):
         """Processes the 'numverts' and 'vert' statements of a mesh block.
@@ -178,9 +362,12 @@ class MD5_SubMesh( object ):
         values = line.split( None, 1 )
         num_verts = int( values[ 1 ] )
 
-        self.tcs = numpy.empty( (num_verts, 2), dtype = 'float' )
-        self.start_weights = numpy.empty( num_verts, dtype = 'int' )
-        self.weight_counts = numpy.empty( num_verts, dtype = 'int' )
+        # store the values in a record array and expose
+        # each field as a column
+        self._vertices = numpy.recarray( num_verts, dtype = MD5_SubMesh.vertex_dtype )
+        self.tcs = self._vertices[ 'tcs' ]
+        self.start_weights = self._vertices[ 'start_weight' ]
+        self.weight_counts = self._vertices[ 'weight_count' ]
 
         # process the vertices
         for index in range( num_verts ):
@@ -212,8 +399,9 @@ class MD5_SubMesh( object ):
                 process_tri( buffer.next() )
                 for num in range( num_tris )
                 ],
-            dtype = 'float'
+            dtype = 'int'
             )
+        self.tris.shape = (-1, 3)
 
     def _process_weights( self, buffer ):
         """Processes the 'numweights' and 'weight' statements of a mesh block.
@@ -238,9 +426,12 @@ class MD5_SubMesh( object ):
         values = line.split( None, 1 )
         num_weights = int( values[ 1 ] )
 
-        self.joints = numpy.empty( num_weights, dtype = 'int' )
-        self.biases = numpy.empty( num_weights, dtype = 'float' )
-        self.positions = numpy.empty( (num_weights, 3), dtype = 'float' )
+        # store the values in a record array and expose
+        # each field as a column
+        self._weights = numpy.recarray( num_weights, dtype = MD5_SubMesh.weight_dtype )
+        self.joints = self._weights[ 'joint' ]
+        self.biases = self._weights[ 'bias' ]
+        self.positions = self._weights[ 'position' ]
 
         for index in range( num_weights ):
             joint, bias, position = process_weight( buffer.next() )
@@ -260,8 +451,24 @@ class MD5_Joints( object ):
     Ie.
     for joint in joints:
         print joint.name, joint.parent, joint.position, joint.orientation
+
+    The iterator yields joint_layout tuples and is provided for
+    compatibility. The joint data is also available as a numpy
+    record array through 'records', which can be indexed and
+    sliced directly from the object.
+    Ie.
+    joints[ 1:5 ].position
     """
 
+    joint_dtype = numpy.dtype(
+        [
+            ('name', 'object'),
+            ('parent', 'int'),
+            ('position', 'float', (3,)),
+            ('orientation', 'float', (4,)),
+            ]
+        )
+
     joint_layout = namedtuple(
         "MD5_Joint",
         [
@@ -275,17 +482,29 @@ class MD5_Joints( object ):
     def __init__( self, buffer, num_joints, seek_to = True ):
         super( MD5_Joints, self ).__init__()
 
+        self.records = None
         self.names = None
         self.parents = None
         self.positions = None
         self.orientations = None
 
+        self._skeleton = None
+        self._inverse_bind_matrices = None
+
         # load the joint data
         self._process_joints( buffer, num_joints, seek_to )
 
     def __iter__( self ):
         return self.next()
 
+    def __len__( self ):
+        return self.num_joints
+
+    def __getitem__( self, index ):
+        """Returns the joint records for the specified index or slice.
+        """
+        return self.records[ index ]
+
     def next( self ):
         for index in range( self.num_joints ):
             yield self.joint( index )
@@ -304,6 +523,62 @@ class MD5_Joints( object ):
     def num_joints( self ):
         return len( self.names )
 
+    @property
+    def skeleton( self ):
+        """Returns an MD5_Skeleton for the joint hierarchy.
+
+        The skeleton is built on first access and re-used.
+        """
+        if self._skeleton is None:
+            self._skeleton = MD5_Skeleton( self.names, self.parents )
+        return self._skeleton
+
+    @property
+    def inverse_bind_matrices( self ):
+        """Returns the inverse of each joint's bind pose transform.
+
+        The matrices transform model space positions into joint
+        space and have the shape (joints, 3, 4), where the last
+        column is the translation.
+
+        The matrices are calculated on first access and re-used.
+        """
+        if self._inverse_bind_matrices is None:
+            rotations = quaternion_to_matrix(
+                quaternion_conjugate( self.orientations )
+                )
+            matrices = numpy.empty( (self.num_joints, 3, 4), dtype = 'float' )
+            matrices[ :, :, :3 ] = rotations
+            matrices[ :, :, 3 ] = -numpy.einsum( 'jab,jb->ja', rotations, self.positions )
+            self._inverse_bind_matrices = matrices
+        return self._inverse_bind_matrices
+
+    def local_pose( self ):
+        """Returns the bind pose relative to each joint's parent.
+
+        Mesh joints are stored in model space, this converts
+        them into the same space as MD5 Anim frames.
+
+        Returns a tuple of arrays with the shapes (joints, 3)
+        and (joints, 4).
+        """
+        positions = numpy.array( self.positions, dtype = 'float' )
+        orientations = numpy.array( self.orientations, dtype = 'float' )
+
+        children = numpy.nonzero( self.parents >= 0 )[ 0 ]
+        parents = self.parents[ children ]
+        inverse = quaternion_conjugate( self.orientations[ parents ] )
+
+        positions[ children ] = quaternion_rotate(
+            inverse,
+            self.positions[ children ] - self.positions[ parents ]
+            )
+        orientations[ children ] = quaternion_multiply(
+            inverse,
+            self.orientations[ children ]
+            )
+        return positions, orientations
+
     def _process_joints( self, buffer, num_joints, seek_to = True ):
         """Processes the joint block.
         Will simply iterate over 'self.num_joints' lines.
@@ -359,10 +634,13 @@ class MD5_Joints( object ):
         if seek_to:
             parse_to( buffer, 'joints' )
 
+        # store the values in a record array and expose
+        # each field as a column
+        self.records = numpy.recarray( num_joints, dtype = MD5_Joints.joint_dtype )
         self.names = []
-        self.parents = numpy.empty( (num_joints), dtype = 'int' )
-        self.positions = numpy.empty( (num_joints, 3), dtype = 'float' )
-        self.orientations = numpy.empty( (num_joints, 4), dtype = 'float' )
+        self.parents = self.records[ 'parent' ]
+        self.positions = self.records[ 'position' ]
+        self.orientations = self.records[ 'orientation' ]
 
         # iterate through our specified number of joints
         for index in range( num_joints ):
@@ -373,6 +651,8 @@ class MD5_Joints( object ):
             self.positions[ index ] = position
             self.orientations[ index ] = orientation
 
+        self.records[ 'name' ][:] = self.names
+
 
 class MD5_Mesh( MD5 ):
     """
@@ -426,6 +706,7 @@ class MD5_Mesh( MD5 ):
         self.md5_version = None
         self.joints = None
         self.meshes = None
+        self.mesh_indices = None
 
     @property
     def num_joints( self ):
@@ -449,32 +730,98 @@ class MD5_Mesh( MD5 ):
             total += mesh.num_tris
         return total
 
+    @property
+    def skeleton( self ):
+        return self.joints.skeleton
+
     def joint( self, index ):
         return self.joints.joint( index )
 
+    def optimise_weights( self, min_bias = 0.0, max_influences = None ):
+        """Removes insignificant weights from all sub-meshes
+        and sorts the remainder.
+
+        See MD5_SubMesh.optimise_weights.
+
+        @return: an MD5_SubMesh.optimise_layout named tuple for
+        the whole mesh.
+        """
+        results = [
+            mesh.optimise_weights( self.joints, min_bias, max_influences )
+            for mesh in self.meshes
+            ]
+        num_verts = self.num_verts
+
+        return MD5_SubMesh.optimise_layout(
+            sum( result.removed for result in results ),
+            max( [ result.max_error for result in results ] or [ 0.0 ] ),
+            sum(
+                result.mean_error * mesh.num_verts
+                for result, mesh in zip( results, self.meshes )
+                ) / max( num_verts, 1 )
+            )
+
+    def joint_bounds( self ):
+        """Returns the bounding box of the weight positions of each
+        joint, in the joint's space.
+
+        Joints that are not referenced by any weight have a box
+        of NaN values.
+
+        @return: an array with the shape (joints, 2, 3).
+        """
+        joints = numpy.concatenate( [ mesh.joints for mesh in self.meshes ] )
+        positions = numpy.concatenate( [ mesh.positions for mesh in self.meshes ] )
+
+        result = numpy.empty( (self.num_joints, 2, 3), dtype = 'float' )
+        result[:] = numpy.nan
+        if len( joints ) == 0:
+            return result
+
+        # sort the weights by joint and reduce each run
+        order = numpy.argsort( joints, kind = 'mergesort' )
+        joints = joints[ order ]
+        positions = positions[ order ]
+        starts = numpy.nonzero( numpy.diff( joints ) )[ 0 ] + 1
+        starts = numpy.concatenate( [ [ 0 ], starts ] )
+
+        used = joints[ starts ]
+        result[ used, 0 ] = numpy.minimum.reduceat( positions, starts, axis = 0 )
+        result[ used, 1 ] = numpy.maximum.reduceat( positions, starts, axis = 0 )
+        return result
+
     def mesh( self, index ):
         return self.meshes[ index ]
 
-    def load_from_buffer( self, buffer ):
+    def load_from_buffer( self, buffer, meshes = None ):
         """Reads the MD5 data from a stream object.
 
         Can be called instead of load() if data
         is not present in a file.
 
+        Only a subset of the mesh blocks can be loaded by passing
+        a list of mesh indices and / or shader names.
+        Other mesh blocks are skipped without being parsed.
+        The original index of each loaded mesh is stored in
+        'mesh_indices'.
+
         @param f: the stream object, usually a file.
+        @param meshes: a list of mesh indices and shader names
+        to load. If None, all meshes are loaded.
         """
         statements = process_md5_buffer( buffer )
 
         try:
-            self._process_buffer( statements )
+            self._process_buffer( statements, meshes )
         except Exception as e:
             # clear our data
             self.md5_version = None
             self.joints = None
             self.meshes = None
+            self.mesh_indices = None
             raise
 
-    def _process_buffer( self, buffer ):
+    def _process_buffer( self, buffer, meshes = None ):
         """Processes the MD5 Mesh file from the specified buffer.
         """
         # Processes the MD5 Mesh header.
@@ -506,7 +853,17 @@ class MD5_Mesh( MD5 ):
 
         # process meshes
         # each mesh is processed individually
-        self.meshes = [
-            MD5_SubMesh( buffer )
-            for num in range( num_meshes )
-            ]
+        if meshes is not None:
+            meshes = set( meshes )
+
+        self.meshes = []
+        self.mesh_indices = []
+        for index in range( num_meshes ):
+            parse_to( buffer, 'mesh' )
+            shader = MD5_SubMesh.read_shader( buffer )
+
+            if meshes is None or index in meshes or shader in meshes:
+                self.meshes.append( MD5_SubMesh( buffer, False, shader ) )
+                self.mesh_indices.append( index )
+            else:
+                skip_block( buffer )
@@ -0,0 +1,175 @@
+"""Provides joint lookup and traversal structures for the
+joint hierarchies of MD5 Mesh and MD5 Anim files.
+"""
+
+import weakref
+
+import numpy
+
+from common import quaternion_multiply, quaternion_normalise, quaternion_rotate
+
+
+class MD5_Skeleton( object ):
+    """Index structure over a joint hierarchy.
+
+    Built once from the joint names and parent indices of an
+    MD5_Joints or MD5_Hierarchy object.
+
+    Provides:
+    indices         name -> joint index dictionary.
+    parents         parent joint index array, -1 for root joints.
+    child_offsets   CSR offsets of each joint's children.
+    children        CSR child joint indices, sorted by parent.
+    depths          depth of each joint, roots have a depth of 0.
+    order           joint indices in topological order, parents
+                    always preceed their children.
+    levels          list of joint index arrays, one per depth.
+    """
+
+    def __init__( self, names, parents ):
+        super( MD5_Skeleton, self ).__init__()
+
+        self.names = list( names )
+        self.parents = numpy.array( parents, dtype = 'int' )
+        self.indices = dict(
+            (name, index) for index, name in enumerate( self.names )
+            )
+
+        num_joints = len( self.names )
+
+        # calculate the depth of each joint by walking
+        # all joints up the hierarchy at once
+        self.depths = numpy.zeros( num_joints, dtype = 'int' )
+        ancestors = self.parents.copy()
+        while True:
+            valid = ancestors >= 0
+            if not valid.any():
+                break
+            self.depths[ valid ] += 1
+            if self.depths.max() > num_joints:
+                raise ValueError( "Joint hierarchy contains a cycle" )
+            ancestors[ valid ] = self.parents[ ancestors[ valid ] ]
+
+        # a stable sort by depth gives a topological order
+        self.order = numpy.argsort( self.depths, kind = 'mergesort' )
+        boundaries = numpy.searchsorted(
+            self.depths[ self.order ],
+            numpy.arange( 1, self.depths.max() + 1 if num_joints else 1 )
+            )
+        self.levels = numpy.split( self.order, boundaries )
+
+        # store the children of each joint in CSR format
+        non_roots = numpy.nonzero( self.parents >= 0 )[ 0 ]
+        self.children = non_roots[
+            numpy.argsort( self.parents[ non_roots ], kind = 'mergesort' )
+            ]
+        counts = numpy.bincount( self.parents[ non_roots ], minlength = num_joints )
+        self.child_offsets = numpy.zeros( num_joints + 1, dtype = 'int' )
+        numpy.cumsum( counts, out = self.child_offsets[ 1: ] )
+
+        self.roots = numpy.nonzero( self.parents < 0 )[ 0 ]
+
+        # joint remappings to other skeletons
+        self._remaps = weakref.WeakKeyDictionary()
+
+    @property
+    def num_joints( self ):
+        return len( self.names )
+
+    def index( self, name ):
+        """Returns the index of the joint with the specified name.
+
+        Raises a KeyError if no joint has the name.
+        """
+        return self.indices[ name ]
+
+    def _as_index( self, joint ):
+        if isinstance( joint, basestring ):
+            return self.indices[ joint ]
+        return joint
+
+    def children_of( self, joint ):
+        """Returns the indices of the direct children of a joint.
+
+        The joint can be specified by index or name.
+        """
+        index = self._as_index( joint )
+        return self.children[
+            self.child_offsets[ index ] : self.child_offsets[ index + 1 ]
+            ]
+
+    def subtree_mask( self, joints ):
+        """Returns a boolean mask that is True for the specified
+        joints and all of their descendants.
+
+        Joints can be specified by index or name, or a list of either.
+        """
+        if isinstance( joints, (basestring, int, numpy.integer) ):
+            joints = [ joints ]
+
+        mask = numpy.zeros( self.num_joints, dtype = 'bool' )
+        mask[ [ self._as_index( joint ) for joint in joints ] ] = True
+
+        # propagate down the hierarchy one level at a time
+        for level in self.levels[ 1: ]:
+            mask[ level ] |= mask[ self.parents[ level ] ]
+        return mask
+
+    def subtree( self, joints ):
+        """Returns the indices of the specified joints and their
+        descendants in topological order.
+        """
+        mask = self.subtree_mask( joints )
+        return self.order[ mask[ self.order ] ]
+
+    def remap( self, skeleton ):
+        """Returns an array that maps each joint of this skeleton
+        to the joint of the same name in the specified skeleton.
+
+        Joints that are not present in the other skeleton are -1.
+
+        The result is cached, so mapping a mesh to an animation
+        is only calculated once.
+        """
+        result = self._remaps.get( skeleton )
+        if result is None:
+            result = numpy.array(
+                [ skeleton.indices.get( name, -1 ) for name in self.names ],
+                dtype = 'int'
+                )
+            self._remaps[ skeleton ] = result
+        return result
+
+    def to_model( self, positions, orientations ):
+        """Converts joint local positions and orientations into
+        model space.
+
+        The arrays have the shapes (..., joints, 3) and
+        (..., joints, 4) and any number of leading dimensions
+        can be used to evaluate a batch of poses at once.
+
+        Each depth level of the hierarchy is evaluated in
+        a single vectorized step.
+
+        Returns a tuple of the model space positions and orientations.
+        """
+        positions = numpy.array( positions, dtype = 'float' )
+        orientations = numpy.array( orientations, dtype = 'float' )
+
+        for level in self.levels[ 1: ]:
+            parents = self.parents[ level ]
+            parent_positions = positions[ ..., parents, : ]
+            parent_orientations = orientations[ ..., parents, : ]
+
+            positions[ ..., level, : ] = parent_positions + quaternion_rotate(
+                parent_orientations,
+                positions[ ..., level, : ]
+                )
+            orientations[ ..., level, : ] = quaternion_normalise(
+                quaternion_multiply(
+                    parent_orientations,
+                    orientations[ ..., level, : ]
+                    )
+                )
+
+        return positions, orientations
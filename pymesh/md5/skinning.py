@@ -0,0 +1,269 @@
+"""Calculates skinned vertex positions of MD5 Meshes.
+
+MD5 vertices are not stored directly. Each vertex references a
+range of weights and each weight stores a position relative to
+a joint and a bias.
+
+MD5_Skin gathers the weights of every vertex into padded arrays
+once, which are then used by both skinning modes.
+
+Linear skinning transforms each weight position by its joint
+and sums the results by bias. This is the method described
+by the MD5 format, but like any linear blend it collapses
+volume around twisting joints.
+
+Dual quaternion skinning blends the joint transforms as dual
+quaternions and applies the result to the bind pose vertex,
+which preserves volume.
+"""
+
+import numpy
+
+from common import quaternion_conjugate, quaternion_multiply, quaternion_rotate
+
+
+class MD5_Skin( object ):
+    """Skins the vertices of all sub-meshes of an MD5_Mesh.
+
+    Vertices of all sub-meshes are stored consecutively.
+    The vertices of sub-mesh 'n' are in the range
+    vertex_offsets[ n ] : vertex_offsets[ n + 1 ].
+
+    Poses are passed as model space joint positions and
+    orientations in the order of the mesh's joints, with the
+    shapes (..., joints, 3) and (..., joints, 4).
+    Any leading dimensions are treated as a batch of poses.
+    See MD5_Anim.model_poses and MD5_Skeleton.remap.
+    """
+
+    modes = ( 'linear', 'dual_quaternion' )
+
+    def __init__( self, mesh, mode = 'linear' ):
+        super( MD5_Skin, self ).__init__()
+
+        if mode not in MD5_Skin.modes:
+            raise ValueError( "Unknown skinning mode '%s'" % mode )
+
+        self.mode = mode
+
+        counts = [ submesh.num_verts for submesh in mesh.meshes ]
+        self.vertex_offsets = numpy.zeros( len( counts ) + 1, dtype = 'int' )
+        numpy.cumsum( counts, out = self.vertex_offsets[ 1: ] )
+
+        max_influences = max(
+            [ submesh.weight_counts.max() for submesh in mesh.meshes if submesh.num_verts ] or [ 0 ]
+            )
+        num_verts = self.vertex_offsets[ -1 ]
+
+        # padded per-vertex weight data
+        # unused influences have a bias of 0
+        self.joint_indices = numpy.zeros( (num_verts, max_influences), dtype = 'int' )
+        self.biases = numpy.zeros( (num_verts, max_influences), dtype = 'float' )
+        self.weight_positions = numpy.zeros( (num_verts, max_influences, 3), dtype = 'float' )
+
+        influences = numpy.arange( max_influences )
+        for submesh, start, end in zip( mesh.meshes, self.vertex_offsets[ :-1 ], self.vertex_offsets[ 1: ] ):
+            if submesh.num_verts == 0:
+                continue
+
+            used = influences < submesh.weight_counts[ :, numpy.newaxis ]
+            weights = submesh.start_weights[ :, numpy.newaxis ] + influences
+            weights = weights[ used ]
+
+            self.joint_indices[ start:end ][ used ] = submesh.joints[ weights ]
+            self.biases[ start:end ][ used ] = submesh.biases[ weights ]
+            self.weight_positions[ start:end ][ used ] = submesh.positions[ weights ]
+
+        # the inverse bind pose, used to move bind pose
+        # vertices into joint space
+        joints = mesh.joints
+        self.bind_positions = numpy.array( joints.positions, dtype = 'float' )
+        self.bind_orientations = numpy.array( joints.orientations, dtype = 'float' )
+        self.inverse_bind_orientations = quaternion_conjugate( self.bind_orientations )
+        self.inverse_bind_positions = -quaternion_rotate(
+            self.inverse_bind_orientations,
+            self.bind_positions
+            )
+
+        # the vertices in the bind pose
+        self.vertices = self._skin_linear( self.bind_positions, self.bind_orientations )
+
+    @property
+    def num_verts( self ):
+        return self.vertex_offsets[ -1 ]
+
+    @property
+    def max_influences( self ):
+        return self.joint_indices.shape[ 1 ]
+
+    def submesh_vertices( self, vertices, index ):
+        """Returns the vertices of the specified sub-mesh from
+        an array of skinned vertices.
+        """
+        return vertices[ ..., self.vertex_offsets[ index ] : self.vertex_offsets[ index + 1 ], : ]
+
+    def skin( self, positions, orientations, mode = None ):
+        """Returns the skinned vertices for the specified poses.
+
+        @param positions: model space joint positions (..., joints, 3).
+        @param orientations: model space joint orientations (..., joints, 4).
+        @param mode: 'linear' or 'dual_quaternion', defaults to the
+        skin's mode.
+        @return: an array of vertices with the shape (..., vertices, 3).
+        """
+        mode = mode or self.mode
+        if mode == 'linear':
+            return self._skin_linear( positions, orientations )
+        elif mode == 'dual_quaternion':
+            return self._skin_dual_quaternion( positions, orientations )
+        raise ValueError( "Unknown skinning mode '%s'" % mode )
+
+    def _skin_linear( self, positions, orientations ):
+        positions = numpy.asarray( positions, dtype = 'float' )
+        orientations = numpy.asarray( orientations, dtype = 'float' )
+
+        # transform each weight's position by its joint
+        # (..., vertices, influences, 3)
+        weighted = positions[ ..., self.joint_indices, : ] + quaternion_rotate(
+            orientations[ ..., self.joint_indices, : ],
+            self.weight_positions
+            )
+        weighted *= self.biases[ ..., numpy.newaxis ]
+        return weighted.sum( axis = -2 )
+
+    def _skin_dual_quaternion( self, positions, orientations ):
+        positions = numpy.asarray( positions, dtype = 'float' )
+        orientations = numpy.asarray( orientations, dtype = 'float' )
+
+        # the transform from the bind pose to the current pose
+        # as a dual quaternion per joint
+        real = quaternion_multiply( orientations, self.inverse_bind_orientations )
+        translation = positions + quaternion_rotate( orientations, self.inverse_bind_positions )
+        pure = numpy.zeros( translation.shape[ :-1 ] + (4,), dtype = 'float' )
+        pure[ ..., :3 ] = translation
+        dual = 0.5 * quaternion_multiply( pure, real )
+
+        # gather the joints of each influence
+        # (..., vertices, influences, 4)
+        real = real[ ..., self.joint_indices, : ]
+        dual = dual[ ..., self.joint_indices, : ]
+
+        # keep every influence in the same hemisphere as the first
+        biases = self.biases * numpy.ones( real.shape[ :-1 ] )
+        signs = numpy.sum( real * real[ ..., :1, : ], axis = -1 )
+        biases = numpy.where( signs < 0.0, -biases, biases )[ ..., numpy.newaxis ]
+
+        real = numpy.sum( real * biases, axis = -2 )
+        dual = numpy.sum( dual * biases, axis = -2 )
+
+        length = numpy.sqrt( numpy.sum( real * real, axis = -1 ) )[ ..., numpy.newaxis ]
+        real /= length
+        dual /= length
+
+        # apply the blended transform to the bind pose vertices
+        real_xyz, real_w = real[ ..., :3 ], real[ ..., 3: ]
+        dual_xyz, dual_w = dual[ ..., :3 ], dual[ ..., 3: ]
+        translation = 2.0 * (
+            real_w * dual_xyz - dual_w * real_xyz + numpy.cross( real_xyz, dual_xyz )
+            )
+        return quaternion_rotate( real, self.vertices ) + translation
+
+
+class MD5_Palette( object ):
+    """Fills skinning matrix palettes for many instances of
+    an MD5 Mesh.
+
+    Each palette matrix is the animated model space transform of
+    a joint multiplied by the inverse of its bind pose transform.
+    Matrices have the shape (3, 4), where the last column is
+    the translation.
+
+    All temporary arrays are allocated up front for 'max_instances',
+    so filling a palette does not allocate any arrays.
+
+    For example:
+
+        palette = MD5_Palette( mesh.joints, 256 )
+        matrices = numpy.empty( (256, mesh.num_joints, 3, 4) )
+        ...
+        palette.fill( positions, orientations, matrices )
+    """
+
+    def __init__( self, joints, max_instances ):
+        """
+        @param joints: the MD5_Joints of the mesh.
+        @param max_instances: the largest number of instances
+        passed to fill.
+        """
+        super( MD5_Palette, self ).__init__()
+
+        self.inverse_bind_matrices = joints.inverse_bind_matrices
+        self.max_instances = max_instances
+
+        num_joints = joints.num_joints
+        self._products = numpy.empty( (9, max_instances, num_joints), dtype = 'float' )
+        self._rotations = numpy.empty( (max_instances, num_joints, 3, 3), dtype = 'float' )
+
+    @property
+    def num_joints( self ):
+        return len( self.inverse_bind_matrices )
+
+    def fill( self, positions, orientations, out ):
+        """Fills the palettes of a number of instances.
+
+        @param positions: model space joint positions with the
+        shape (instances, joints, 3).
+        @param orientations: model space joint orientations with the
+        shape (instances, joints, 4).
+        @param out: the array to fill, with the shape
+        (instances, joints, 3, 4) or larger in the first dimension.
+        Only the first 'instances' palettes are written.
+        @return: 'out'.
+        """
+        num_instances = len( positions )
+        if num_instances > self.max_instances:
+            raise ValueError(
+                "Palette supports '%i' instances, received '%i'" % (
+                    self.max_instances,
+                    num_instances
+                    )
+                )
+        if out.shape[ 1: ] != (self.num_joints, 3, 4) or len( out ) < num_instances:
+            raise ValueError( "Palette output array has the wrong shape" )
+
+        x = orientations[ ..., 0 ]
+        y = orientations[ ..., 1 ]
+        z = orientations[ ..., 2 ]
+        w = orientations[ ..., 3 ]
+
+        xx, yy, zz, xy, xz, yz, xw, yw, zw = self._products[ :, :num_instances ]
+        numpy.multiply( x, x, out = xx )
+        numpy.multiply( y, y, out = yy )
+        numpy.multiply( z, z, out = zz )
+        numpy.multiply( x, y, out = xy )
+        numpy.multiply( x, z, out = xz )
+        numpy.multiply( y, z, out = yz )
+        numpy.multiply( x, w, out = xw )
+        numpy.multiply( y, w, out = yw )
+        numpy.multiply( z, w, out = zw )
+
+        # rotation matrices of the animated joints
+        rotations = self._rotations[ :num_instances ]
+        numpy.add( yy, zz, out = rotations[ ..., 0, 0 ] )
+        numpy.subtract( xy, zw, out = rotations[ ..., 0, 1 ] )
+        numpy.add( xz, yw, out = rotations[ ..., 0, 2 ] )
+        numpy.add( xy, zw, out = rotations[ ..., 1, 0 ] )
+        numpy.add( xx, zz, out = rotations[ ..., 1, 1 ] )
+        numpy.subtract( yz, xw, out = rotations[ ..., 1, 2 ] )
+        numpy.subtract( xz, yw, out = rotations[ ..., 2, 0 ] )
+        numpy.add( yz, xw, out = rotations[ ..., 2, 1 ] )
+        numpy.add( xx, yy, out = rotations[ ..., 2, 2 ] )
+        rotations *= 2.0
+        for index in range( 3 ):
+            numpy.subtract( 1.0, rotations[ ..., index, index ], out = rotations[ ..., index, index ] )
+
+        # [ R | t ] * [ Ri | ti ] = [ R * Ri | R * ti + t ]
+        palettes = out[ :num_instances ]
+        numpy.einsum( 'ijab,jbc->ijac', rotations, self.inverse_bind_matrices, out = palettes )
+        palettes[ ..., 3 ] += positions
+        return out
@@ -12,21 +12,31 @@ http://paulbourke.net/dataformats/mtl/
 http://people.sc.fsu.edu/~jburkardt/data/mtl/mtl.html
 
 
-Future optimisations:
-Merge groups with the same:
-    name, groups, material, texture and smoothing group
-I attempted this by using a dictionary with the above values as a tuple for
-the key, but this slowed down loading massively.
-Ironically it didn't slow down loading in this file, but my conversion
-to OpenGL. No idea how.
+Sub-meshes with the same name, groups, material, texture and smoothing
+group can be merged after loading with merge_meshes, which reduces the
+number of draw calls:
+    obj.model.meshes = merge_meshes( obj.model.meshes )
+Merging is a separate pass over the polygon arrays rather than
+part of parsing, which keeps loading fast.
 """
 
 import os
 from string import Template
 import Queue
 
+from common import process_obj_buffer
 from mesh import OBJ_Mesh
 from material import OBJ_Material
+from polygons import OBJ_Polygons
+from triangulate import triangulate
+from indexing import index_buffer
+from merge import merge_meshes
+from weld import weld_vertices, weld_mesh, weld_merging_groups
+from normals import corner_normals, generate_normals
+from simplify import simplify, lod_chain
+from parallel import load_parallel
+from reader import read_obj_file, read_obj_data, scan_obj_file, iter_obj_file
+from cache import load_cache, save_cache
 
 
 class BufferStack( object ):
@@ -112,8 +122,11 @@ class ArgumentBufferStack( BufferStack ):
         line = super( ArgumentBufferStack, self ).readline()
 
         # perform argument replacement
-        template = Template( line )
-        line = template.substitute( self.args )
+        # most lines have no arguments, so avoid the
+        # cost of the template
+        if '$' in line:
+            template = Template( line )
+            line = template.substitute( self.args )
 
         return line
 
@@ -121,7 +134,7 @@ class ArgumentBufferStack( BufferStack ):
         """Pushes the args as the current buffer's arguement list.
         """
         if self.args:
-            self.args_stack.push( self.args )
+            self.args_stack.put( self.args )
         # convert our arguments to a dictionary
         dict_args = {}
         for num, arg in zip( range(len(args)), args ):
@@ -130,65 +143,6 @@ class ArgumentBufferStack( BufferStack ):
         self.args = dict_args
 
 
-
-
-
-
-
-def process_obj_buffer( buffer ):
-    """Generator that processes a buffer and returns
-    complete OBJ statements.
-
-    Empty lines will be ignored.
-    Comments will be ignored.
-    Multi-line statements will be concatenated to a single line.
-    Start and end whitespace will be stripped.
-    """
-
-    def obj_line( buffer ):
-        """Generator that returns valid OBJ statements.
-
-        Removes comments, whitespace and concatenates multi-line
-        statements.
-        """
-        while True:
-            line = buffer.readline()
-
-            # check if we've hit the end
-            # EOF is signified by ''
-            # whereas an empty line is '\n'
-            if line == '':
-                break
-
-            # remove any whitespace
-            line = line.strip()
-
-            if line.startswith( '#' ):
-                continue
-
-            if len( line ) <= 0:
-                continue
-
-            yield line
-
-    # use our generator to remove comments and empty lines
-    gen = obj_line( buffer )
-
-    # iterate through each valid line of the OBJ file
-    # and yield full statements
-    for line in gen:
-        # concatenate lines until we get a full statement
-        while line.endswith( '\\' ):
-            try:
-                # remove the \ token
-                # add some white space
-                line = line[:-1].strip() + ' ' + gen.next()
-            except:
-                raise EOFError( 'Line had a continuation but no following line to concatenate with' )
-
-        yield line
-
-
 class OBJ( object ):
     """
     Loads a Wavefront OBJ formatted mesh.
@@ -226,21 +180,53 @@ class OBJ( object ):
         self.textures = set([])
         self.materials = set([])
 
-    def load( self, filename, ignore_smoothing_groups = True ):
+        # the files the OBJ was loaded from
+        self._files = []
+
+    def load(
+        self,
+        filename,
+        ignore_smoothing_groups = True,
+        workers = None,
+        preallocate = False,
+        cache = None
+        ):
         """
         Reads the OBJ data from the existing
         specified filename.
 
         @param filename: the filename of the OBJ file
         to load.
+        @param workers: the number of processes used to parse the
+        main model. If None, the file is parsed sequentially.
+        If 0, the number of CPUs is used.
+        Files with 'call' statements are always parsed sequentially.
+        @param preallocate: if True, files are read in two passes.
+        The first pass counts the data so the second pass can fill
+        exact size arrays, which keeps the memory used while loading
+        predictable. The polygons of each sub-mesh are slices of
+        shared arrays.
+        @param cache: if set, the parsed result is cached in a binary
+        file that is loaded instead of the OBJ file while the OBJ file
+        and the files it references are unchanged.
+        If True, the cache is stored next to the OBJ file,
+        otherwise this is the directory to store the cache in.
+        If the cache can't be written the file is loaded without it.
         """
+        if cache and load_cache( self, filename, cache, ignore_smoothing_groups ):
+            return
 
         # extract the path of the original filename
         path = os.path.dirname( filename )
 
-        with open( filename, 'r' ) as f:
+        self._files = [ filename ]
+        self.model = None
+        if workers is not None:
+            self.model = load_parallel( filename, workers, ignore_smoothing_groups )
+
+        if self.model is None:
             # process the main model
-            self.model = self._parse_obj_mesh( f, path )
+            self.model = self._read_obj_mesh( filename, path, ignore_smoothing_groups, preallocate )
 
         # process any shadow objects
         self.shadow = None
@@ -248,8 +234,8 @@ class OBJ( object ):
             # convert any further filenames to be relative to the file
             shadow = os.path.join( path, self.model.shadow )
 
-            with open( shadow, 'r' ) as f:
-                self.shadow = self._parse_obj_mesh( f, path )
+            self._files.append( shadow )
+            self.shadow = self._read_obj_mesh( shadow, path, ignore_smoothing_groups, preallocate )
 
         # process any trace objects
         self.trace = None
@@ -257,15 +243,73 @@ class OBJ( object ):
             # convert any further filenames to be relative to the file
             trace = os.path.join( path, self.model.trace )
 
-            with open( trace, 'r' ) as f:
-                self.trace = self._parse_obj_mesh( f, path )
+            self._files.append( trace )
+            self.trace = self._read_obj_mesh( trace, path, ignore_smoothing_groups, preallocate )
+
+        # weld the vertices of any merging groups
+        for mesh in [ self.model, self.shadow, self.trace ]:
+            if mesh is not None and mesh.merging_groups:
+                weld_merging_groups( mesh )
 
-        # process any materials
+        self._load_materials( path )
+
+        if cache:
+            save_cache( self, filename, cache, ignore_smoothing_groups )
+
+    def iter_meshes( self, filename, ignore_smoothing_groups = True, release = False ):
+        """Reads an OBJ file and yields each sub-mesh as soon
+        as it is complete.
+
+        The file is read in chunks. Sub-meshes are yielded when a
+        statement begins a new sub-mesh, which lets the caller
+        process large files before they are fully loaded.
+        The sub-mesh's polygons refer to the vertex data of
+        self.model, which grows as the file is read.
+        Materials are loaded once every sub-mesh has been yielded.
+        Shadow and trace objects are not loaded and merging groups
+        are not welded.
+
+        Files with 'call' statements are loaded completely before
+        any sub-meshes are yielded.
+
+        For example:
+
+            obj = OBJ()
+            for mesh in obj.iter_meshes( 'large.obj', release = True ):
+                convert( mesh[ 'faces' ], obj.model.vertices )
+
+        @param filename: the filename of the OBJ file to load.
+        @param release: if True, the points, lines and faces of each
+        sub-mesh are released once the caller has processed it,
+        which keeps the memory used bounded.
+        """
+        path = os.path.dirname( filename )
+
+        self._files = [ filename ]
+        self.model = OBJ_Mesh( ignore_smoothing_groups )
+        self.shadow = None
+        self.trace = None
+
+        meshes = iter_obj_file( filename, self.model, release )
+        if meshes is None:
+            with open( filename, 'r' ) as f:
+                self.model = self._parse_obj_mesh( f, path, ignore_smoothing_groups )
+            meshes = iter( self.model.meshes )
+
+        for mesh in meshes:
+            yield mesh
+
+        self._load_materials( path )
+
+    def _load_materials( self, path ):
+        """Loads the material files of the model.
+        """
         self.textures = set([])
         self.materials = set([])
         for material_path in self.model.materials:
             # convert any further filenames to be relative to the file
             material_path = os.path.join( path, material_path )
+            self._files.append( material_path )
 
             with open( material_path, 'r' ) as f:
                 material = self._parse_obj_material( f )
@@ -275,6 +319,20 @@ class OBJ( object ):
             # add the textures to our list of textures
             self.textures.update( material.textures )
 
+    def _read_obj_mesh( self, filename, path, ignore_smoothing_groups = True, preallocate = False ):
+        """Reads an OBJ file with the memory mapped reader.
+
+        Files with 'call' statements are read through a buffer stack.
+        """
+        data = OBJ_Mesh( ignore_smoothing_groups )
+        if read_obj_file( filename, data, preallocate ):
+            # zero the current mesh
+            data._current_mesh = None
+            return data
+
+        with open( filename, 'r' ) as f:
+            return self._parse_obj_mesh( f, path, ignore_smoothing_groups )
+
     def _parse_obj_mesh( self, buffer, path, ignore_smoothing_groups = True ):
         # we will store our values as a property of this method
         # this lets the inner functions access them
@@ -292,24 +350,17 @@ class OBJ( object ):
 
         # process the file
         for line in statements:
-            # tokenize based on space
+            # get the first word
+            # this is the statement type
             # there are some statements with 0 parameters
             # such as  'g'
             # so we need to extract the specific values later
-            values = line.split()
-
-            # get the first word
-            # this is the statement type
-            type = values[ 0 ]
-            if len(values) > 1:
-                values = values[ 1: ]
-            else:
-                # no values, so empty our arg list
-                values = []
+            type = line.split( None, 1 )[ 0 ]
 
             # check if the statement is a 'call' statement
             # we need to handle this ourselves
             if type == 'call':
+                values = line.split()[ 1: ]
                 filename = values[ 0 ]
                 args = []
 
@@ -322,8 +373,9 @@ class OBJ( object ):
 
                 # open it as a file and push into our read buffer
                 f = open( filename, 'r' )
-                statements.push( f )
-                statements.push_args( args )
+                buffers.push( f )
+                buffers.push_args( args )
+                self._files.append( filename )
 
                 # iterate again
                 continue
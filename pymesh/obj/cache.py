@@ -0,0 +1,419 @@
+"""Caches parsed OBJ files in a binary format.
+
+Parsing an OBJ file is slow compared to reading the resulting arrays.
+The parsed model, shadow and trace meshes and materials are written
+to a cache file, which is memory mapped when it is loaded again.
+
+The cache file is either stored next to the OBJ file, with a
+'.cache' extension, or in a cache directory, named by a hash of
+the OBJ file's path.
+
+The cache records the size, modification time and SHA1 hash of
+every file the result was loaded from, including files referenced
+by 'call', 'mtllib', 'shadow_obj' and 'trace_obj' statements.
+A cache is used if every file has the same size and either the same
+modification time or the same content hash. Files are only hashed
+when their modification time has changed.
+
+File layout:
+    magic           16 bytes
+    version         uint32
+    header size     uint32
+    header          JSON, padded to 'alignment' bytes
+    arrays          raw array data, each aligned to 'alignment' bytes
+
+For example:
+
+    obj = OBJ()
+    # the first load parses the file and writes 'model.obj.cache'
+    obj.load( 'model.obj', cache = True )
+
+    # or store cache files in a directory
+    obj.load( 'model.obj', cache = '/var/cache/models' )
+"""
+
+import hashlib
+import json
+import mmap
+import os
+import struct
+import tempfile
+
+import numpy
+
+from mesh import OBJ_Mesh
+from material import OBJ_Material
+from polygons import OBJ_Polygons
+
+
+magic = 'PYMESH-OBJ-CACH\0'
+
+# increment when the layout of the cache changes
+version = 3
+
+# the alignment of the header and each array in bytes
+alignment = 64
+
+_prefix = struct.Struct( '<16sII' )
+
+_polygon_keys = [ 'points', 'lines', 'faces' ]
+_state_keys = OBJ_Mesh.state_keys
+
+
+def cache_filename( filename, cache = True ):
+    """Returns the cache filename for an OBJ file.
+
+    @param cache: True to store the cache next to the OBJ file,
+    or the directory to store the cache in.
+    """
+    if cache is True:
+        return filename + '.cache'
+
+    path = os.path.abspath( filename )
+    name = hashlib.sha1( path ).hexdigest()
+    return os.path.join( cache, '%s-%s.cache' % (os.path.basename( filename ), name) )
+
+
+def file_hash( filename ):
+    """Returns the SHA1 hash of a file's contents.
+    """
+    sha1 = hashlib.sha1()
+    with open( filename, 'rb' ) as f:
+        while True:
+            block = f.read( 1024 * 1024 )
+            if not block:
+                break
+            sha1.update( block )
+    return sha1.hexdigest()
+
+
+def _dependency( filename ):
+    stat = os.stat( filename )
+    return {
+        'path':     os.path.abspath( filename ),
+        'size':     stat.st_size,
+        'mtime':    stat.st_mtime,
+        'sha1':     file_hash( filename ),
+        }
+
+
+def _dependency_valid( dependency ):
+    try:
+        stat = os.stat( dependency[ 'path' ] )
+    except OSError:
+        return False
+
+    if stat.st_size != dependency[ 'size' ]:
+        return False
+    if stat.st_mtime == dependency[ 'mtime' ]:
+        return True
+
+    # the file was touched, check if the contents changed
+    return file_hash( dependency[ 'path' ] ) == dependency[ 'sha1' ]
+
+
+def _decode( value ):
+    """Converts the unicode strings returned by json into str.
+    """
+    if isinstance( value, unicode ):
+        return value.encode( 'utf-8' )
+    if isinstance( value, list ):
+        return [ _decode( item ) for item in value ]
+    if isinstance( value, dict ):
+        return dict( (_decode( key ), _decode( item )) for key, item in value.items() )
+    return value
+
+
+def _file_mode():
+    """Returns the permissions of a new file.
+    """
+    umask = os.umask( 0 )
+    os.umask( umask )
+    return 0o666 & ~umask
+
+
+def _align( offset ):
+    return (offset + alignment - 1) // alignment * alignment
+
+
+class _ArrayWriter( object ):
+    """Lays out arrays for the cache file.
+    """
+
+    def __init__( self ):
+        super( _ArrayWriter, self ).__init__()
+
+        self.arrays = []
+        self.size = 0
+
+    def add( self, array ):
+        array = numpy.ascontiguousarray( array )
+        offset = _align( self.size )
+        self.arrays.append( (offset, array) )
+        self.size = offset + array.nbytes
+        return {
+            'offset':   offset,
+            'dtype':    array.dtype.str,
+            'shape':    list( array.shape ),
+            }
+
+    def write( self, f, start ):
+        for offset, array in self.arrays:
+            f.seek( start + offset )
+            f.write( array.data )
+
+
+def _read_array( data, start, layout ):
+    shape = tuple( layout[ 'shape' ] )
+    dtype = numpy.dtype( layout[ 'dtype' ] )
+    count = int( numpy.prod( shape ) )
+    if count == 0:
+        return numpy.empty( shape, dtype = dtype )
+    return numpy.frombuffer(
+        data,
+        dtype = dtype,
+        count = count,
+        offset = start + layout[ 'offset' ]
+        ).reshape( shape )
+
+
+def _array_end( layout ):
+    """Returns the end of an array, relative to the array section.
+    """
+    count = int( numpy.prod( layout[ 'shape' ] ) )
+    return layout[ 'offset' ] + count * numpy.dtype( layout[ 'dtype' ] ).itemsize
+
+
+def _mesh_layouts( header ):
+    """Returns the layouts of the arrays of a stored OBJ_Mesh.
+    """
+    if header is None:
+        return []
+
+    layouts = [ header[ key ] for key in [ 'vertices', 'texture_coords', 'normals', 'mesh_states' ] ]
+    for key in _polygon_keys:
+        layouts.extend( header[ key ][ name ] for name in [ 'corners', 'counts', 'offsets' ] )
+    return layouts
+
+
+def _mesh_header( mesh, arrays ):
+    """Stores an OBJ_Mesh in the cache.
+
+    The polygons of all sub-meshes are concatenated, with the
+    offsets of each sub-mesh's corners and counts in a separate
+    array. Sub-mesh state is stored once per unique state.
+    """
+    if mesh is None:
+        return None
+
+    states = []
+    state_indices = {}
+    mesh_states = numpy.empty( len( mesh.meshes ), dtype = 'int32' )
+    for index, submesh in enumerate( mesh.meshes ):
+        state = [ submesh[ key ] for key in _state_keys ]
+        key = json.dumps( state )
+        if key not in state_indices:
+            state_indices[ key ] = len( states )
+            states.append( state )
+        mesh_states[ index ] = state_indices[ key ]
+
+    header = {
+        'vertices':         arrays.add( mesh.vertices ),
+        'texture_coords':   arrays.add( mesh.texture_coords ),
+        'normals':          arrays.add( mesh.normals ),
+        'names':            sorted( mesh.names ),
+        'groups':           sorted( mesh.groups ),
+        'materials':        sorted( mesh.materials ),
+        'textures':         sorted( mesh.textures ),
+        'shadow':           mesh.shadow,
+        'trace':            mesh.trace,
+        'merging_groups':   sorted( mesh.merging_groups.items() ),
+        'states':           states,
+        'mesh_states':      arrays.add( mesh_states ),
+        }
+
+    for key in _polygon_keys:
+        polygons = [ submesh[ key ] for submesh in mesh.meshes ]
+        offsets = numpy.zeros( (len( polygons ) + 1, 2), dtype = 'int64' )
+        offsets[ 1:, 0 ] = numpy.cumsum( [ len( values.corners ) for values in polygons ] )
+        offsets[ 1:, 1 ] = numpy.cumsum( [ len( values.counts ) for values in polygons ] )
+
+        corners = numpy.empty( (offsets[ -1, 0 ], 3), dtype = 'int32' )
+        counts = numpy.empty( offsets[ -1, 1 ], dtype = 'int64' )
+        for values, (corner_start, count_start), (corner_end, count_end) in zip(
+            polygons,
+            offsets[ :-1 ].tolist(),
+            offsets[ 1: ].tolist()
+            ):
+            corners[ corner_start : corner_end ] = values.corners
+            counts[ count_start : count_end ] = values.counts
+
+        header[ key ] = {
+            'corners':  arrays.add( corners ),
+            'counts':   arrays.add( counts ),
+            'offsets':  arrays.add( offsets ),
+            }
+    return header
+
+
+def _read_mesh( header, data, start, ignore_smoothing_groups ):
+    if header is None:
+        return None
+
+    mesh = OBJ_Mesh( ignore_smoothing_groups )
+    mesh._vertices = _read_array( data, start, header[ 'vertices' ] )
+    mesh._texture_coords = _read_array( data, start, header[ 'texture_coords' ] )
+    mesh._normals = _read_array( data, start, header[ 'normals' ] )
+    mesh.names = set( header[ 'names' ] )
+    mesh.groups = set( header[ 'groups' ] )
+    mesh.materials = set( header[ 'materials' ] )
+    mesh.textures = set( header[ 'textures' ] )
+    mesh.shadow = header[ 'shadow' ]
+    mesh.trace = header[ 'trace' ]
+    mesh.merging_groups = dict( header[ 'merging_groups' ] )
+
+    states = header[ 'states' ]
+    for index in _read_array( data, start, header[ 'mesh_states' ] ).tolist():
+        mesh.meshes.append( dict( zip( _state_keys, states[ index ] ) ) )
+
+    for key in _polygon_keys:
+        corners = _read_array( data, start, header[ key ][ 'corners' ] )
+        counts = _read_array( data, start, header[ key ][ 'counts' ] )
+        offsets = _read_array( data, start, header[ key ][ 'offsets' ] ).tolist()
+        for submesh, (corner_start, count_start), (corner_end, count_end) in zip(
+            mesh.meshes,
+            offsets[ :-1 ],
+            offsets[ 1: ]
+            ):
+            submesh[ key ] = OBJ_Polygons.from_arrays(
+                corners[ corner_start : corner_end ],
+                counts[ count_start : count_end ],
+                points = key == 'points'
+                )
+    return mesh
+
+
+def save_cache( obj, filename, cache = True, ignore_smoothing_groups = True ):
+    """Writes a loaded OBJ to a cache file.
+
+    @param obj: an OBJ object the file was loaded into.
+    @param filename: the OBJ file that was loaded.
+    @param cache: True to store the cache next to the OBJ file,
+    or the directory to store the cache in. The directory is
+    created if it doesn't exist.
+    @return: True if the cache was written, or False if it
+    couldn't be written.
+    """
+    arrays = _ArrayWriter()
+    header = {
+        'path':         os.path.abspath( filename ),
+        'ignore_smoothing_groups':  ignore_smoothing_groups,
+        'dependencies': [ _dependency( path ) for path in obj._files ],
+        'model':        _mesh_header( obj.model, arrays ),
+        'shadow':       _mesh_header( obj.shadow, arrays ),
+        'trace':        _mesh_header( obj.trace, arrays ),
+        'materials':    [
+            {
+                'materials':    material.materials,
+                'textures':     sorted( material.textures ),
+                }
+            for material in obj.materials
+            ],
+        }
+    header = json.dumps( header )
+    start = _align( _prefix.size + len( header ) )
+
+    # write to a temporary file so a partially written
+    # cache is never read
+    output = cache_filename( filename, cache )
+    directory = os.path.dirname( os.path.abspath( output ) )
+    try:
+        if not os.path.isdir( directory ):
+            os.makedirs( directory )
+        handle, temporary = tempfile.mkstemp( dir = directory )
+    except OSError:
+        # the cache is optional, so an unwritable
+        # directory doesn't stop the file loading
+        return False
+
+    try:
+        with os.fdopen( handle, 'wb' ) as f:
+            f.write( _prefix.pack( magic, version, len( header ) ) )
+            f.write( header )
+            arrays.write( f, start )
+            f.truncate( start + arrays.size )
+
+        # mkstemp only lets the current user read the file
+        os.chmod( temporary, _file_mode() )
+        if os.path.exists( output ):
+            os.remove( output )
+        os.rename( temporary, output )
+    except (IOError, OSError):
+        # such as a full disk
+        os.remove( temporary )
+        return False
+    except:
+        os.remove( temporary )
+        raise
+    return True
+
+
+def load_cache( obj, filename, cache = True, ignore_smoothing_groups = True ):
+    """Loads an OBJ from its cache file.
+
+    The arrays of the loaded meshes are memory mapped from the
+    cache file. Changes to the arrays are not written to the cache.
+
+    @param obj: the OBJ object to load the file into.
+    @param filename: the OBJ file to load.
+    @param cache: True if the cache is stored next to the OBJ file,
+    or the directory the cache is stored in.
+    @return: True if the cache was loaded, or False if the cache
+    doesn't exist, is out of date or is corrupt.
+    """
+    try:
+        f = open( cache_filename( filename, cache ), 'rb' )
+    except IOError:
+        return False
+
+    with f:
+        try:
+            file_magic, file_version, header_size = _prefix.unpack( f.read( _prefix.size ) )
+            if file_magic != magic or file_version != version:
+                return False
+            header = _decode( json.loads( f.read( header_size ) ) )
+        except (struct.error, ValueError):
+            # the cache is corrupt
+            return False
+
+        if \
+            header[ 'path' ] != os.path.abspath( filename ) or \
+            header[ 'ignore_smoothing_groups' ] != ignore_smoothing_groups or \
+            not all( _dependency_valid( dependency ) for dependency in header[ 'dependencies' ] ):
+            return False
+
+        # a private copy lets the arrays be modified
+        data = mmap.mmap( f.fileno(), 0, access = mmap.ACCESS_COPY )
+
+    start = _align( _prefix.size + header_size )
+    layouts = sum( [ _mesh_layouts( header[ key ] ) for key in [ 'model', 'shadow', 'trace' ] ], [] )
+    if any( start + _array_end( layout ) > len( data ) for layout in layouts ):
+        # the cache was truncated after the header
+        data.close()
+        return False
+
+    obj.model = _read_mesh( header[ 'model' ], data, start, ignore_smoothing_groups )
+    obj.shadow = _read_mesh( header[ 'shadow' ], data, start, ignore_smoothing_groups )
+    obj.trace = _read_mesh( header[ 'trace' ], data, start, ignore_smoothing_groups )
+
+    obj.materials = set([])
+    obj.textures = set([])
+    for values in header[ 'materials' ]:
+        material = OBJ_Material()
+        material.materials = values[ 'materials' ]
+        material.textures = set( values[ 'textures' ] )
+        obj.materials.add( material )
+        obj.textures.update( material.textures )
+
+    obj._files = [ dependency[ 'path' ] for dependency in header[ 'dependencies' ] ]
+    return True
@@ -1,5 +1,77 @@
 import re
 
+import numpy
+
+
+def count_tokens( text, num_lines ):
+    """Counts the whitespace separated tokens on each line of a
+    newline separated string.
+
+    @return: a tuple of the token count of each line and a boolean
+    array that is True for the first character of each token.
+    """
+    chars = numpy.frombuffer( text, dtype = 'uint8' )
+    spaces = chars <= ord( ' ' )
+    starts = ~spaces
+    starts[ 1: ] &= spaces[ :-1 ]
+    line_ids = numpy.cumsum( chars == ord( '\n' ) )
+    counts = numpy.bincount( line_ids[ starts ], minlength = num_lines )
+    return counts, starts
+
+
+def process_obj_buffer( buffer ):
+    """Generator that processes a buffer and returns
+    complete OBJ statements.
+
+    Empty lines will be ignored.
+    Comments will be ignored.
+    Multi-line statements will be concatenated to a single line.
+    Start and end whitespace will be stripped.
+    """
+
+    def obj_line( buffer ):
+        """Generator that returns valid OBJ statements.
+
+        Removes comments, whitespace and concatenates multi-line
+        statements.
+        """
+        while True:
+            line = buffer.readline()
+
+            # check if we've hit the end
+            # EOF is signified by ''
+            # whereas an empty line is '\n'
+            if line == '':
+                break
+
+            # remove any whitespace
+            line = line.strip()
+
+            if line.startswith( '#' ):
+                continue
+
+            if len( line ) <= 0:
+                continue
+
+            yield line
+
+    # use our generator to remove comments and empty lines
+    gen = obj_line( buffer )
+
+    # iterate through each valid line of the OBJ file
+    # and yield full statements
+    for line in gen:
+        # concatenate lines until we get a full statement
+        while line.endswith( '\\' ):
+            try:
+                # remove the \ token
+                # add some white space
+                line = line[:-1].strip() + ' ' + gen.next()
+            except:
+                raise EOFError( 'Line had a continuation but no following line to concatenate with' )
+
+        yield line
+
 
 class OBJ_Loader( object ):
 
@@ -33,14 +105,8 @@ class OBJ_Loader( object ):
         for malformed or unexpected data.
         """
         # get the statement type
-        values = statement.split()
-
-        type = values[ 0 ]
-        if len(values) > 1:
-            values = values[ 1: ]
-        else:
-            # no values, so empty our arg list
-            values = []
+        # the values are extracted by the parse functions
+        type = statement.split( None, 1 )[ 0 ]
 
         # check if we have a function that handles this type of value
         # all parse functions are named _parse_$ where $ is
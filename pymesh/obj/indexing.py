@@ -0,0 +1,149 @@
+"""Creates render ready vertex and index buffers from OBJ meshes.
+
+OBJ corners index vertices, texture coordinates and normals
+independently. Render APIs require a single index per unique
+combination of the three.
+
+Each (vertex, texture coord, normal) corner is packed into a single
+integer key, which lets numpy.unique find the unique combinations
+and the index of every corner in one step.
+
+For example:
+
+    buffer = index_buffer( obj.model )
+    for mesh, (start, count) in zip( obj.model.meshes, buffer.ranges ):
+        # draw buffer.indices[ start : start + count ]
+        # with buffer.vertices as the vertex data
+"""
+
+from collections import namedtuple
+
+import numpy
+
+from triangulate import triangulate
+
+
+index_layout = namedtuple(
+    'OBJ_IndexBuffer',
+    [
+        'vertices',
+        'indices',
+        'format',
+        'ranges'
+        ]
+    )
+"""
+vertices    Interleaved float32 vertex data with the shape (vertices, stride).
+indices     Triangle indices as a flat array of the smallest unsigned
+            integer type that can index all vertices.
+format      A list of (name, offset, size) tuples describing the
+            columns of the vertex data.
+            Names are 'position', 'texture_coord' and 'normal'.
+ranges      The (start, count) of each sub-mesh's indices.
+"""
+
+
+def index_dtype( num_vertices ):
+    """Returns the smallest unsigned integer type that can index
+    the specified number of vertices.
+    """
+    for dtype in [ 'uint8', 'uint16', 'uint32' ]:
+        if num_vertices <= numpy.iinfo( dtype ).max + 1:
+            return numpy.dtype( dtype )
+    return numpy.dtype( 'uint64' )
+
+
+def unique_corners( corners, sizes ):
+    """Finds the unique (vertex, texture coord, normal) combinations.
+
+    @param corners: an array of corners with the shape (N,3).
+    Missing indices are -1.
+    @param sizes: the number of vertices, texture coordinates
+    and normals.
+    @return: a tuple of the unique corners with the shape (U,3)
+    and the index of each corner's unique corner.
+    """
+    corners = numpy.asarray( corners, dtype = 'int64' )
+    if len( corners ) == 0:
+        return numpy.empty( (0, 3), dtype = corners.dtype ), numpy.empty( 0, dtype = 'int' )
+
+    # -1 becomes 0 so every value is positive
+    ranges = [ int( size ) + 1 for size in sizes ]
+    if ranges[ 0 ] * ranges[ 1 ] * ranges[ 2 ] >= 2 ** 63:
+        # too large to pack into a single integer
+        unique, inverse = numpy.unique( corners, axis = 0, return_inverse = True )
+        return unique, inverse
+
+    keys = (corners[ :, 0 ] + 1) * ranges[ 1 ]
+    keys += corners[ :, 1 ] + 1
+    keys *= ranges[ 2 ]
+    keys += corners[ :, 2 ] + 1
+
+    keys, first, inverse = numpy.unique( keys, return_index = True, return_inverse = True )
+    return corners[ first ], inverse
+
+
+def interleave( mesh, corners ):
+    """Creates interleaved vertex data for a set of unique corners.
+
+    Texture coordinates and normals are only included if the mesh
+    has them and at least one corner refers to them.
+    Corners without a texture coordinate or normal use zeros.
+
+    @param mesh: the OBJ_Mesh the corners refer to.
+    @param corners: the unique corners with the shape (U,3).
+    @return: a tuple of the float32 vertex data and the format list.
+    """
+    columns = [ ('position', mesh.vertices, 0) ]
+    if mesh.num_texture_coords and numpy.any( corners[ :, 1 ] >= 0 ):
+        columns.append( ('texture_coord', mesh.texture_coords, 1) )
+    if mesh.num_normals and numpy.any( corners[ :, 2 ] >= 0 ):
+        columns.append( ('normal', mesh.normals, 2) )
+
+    stride = sum( values.shape[ 1 ] for name, values, index in columns )
+    vertices = numpy.zeros( (len( corners ), stride), dtype = 'float32' )
+
+    format = []
+    offset = 0
+    for name, values, index in columns:
+        size = values.shape[ 1 ]
+        present = corners[ :, index ] >= 0
+        vertices[ present, offset : offset + size ] = values[ corners[ present, index ] ]
+        format.append( (name, offset, size) )
+        offset += size
+
+    return vertices, format
+
+
+def index_buffer( mesh, shared = True ):
+    """Creates vertex and index buffers for the faces of an OBJ mesh.
+
+    Faces are triangulated first.
+
+    @param mesh: an OBJ_Mesh.
+    @param shared: if True, a single buffer is created for all sub-meshes
+    and 'ranges' contains the indices of each sub-mesh.
+    If False, a list with a buffer per sub-mesh is returned.
+    @return: an index_layout or a list of index_layouts.
+    """
+    sizes = (mesh.num_vertices, mesh.num_texture_coords, mesh.num_normals)
+    triangles = [
+        triangulate( submesh[ 'faces' ], mesh.vertices )[ 0 ].reshape( -1, 3 )
+        for submesh in mesh.meshes
+        ]
+
+    def create( corners, counts ):
+        unique, inverse = unique_corners( corners, sizes )
+        vertices, format = interleave( mesh, unique )
+        indices = inverse.astype( index_dtype( len( unique ) ) )
+
+        ranges = numpy.zeros( (len( counts ), 2), dtype = 'int' )
+        ranges[ :, 1 ] = counts
+        ranges[ 1:, 0 ] = numpy.cumsum( counts )[ :-1 ]
+        return index_layout( vertices, indices, format, ranges )
+
+    if shared:
+        corners = numpy.concatenate( triangles ) if triangles else numpy.empty( (0, 3), dtype = 'int32' )
+        return create( corners, [ len( corners ) for corners in triangles ] )
+
+    return [ create( corners, [ len( corners ) ] ) for corners in triangles ]
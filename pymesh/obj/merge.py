@@ -0,0 +1,117 @@
+"""Merges OBJ sub-meshes that share the same state.
+
+OBJ files commonly switch between a few materials and groups many
+times, creating a sub-mesh for each switch. Sub-meshes with the same
+name, groups, smoothing group, material, texture, merging group and
+level of detail can be rendered together.
+
+Each state value is mapped to an integer and the values of a sub-mesh
+are packed into a single integer key. The sub-meshes are then ordered
+by key with a single stable argsort, so each merged sub-mesh's polygons
+are a contiguous range of a single concatenated array.
+
+For example:
+
+    obj.model.meshes = merge_meshes( obj.model.meshes )
+"""
+
+import numpy
+
+from mesh import OBJ_Mesh
+from polygons import OBJ_Polygons, convert_pending
+
+
+_state_keys = OBJ_Mesh.state_keys
+_polygon_keys = [ 'points', 'lines', 'faces' ]
+
+
+def state_keys( meshes ):
+    """Returns an integer key for the state of each sub-mesh.
+
+    Sub-meshes have the same key if they have the same name,
+    groups, smoothing group, material, texture, merging group and
+    level of detail.
+    """
+    if len( meshes ) == 0:
+        return numpy.empty( 0, dtype = 'int64' )
+
+    codes = numpy.empty( (len( meshes ), len( _state_keys )), dtype = 'int64' )
+    for column, key in enumerate( _state_keys ):
+        values = {}
+        for row, mesh in enumerate( meshes ):
+            value = mesh[ key ]
+            if isinstance( value, list ):
+                value = tuple( value )
+            codes[ row, column ] = values.setdefault( value, len( values ) )
+
+    # pack the codes into a single integer
+    ranges = codes.max( axis = 0 ) + 1
+    if numpy.prod( ranges.astype( 'float' ) ) >= 2 ** 63:
+        # too large to pack into a single integer
+        return numpy.unique( codes, axis = 0, return_inverse = True )[ 1 ]
+
+    keys = codes[ :, 0 ].copy()
+    for column in range( 1, len( _state_keys ) ):
+        keys *= ranges[ column ]
+        keys += codes[ :, column ]
+    return keys
+
+
+def merge_meshes( meshes ):
+    """Merges sub-meshes with the same state.
+
+    Merged sub-meshes are in the order of their first sub-mesh.
+    The polygons of a merged sub-mesh are in their original order.
+
+    @param meshes: a list of sub-mesh dictionaries, ie. OBJ_Mesh.meshes.
+    @return: a new list of sub-mesh dictionaries.
+    """
+    if len( meshes ) == 0:
+        return []
+
+    keys, first, inverse = numpy.unique(
+        state_keys( meshes ),
+        return_index = True,
+        return_inverse = True
+        )
+
+    # number the states in the order they first appear
+    rank = numpy.empty( len( first ), dtype = 'int64' )
+    rank[ numpy.argsort( first ) ] = numpy.arange( len( first ) )
+    states = rank[ inverse ]
+
+    order = numpy.argsort( states, kind = 'mergesort' )
+    # the first sub-mesh of each merged sub-mesh within 'order'
+    starts = numpy.searchsorted( states[ order ], numpy.arange( len( first ) + 1 ) )
+
+    merged = []
+    for index in order[ starts[ :-1 ] ].tolist():
+        mesh = dict( (key, meshes[ index ][ key ]) for key in _state_keys )
+        if isinstance( mesh[ 'groups' ], list ):
+            mesh[ 'groups' ] = list( mesh[ 'groups' ] )
+        merged.append( mesh )
+
+    for key in _polygon_keys:
+        polygons = [ meshes[ index ][ key ] for index in order.tolist() ]
+        convert_pending( polygons )
+        corner_arrays = [ values.corners for values in polygons ]
+        count_arrays = [ values.counts for values in polygons ]
+        corners = numpy.concatenate( corner_arrays )
+        counts = numpy.concatenate( count_arrays )
+
+        # the offsets of each merged sub-mesh's corners and counts
+        corner_offsets = numpy.zeros( len( polygons ) + 1, dtype = 'int64' )
+        corner_offsets[ 1: ] = numpy.cumsum( [ len( values ) for values in corner_arrays ] )
+        count_offsets = numpy.zeros( len( polygons ) + 1, dtype = 'int64' )
+        count_offsets[ 1: ] = numpy.cumsum( [ len( values ) for values in count_arrays ] )
+        corner_offsets = corner_offsets[ starts ].tolist()
+        count_offsets = count_offsets[ starts ].tolist()
+
+        for index, mesh in enumerate( merged ):
+            mesh[ key ] = OBJ_Polygons.from_arrays(
+                corners[ corner_offsets[ index ] : corner_offsets[ index + 1 ] ],
+                counts[ count_offsets[ index ] : count_offsets[ index + 1 ] ],
+                points = key == 'points'
+                )
+
+    return merged
@@ -1,4 +1,92 @@
-from common import OBJ_Loader
+import numpy
+
+from common import OBJ_Loader, count_tokens
+from polygons import OBJ_Polygons
+
+
+def parse_float_lines( lines, defaults, return_counts = False ):
+    """Converts a list of whitespace separated value strings into
+    a single float array.
+
+    All values are converted in a single pass by numpy.
+    Lines with fewer values than 'defaults' are padded with
+    the default values. Extra values are ignored.
+
+    @param lines: a list of strings, ie. [ '1.0 2.0 3.0', ... ].
+    A string may contain multiple newline separated lines.
+    @param defaults: the default value of each column.
+    @param return_counts: if True, the number of values on each
+    line is also returned.
+    @return: an array with the shape (number of lines, len(defaults)),
+    or a tuple of the array and the counts.
+    """
+    width = len( defaults )
+    if len( lines ) == 0:
+        result = numpy.empty( (0, width), dtype = 'float' )
+        return (result, numpy.empty( 0, dtype = 'int' )) if return_counts else result
+
+    text = '\n'.join( lines )
+    values = numpy.fromstring( text, dtype = 'float', sep = ' ' )
+
+    num_lines = text.count( '\n' ) + 1
+    counts, starts = count_tokens( text, num_lines )
+
+    if len( values ) != counts.sum():
+        raise ValueError( 'Invalid floating point value in vertex data' )
+
+    if numpy.all( counts == width ):
+        result = values.reshape( -1, width )
+    else:
+        # lines have differing numbers of values
+        result = numpy.empty( (num_lines, width), dtype = 'float' )
+        result[:] = defaults
+        offsets = numpy.cumsum( counts ) - counts
+        for column in range( width ):
+            present = counts > column
+            result[ present, column ] = values[ offsets[ present ] + column ]
+    return (result, counts) if return_counts else result
+
+
+def parse_position_lines( lines ):
+    """Converts 'v' or 'vn' statement values into an array with
+    the shape (number of lines, 3).
+
+    Only lines with exactly 4 values are divided by their w component.
+    Extra values, such as the colours of 'v x y z r g b', are ignored.
+    """
+    values, counts = parse_float_lines( lines, (0.0, 0.0, 0.0, 1.0), True )
+    positions = values[ :, :3 ]
+    homogeneous = counts == 4
+    if numpy.any( homogeneous ):
+        positions[ homogeneous ] /= values[ homogeneous, 3: ]
+    return positions
+
+
+def extend_rows( array, buffer, values ):
+    """Appends rows to an array that is a view of a larger buffer.
+
+    The buffer is grown geometrically, so repeatedly appending
+    rows takes amortised linear time. The first append allocates
+    exactly the rows required.
+
+    @param array: the array to extend.
+    @param buffer: the buffer 'array' is a view of, or None.
+    @param values: the rows to append.
+    @return: a tuple of the extended array and its buffer.
+    """
+    size = len( array ) + len( values )
+    if \
+        buffer is None or \
+        array.base is not buffer or \
+        len( buffer ) < size or \
+        buffer.shape[ 1: ] != values.shape[ 1: ]:
+        buffer = numpy.empty(
+            (max( size, 2 * len( array ) ),) + values.shape[ 1: ],
+            dtype = numpy.result_type( array, values )
+            )
+        buffer[ :len( array ) ] = array
+    buffer[ len( array ) : size ] = values
+    return buffer[ :size ], buffer
 
 
 class OBJ_Mesh( OBJ_Loader ):
@@ -119,9 +207,12 @@ class OBJ_Mesh( OBJ_Loader ):
 
 
 
-    Unsupported Grouping Statements:
     mg group_number res
-    Merge (weld) vertices of meshes together within 'res' tolerance.
+    Merging groups
+    Makes the following geometry part of the specified merging group.
+    Vertices of the merging group's geometry that are within 'res' of
+    each other are welded once the file is loaded.
+    A value of 0 or 'off' turns merging off.
 
 
 
@@ -146,11 +237,16 @@ class OBJ_Mesh( OBJ_Loader ):
     If no extension is given, .obj is assumed.
 
 
+    lod level
+    Sets the level of detail of the following geometry, from 1 to 100.
+    A value of 0 turns the level of detail off.
+    See simplify.lod_chain to generate levels of detail.
+
+
     Unsupported Display/render attributes:
     bevel on/off
     c_interp on/off
     d_interp on/off
-    lod level
 
     ctech technique resolution
     stech technique resolution
@@ -196,15 +292,32 @@ class OBJ_Mesh( OBJ_Loader ):
 
     default_group = 'default'
 
+    # the keys of a sub-mesh that are set by grouping and
+    # render statements, rather than by elements
+    state_keys = [ 'name', 'groups', 'smoothing', 'material', 'texture', 'merge_group', 'lod' ]
+
 
     def __init__( self, ignore_smoothing_groups = True ):
         super( OBJ_Mesh, self ).__init__()
 
         self._ignore_smoothing_groups = ignore_smoothing_groups
 
-        self.vertices = []
-        self.texture_coords = []
-        self.normals = []
+        # vertex data is stored as the raw value strings until it is
+        # accessed, at which point it is converted in a single pass
+        self._vertices = numpy.empty( (0, 3), dtype = 'float' )
+        self._texture_coords = numpy.empty( (0, 2), dtype = 'float' )
+        self._normals = numpy.empty( (0, 3), dtype = 'float' )
+        self._vertex_lines = []
+        self._texture_coord_lines = []
+        self._normal_lines = []
+
+        # the buffers the vertex data arrays are views of
+        self._buffers = { 'v': None, 'vt': None, 'vn': None }
+
+        # the number of lines stored in blocks beyond
+        # the first line of each block
+        self._block_lines = { 'v': 0, 'vt': 0, 'vn': 0 }
+
         self.names = set([])
         self.groups = set([])
         self.materials = set([])
@@ -213,16 +326,89 @@ class OBJ_Mesh( OBJ_Loader ):
         self.shadow = None
         self.trace = None
 
+        # the resolution of each merging group
+        self.merging_groups = {}
+
         self._current_mesh = None
 
+    @property
+    def vertices( self ):
+        """The vertex positions as an array with the shape (N,3).
+        """
+        if self._vertex_lines:
+            vertices = parse_position_lines( self._vertex_lines )
+            self._vertex_lines = []
+            self._block_lines[ 'v' ] = 0
+
+            self._vertices, self._buffers[ 'v' ] = extend_rows(
+                self._vertices,
+                self._buffers[ 'v' ],
+                vertices
+                )
+        return self._vertices
+
+    @property
+    def texture_coords( self ):
+        """The texture coordinates as an array with the shape
+        (N,2), or (N,3) if any 'w' values are specified.
+        """
+        if self._texture_coord_lines:
+            texture_coords = parse_float_lines( self._texture_coord_lines, (0.0, 0.0, 0.0) )
+            self._texture_coord_lines = []
+            self._block_lines[ 'vt' ] = 0
+
+            # only keep the w component if it is used
+            width = max( self._texture_coords.shape[ 1 ], 2 )
+            if numpy.any( texture_coords[ :, 2 ] != 0.0 ):
+                width = 3
+            if width != self._texture_coords.shape[ 1 ]:
+                previous = numpy.zeros( (len( self._texture_coords ), width), dtype = 'float' )
+                previous[ :, :2 ] = self._texture_coords
+                self._texture_coords = previous
+
+            self._texture_coords, self._buffers[ 'vt' ] = extend_rows(
+                self._texture_coords,
+                self._buffers[ 'vt' ],
+                texture_coords[ :, :width ]
+                )
+        return self._texture_coords
+
+    @property
+    def normals( self ):
+        """The normals as an array with the shape (N,3).
+        """
+        if self._normal_lines:
+            normals = parse_position_lines( self._normal_lines )
+            self._normal_lines = []
+            self._block_lines[ 'vn' ] = 0
+
+            self._normals, self._buffers[ 'vn' ] = extend_rows(
+                self._normals,
+                self._buffers[ 'vn' ],
+                normals
+                )
+        return self._normals
+
+    @property
+    def num_vertices( self ):
+        return len( self._vertices ) + len( self._vertex_lines ) + self._block_lines[ 'v' ]
+
+    @property
+    def num_texture_coords( self ):
+        return len( self._texture_coords ) + len( self._texture_coord_lines ) + self._block_lines[ 'vt' ]
+
+    @property
+    def num_normals( self ):
+        return len( self._normals ) + len( self._normal_lines ) + self._block_lines[ 'vn' ]
+
     def _create_mesh( self ):
         """Creates an empty mesh with default values.
 
         All meshes begin as part of the default group.
         Any group statement will over-ride this.
 
-        Points, lines and faces are a lists.
-        Each value in the list is a tuple that represents the indicies
+        Points, lines and faces are OBJ_Polygons objects.
+        Each corner of a polygon stores the indices
         for vertex, texture coordinate and normal data respectively.
         """
         return {
@@ -231,9 +417,11 @@ class OBJ_Mesh( OBJ_Loader ):
             'smoothing':    None,
             'material':     None,
             'texture':      None,
-            'points':       [],
-            'lines':        [],
-            'faces':        [],
+            'merge_group':  None,
+            'lod':          None,
+            'points':       OBJ_Polygons( points = True ),
+            'lines':        OBJ_Polygons(),
+            'faces':        OBJ_Polygons(),
             }
 
     def _add_mesh_to_list( self, mesh ):
@@ -281,65 +469,79 @@ class OBJ_Mesh( OBJ_Loader ):
         mesh.
         """
         if self._current_mesh:
-            # duplicate ourself
-            self._current_mesh = self._current_mesh.copy()
-            # copy the current mesh and push it into
-            # our meshes list
+            # duplicate our state but not our polygons
+            mesh = self._create_mesh()
+            for key in OBJ_Mesh.state_keys:
+                mesh[ key ] = self._current_mesh[ key ]
+            self._current_mesh = mesh
+
+            # push the new mesh into our meshes list
             self._add_mesh_to_list( self._current_mesh )
         else:
             # create an empty mesh
-            self._current_mesh = _create_mesh
+            self._ensure_current_mesh()
 
     def _parse_v( self, statement ):
-        type, values = statement.split( None, 1 )
-        values = values.split()
-
-        # convert to float and a list
-        floats = map( float, values )
-
-        # divide by W component if present
-        if len(floats) == 4:
-            w = 1.0 / floats[ 3 ]
-            floats = [ value * 3 for value in floats[ :3 ] ]
-
-        # append to our vertices
-        # this will append a list inside our vertices list
-        self.vertices.append( tuple(floats) )
+        # store the values for conversion when the
+        # vertices are accessed
+        self._vertex_lines.append( statement[ 1: ] )
 
     def _parse_vt( self, statement ):
-        type, values = statement.split( None, 1 )
-        values = values.split()
+        # store the values for conversion when the
+        # texture coordinates are accessed
+        self._texture_coord_lines.append( statement[ 2: ] )
 
-        # convert to float and a list
-        floats = map( float, values )
+    def _parse_vn( self, statement ):
+        # store the values for conversion when the
+        # normals are accessed
+        self._normal_lines.append( statement[ 2: ] )
 
-        # append to our vertices
-        # this will append a list inside our vertices list
-        self.texture_coords.append( floats )
+    def parse_block( self, type, values, num_lines ):
+        """Processes a block of consecutive statements of the same type.
 
-    def _parse_vn( self, statement ):
-        type, values = statement.split( None, 1 )
-        values = values.split()
+        This is equivalent to, but much faster than, passing each
+        statement to parse_statement.
+        Only 'v', 'vt', 'vn', 'p', 'l' and 'f' statements are supported.
 
-        # convert to float and a list
-        floats = map( float, values )
+        @param type: the statement type.
+        @param values: the values of each statement with the
+        statement type removed, separated by newlines.
+        @param num_lines: the number of statements in the block.
+        """
+        if type in self._block_lines:
+            lines = {
+                'v':    self._vertex_lines,
+                'vt':   self._texture_coord_lines,
+                'vn':   self._normal_lines,
+                }[ type ]
+            lines.append( values )
+            self._block_lines[ type ] += num_lines - 1
+            return
+
+        key = {
+            'p':    'points',
+            'l':    'lines',
+            'f':    'faces',
+            }[ type ]
 
-        # divide by W component if present
-        if len(floats) == 4:
-            div = 1.0 / floats[ 3 ]
-            floats[ 0 ] *= div
-            floats[ 1 ] *= div
-            floats[ 2 ] *= div
-            floats = floats[ :3 ]
+        # ensure we have a current mesh
+        self._ensure_current_mesh()
+        polygons = self._current_mesh[ key ]
 
-        # append to our vertices
-        # this will append a list inside our vertices list
-        self.normals.append( floats )
+        if '-' in values:
+            # relative indices are converted statement by statement
+            for line in values.split( '\n' ):
+                polygons.append( self._absolute_indices( line ) )
+        else:
+            polygons.append( values, num_lines )
 
-    def _convert_indice( self, value ):
+    def _convert_indice( self, value, count ):
         """Converts a parsed indice value to an absolute
         index. Also handles '' and None values that result
         from string splitting or list buffering.
+
+        'count' is the current number of values of the indice's
+        type and is used to resolve relative indices.
         """
         # convert from offset to absolute indice
         if value == None:
@@ -355,7 +557,7 @@ class OBJ_Mesh( OBJ_Loader ):
             # check for relative indices
             # these are negative values
             elif value < 0:
-                value = len( self.vertices ) + value
+                value = count + value
             else:
                 # shouldn't be any 0 indices
                 assert False
@@ -377,6 +579,11 @@ class OBJ_Mesh( OBJ_Loader ):
         # it is invalid to mix vertex definitions
         # but we don't validate that here
         result = []
+        counts = (
+            self.num_vertices,
+            self.num_texture_coords,
+            self.num_normals
+            )
 
         for value in values:
             indices = value.split( '/' )
@@ -384,54 +591,63 @@ class OBJ_Mesh( OBJ_Loader ):
             # ensure we have 3 padded values
             indices.extend( [None] * (3 - len(indices)) )
 
-            indices = map( self._convert_indice, indices )
+            indices = map( self._convert_indice, indices, counts )
 
             # append to mesh
             result.append( tuple(indices) )
 
         return result
 
+    def _absolute_indices( self, values ):
+        """Converts any relative indices in a statement's values
+        to absolute indices.
+
+        Relative indices depend on the amount of vertex data
+        at the time the statement is parsed, so they must be
+        converted immediately.
+        """
+        if '-' not in values:
+            return values
+
+        # convert back to 1 based indices
+        # and remove any trailing empty indices
+        return ' '.join(
+            '/'.join(
+                '' if value is None else str( value + 1 )
+                for value in indices
+                ).rstrip( '/' )
+            for indices in self._convert_indices( values.split() )
+            )
+
     def _parse_p( self, statement ):
         type, values = statement.split( None, 1 )
-        values = values.split()
 
         # ensure we have a current mesh
         self._ensure_current_mesh()
-        
-        # convert our indices to integers and absolute
-        # values
-        indices = self._convert_indices( values )
 
         # append to mesh
-        self._current_mesh[ 'points' ].extend( indices )
+        # the indices are converted when the polygons are accessed
+        self._current_mesh[ 'points' ].append( self._absolute_indices( values ) )
 
     def _parse_l( self, statement ):
         type, values = statement.split( None, 1 )
-        values = values.split()
 
         # ensure we have a current mesh
         self._ensure_current_mesh()
 
-        # convert our indices to integers and absolute
-        # values
-        indices = self._convert_indices( values )
-
         # append to mesh
-        self._current_mesh[ 'lines' ].append( tuple(indices) )
+        # the indices are converted when the polygons are accessed
+        self._current_mesh[ 'lines' ].append( self._absolute_indices( values ) )
 
     def _parse_f( self, statement ):
         type, values = statement.split( None, 1 )
-        values = values.split()
 
         # ensure we have a current mesh
         self._ensure_current_mesh()
 
-        # convert our indices to integers and absolute
-        # values
-        indices = self._convert_indices( values )
-
         # append to mesh
-        self._current_mesh[ 'faces' ].append( tuple(indices) )
+        # the indices are converted when the polygons are accessed
+        self._current_mesh[ 'faces' ].append( self._absolute_indices( values ) )
 
     def _parse_o( self, statement ):
         # there should only be 1 name value
@@ -660,9 +876,27 @@ class OBJ_Mesh( OBJ_Loader ):
             )
 
     def _parse_mg( self, statement ):
-        raise NotImplementedError(
-            '"%s" not supported' % statement.split( None, 1 )[ 0 ]
-            )
+        # the resolution is only required when
+        # merging is being enabled
+        values = statement.split()
+        group = values[ 1 ]
+
+        # push the current mesh and begin a new one
+        # don't copy the mesh if we haven't actually set
+        # any faces yet
+        # this is because we may have multiple 'setup' statements
+        if self._current_mesh_has_data():
+            self._push_current_mesh()
+        else:
+            self._ensure_current_mesh()
+
+        if group == 'off' or group == '0':
+            # merging disabled
+            self._current_mesh[ 'merge_group' ] = None
+        else:
+            group = int( group )
+            self._current_mesh[ 'merge_group' ] = group
+            self.merging_groups[ group ] = float( values[ 2 ] )
 
     def _parse_bevel( self, statement ):
         raise NotImplementedError(
@@ -680,9 +914,24 @@ class OBJ_Mesh( OBJ_Loader ):
             )
 
     def _parse_lod( self, statement ):
-        raise NotImplementedError(
-            '"%s" not supported' % statement.split( None, 1 )[ 0 ]
-            )
+        # there should only be 1 level value
+        type, value = statement.split()
+
+        # push the current mesh and begin a new one
+        # don't copy the mesh if we haven't actually set
+        # any faces yet
+        # this is because we may have multiple 'setup' statements
+        if self._current_mesh_has_data():
+            self._push_current_mesh()
+        else:
+            self._ensure_current_mesh()
+
+        level = int( value )
+        if level < 0 or level > 100:
+            raise ValueError( 'Invalid level of detail "%s"' % value )
+
+        # a level of 0 turns the level of detail off
+        self._current_mesh[ 'lod' ] = level if level else None
 
     def _parse_ctech( self, statement ):
         raise NotImplementedError(
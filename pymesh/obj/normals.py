@@ -0,0 +1,180 @@
+"""Generates smoothing group aware normals for OBJ faces.
+
+The faces of every sub-mesh are processed at once.
+Face normals are calculated with Newell's method, which handles
+polygons with any number of corners. Each corner's face normal is
+weighted by the corner's angle, or by the face's area, and summed
+into the normal of its (vertex, smoothing group) pair.
+
+Corners of faces in the same smoothing group that share a vertex share
+a normal. Faces with smoothing turned off ('s off' or 's 0') are flat
+shaded and their corners use the face normal.
+
+Smoothing groups are a property of each sub-mesh, so files should be
+loaded with ignore_smoothing_groups set to False, otherwise a sub-mesh
+only has its last smoothing group.
+
+For example:
+
+    obj = OBJ()
+    obj.load( 'teapot.obj', ignore_smoothing_groups = False )
+    generate_normals( obj.model )
+    buffer = index_buffer( obj.model )
+"""
+
+import numpy
+
+from mesh import extend_rows
+
+
+weightings = [ 'angle', 'area' ]
+
+
+def _face_arrays( meshes ):
+    """Returns the corners, polygon counts and smoothing group of
+    each face of a list of sub-meshes.
+    """
+    faces = [ mesh[ 'faces' ] for mesh in meshes ]
+    corners = numpy.concatenate(
+        [ numpy.empty( (0, 3), dtype = 'int32' ) ] + [ values.corners for values in faces ]
+        )
+    counts = numpy.concatenate(
+        [ numpy.empty( 0, dtype = 'int64' ) ] + [ values.counts for values in faces ]
+        )
+
+    # -1 marks smoothing turned off
+    smoothing = numpy.concatenate( [ numpy.empty( 0, dtype = 'int64' ) ] + [
+        numpy.repeat( -1 if mesh[ 'smoothing' ] is None else mesh[ 'smoothing' ], len( values ) )
+        for mesh, values in zip( meshes, faces )
+        ] )
+    return corners, counts, smoothing
+
+
+def _normalise( vectors ):
+    lengths = numpy.sqrt( numpy.einsum( 'ij,ij->i', vectors, vectors ) )
+    lengths[ lengths == 0.0 ] = 1.0
+    return vectors / lengths[ :, numpy.newaxis ]
+
+
+def corner_normals( vertices, corners, counts, smoothing, weighting = 'angle' ):
+    """Calculates the normal of each polygon corner.
+
+    @param vertices: the vertex positions with the shape (N,3).
+    @param corners: the corners of every polygon with the shape (C,3).
+    Only the vertex index is used.
+    @param counts: the number of corners of each polygon.
+    @param smoothing: the smoothing group of each polygon, or
+    -1 for flat shaded polygons.
+    @param weighting: 'angle' to weight face normals by each corner's
+    angle, or 'area' to weight them by the face's area.
+    @return: a tuple of the unique normals with the shape (U,3) and
+    the index of each corner's normal.
+    """
+    if weighting not in weightings:
+        raise ValueError( 'Invalid normal weighting "%s"' % weighting )
+
+    vertices = numpy.asarray( vertices, dtype = 'float' )
+    counts = numpy.asarray( counts, dtype = 'int64' )
+    if len( corners ) == 0:
+        return numpy.empty( (0, 3), dtype = 'float' ), numpy.empty( 0, dtype = 'int' )
+
+    # the polygon of each corner and the previous and next corners
+    starts = numpy.cumsum( counts ) - counts
+    faces = numpy.repeat( numpy.arange( len( counts ) ), counts )
+    indices = numpy.arange( len( corners ) )
+    used = counts > 0
+    following = indices + 1
+    following[ (starts + counts - 1)[ used ] ] = starts[ used ]
+    preceding = indices - 1
+    preceding[ starts[ used ] ] = (starts + counts - 1)[ used ]
+
+    positions = vertices[ corners[ :, 0 ] ]
+
+    # Newell's method, the length is twice the polygon's area
+    face_normals = numpy.zeros( (len( counts ), 3), dtype = 'float' )
+    crosses = numpy.cross( positions, positions[ following ] )
+    for axis in range( 3 ):
+        face_normals[ :, axis ] = numpy.bincount( faces, weights = crosses[ :, axis ], minlength = len( counts ) )
+
+    if weighting == 'area':
+        weighted = face_normals[ faces ]
+    else:
+        to_next = positions[ following ] - positions
+        to_previous = positions[ preceding ] - positions
+        sines = numpy.sqrt( (numpy.cross( to_next, to_previous ) ** 2).sum( axis = -1 ) )
+        cosines = numpy.einsum( 'ij,ij->i', to_next, to_previous )
+        angles = numpy.arctan2( sines, cosines )
+        weighted = _normalise( face_normals )[ faces ] * angles[ :, numpy.newaxis ]
+
+    # smooth corners share a normal per (vertex, smoothing group)
+    # flat corners have a normal per face
+    smoothing = numpy.asarray( smoothing, dtype = 'int64' )[ faces ]
+    smooth = smoothing >= 0
+    groups = numpy.unique( smoothing[ smooth ], return_inverse = True )[ 1 ]
+    keys = numpy.empty( len( corners ), dtype = 'int64' )
+    keys[ smooth ] = corners[ smooth, 0 ].astype( 'int64' ) * (groups.max() + 1 if len( groups ) else 1) + groups
+    keys[ ~smooth ] = -1 - faces[ ~smooth ]
+
+    unique_keys, inverse = numpy.unique( keys, return_inverse = True )
+    normals = numpy.empty( (len( unique_keys ), 3), dtype = 'float' )
+    for axis in range( 3 ):
+        normals[ :, axis ] = numpy.bincount( inverse, weights = weighted[ :, axis ], minlength = len( unique_keys ) )
+
+    # normals that cancelled out use the face normal of
+    # one of their corners
+    degenerate = numpy.flatnonzero( numpy.einsum( 'ij,ij->i', normals, normals ) == 0.0 )
+    if len( degenerate ):
+        representative = numpy.empty( len( unique_keys ), dtype = 'int64' )
+        representative[ inverse ] = indices
+        normals[ degenerate ] = face_normals[ faces[ representative[ degenerate ] ] ]
+
+    return _normalise( normals ), inverse
+
+
+def generate_normals( mesh, weighting = 'angle', overwrite = False ):
+    """Generates normals for the faces of an OBJ mesh.
+
+    The new normals are added to the mesh's normals and the normal
+    index of each face corner is updated.
+
+    @param mesh: an OBJ_Mesh.
+    @param weighting: 'angle' or 'area', see corner_normals.
+    @param overwrite: if False, faces that have a normal at every
+    corner keep their normals.
+    @return: the number of normals added.
+    """
+    meshes = [ submesh for submesh in mesh.meshes if len( submesh[ 'faces' ] ) ]
+    corners, counts, smoothing = _face_arrays( meshes )
+    if len( corners ) == 0:
+        return 0
+
+    # the faces that need normals
+    faces = numpy.repeat( numpy.arange( len( counts ) ), counts )
+    if overwrite:
+        generate = numpy.ones( len( counts ), dtype = 'bool' )
+    else:
+        missing = numpy.bincount( faces, weights = corners[ :, 2 ] < 0, minlength = len( counts ) )
+        generate = missing > 0
+    if not numpy.any( generate ):
+        return 0
+
+    selected = generate[ faces ]
+    normals, indices = corner_normals(
+        mesh.vertices,
+        corners[ selected ],
+        counts[ generate ],
+        smoothing[ generate ],
+        weighting
+        )
+
+    # append the new normals
+    values = corners[ :, 2 ].copy()
+    values[ selected ] = indices + mesh.num_normals
+    mesh._normals, mesh._buffers[ 'vn' ] = extend_rows( mesh.normals, mesh._buffers[ 'vn' ], normals )
+
+    offset = 0
+    for submesh in meshes:
+        polygons = submesh[ 'faces' ]
+        polygons.replace_column( 2, values[ offset : offset + len( polygons.corners ) ] )
+        offset += len( polygons.corners )
+    return len( normals )
@@ -0,0 +1,251 @@
+"""Parses large OBJ files with a pool of processes.
+
+The file is split into byte ranges at line boundaries.
+Each range is parsed by a separate process and the results
+are merged in order.
+
+OBJ indices are global, so absolute indices need no conversion.
+Relative (negative) indices depend on the number of vertices,
+texture coordinates and normals before the statement. The vertex
+data statements of each range are counted first, which gives each
+process the counts at the start of its range.
+
+A range may begin in the middle of a sub-mesh. The first sub-mesh
+of a range inherits any state (name, groups, material, etc) that
+is not set within the range from the previous range, and continues
+the previous range's last sub-mesh where the sequential loader
+would not have created a new one.
+
+Files containing 'call' statements are loaded sequentially, as the
+called files can change the vertex counts.
+"""
+
+import mmap
+import multiprocessing
+import re
+
+import numpy
+
+from mesh import OBJ_Mesh
+from reader import has_call_statements, read_obj_data, split_ranges
+
+
+_vertex_statement = re.compile( r'^[ \t]*(vt|vn|v)[ \t]', re.M )
+
+_state_keys = OBJ_Mesh.state_keys
+
+
+class _Inherit( object ):
+    """Marks mesh state that is inherited from the previous range.
+    """
+    pass
+
+
+class _OBJ_RangeMesh( OBJ_Mesh ):
+    """Parses a byte range of an OBJ file.
+
+    'counts' are the number of vertices, texture coordinates and
+    normals before the range, which are used to resolve
+    relative indices.
+    """
+
+    def __init__( self, counts, ignore_smoothing_groups = True ):
+        super( _OBJ_RangeMesh, self ).__init__( ignore_smoothing_groups )
+
+        self.base_counts = counts
+
+        # True if the first mesh was begun by a statement that
+        # would have pushed the previous range's mesh
+        self.pushed = False
+
+        # the state set before that statement, which the
+        # sequential loader sets on the previous range's mesh
+        self.unpushed_state = {}
+
+    def _create_mesh( self ):
+        mesh = super( _OBJ_RangeMesh, self )._create_mesh()
+        if not self.meshes:
+            for key in _state_keys:
+                mesh[ key ] = _Inherit()
+        return mesh
+
+    def _current_mesh_has_data( self ):
+        # only statements that push meshes check for data
+        has_data = super( _OBJ_RangeMesh, self )._current_mesh_has_data()
+        if not has_data and len( self.meshes ) <= 1 and not self.pushed:
+            # no elements have been parsed in this range yet.
+            # statements such as 's' with smoothing groups ignored
+            # may have already created the first mesh, their state
+            # belongs to the previous range's mesh
+            self.pushed = True
+            if self._current_mesh:
+                self.unpushed_state = dict(
+                    (key, value)
+                    for key, value in self._current_mesh.items()
+                    if key in _state_keys and not isinstance( value, _Inherit )
+                    )
+        return has_data
+
+    @property
+    def num_vertices( self ):
+        return self.base_counts[ 0 ] + super( _OBJ_RangeMesh, self ).num_vertices
+
+    @property
+    def num_texture_coords( self ):
+        return self.base_counts[ 1 ] + super( _OBJ_RangeMesh, self ).num_texture_coords
+
+    @property
+    def num_normals( self ):
+        return self.base_counts[ 2 ] + super( _OBJ_RangeMesh, self ).num_normals
+
+
+def _read_range( filename, start, end ):
+    with open( filename, 'rb' ) as f:
+        f.seek( start )
+        return f.read( end - start )
+
+
+def _count_task( args ):
+    """Process pool task that counts the vertex data
+    statements in a byte range.
+    """
+    filename, start, end = args
+    statements = _vertex_statement.findall( _read_range( filename, start, end ) )
+    return (
+        statements.count( 'v' ),
+        statements.count( 'vt' ),
+        statements.count( 'vn' )
+        )
+
+
+def _parse_task( args ):
+    """Process pool task that parses a byte range.
+    """
+    filename, start, end, counts, ignore_smoothing_groups = args
+
+    data = _OBJ_RangeMesh( counts, ignore_smoothing_groups )
+    read_obj_data( _read_range( filename, start, end ), data )
+
+    # convert everything before returning it
+    data.vertices
+    data.texture_coords
+    data.normals
+    for mesh in data.meshes:
+        for key in [ 'points', 'lines', 'faces' ]:
+            mesh[ key ].corners
+    data._current_mesh = None
+    return data
+
+
+def load_parallel( filename, workers = 0, ignore_smoothing_groups = True ):
+    """Parses an OBJ file with a pool of processes.
+
+    @param filename: the OBJ file to load.
+    @param workers: the number of processes, if 0 the number of
+    CPUs is used.
+    @return: an OBJ_Mesh, or None if the file must be
+    loaded sequentially.
+    """
+    workers = workers or multiprocessing.cpu_count()
+
+    with open( filename, 'rb' ) as f:
+        try:
+            data = mmap.mmap( f.fileno(), 0, access = mmap.ACCESS_READ )
+        except ValueError:
+            # empty files can't be mapped
+            return None
+
+        try:
+            if has_call_statements( data ):
+                return None
+
+            # use a few ranges per worker to balance the load
+            ranges = split_ranges( data, workers * 4 )
+        finally:
+            data.close()
+
+    processes = multiprocessing.Pool( workers )
+    try:
+        counts = processes.map(
+            _count_task,
+            [ (filename, start, end) for start, end in ranges ]
+            )
+
+        # the counts at the start of each range
+        bases = numpy.zeros( (len( ranges ), 3), dtype = 'int' )
+        bases[ 1: ] = numpy.cumsum( counts, axis = 0 )[ :-1 ]
+
+        results = processes.map(
+            _parse_task,
+            [
+                (filename, start, end, tuple( base ), ignore_smoothing_groups)
+                for (start, end), base in zip( ranges, bases.tolist() )
+                ]
+            )
+    finally:
+        processes.close()
+        processes.join()
+
+    # the counts are found by pattern matching, which may not match
+    # the parser if a vertex statement spans multiple lines
+    for result, count in zip( results, counts ):
+        parsed = (len( result.vertices ), len( result.texture_coords ), len( result.normals ))
+        if parsed != tuple( count ):
+            return None
+
+    return _merge( results, ignore_smoothing_groups )
+
+
+def _merge( results, ignore_smoothing_groups ):
+    """Merges the parsed ranges into a single OBJ_Mesh.
+    """
+    data = OBJ_Mesh( ignore_smoothing_groups )
+
+    data._vertices = numpy.concatenate( [ result.vertices for result in results ] )
+    data._normals = numpy.concatenate( [ result.normals for result in results ] )
+
+    # ranges may differ in their texture coordinate size
+    width = max( result.texture_coords.shape[ 1 ] for result in results )
+    texture_coords = []
+    for result in results:
+        values = result.texture_coords
+        if values.shape[ 1 ] != width:
+            values = numpy.hstack( (values, numpy.zeros( (len( values ), width - values.shape[ 1 ]) )) )
+        texture_coords.append( values )
+    data._texture_coords = numpy.concatenate( texture_coords )
+
+    for result in results:
+        data.names.update( result.names )
+        data.groups.update( result.groups )
+        data.materials.update( result.materials )
+        data.textures.update( result.textures )
+        data.merging_groups.update( result.merging_groups )
+        data.shadow = result.shadow or data.shadow
+        data.trace = result.trace or data.trace
+
+        for index, mesh in enumerate( result.meshes ):
+            previous = data._current_mesh
+
+            if index == 0 and previous and result.pushed and data._current_mesh_has_data():
+                # state set before the push belongs to the previous mesh
+                previous.update( result.unpushed_state )
+            elif index == 0 and previous:
+                # the mesh continues the previous range's mesh
+                for key in _state_keys:
+                    if not isinstance( mesh[ key ], _Inherit ):
+                        previous[ key ] = mesh[ key ]
+                for key in [ 'points', 'lines', 'faces' ]:
+                    previous[ key ].extend( mesh[ key ] )
+                continue
+
+            # inherit any state that wasn't set
+            state = previous or data._create_mesh()
+            for key in _state_keys:
+                if isinstance( mesh[ key ], _Inherit ):
+                    mesh[ key ] = state[ key ]
+
+            data._current_mesh = mesh
+            data._add_mesh_to_list( mesh )
+
+    data._current_mesh = None
+    return data
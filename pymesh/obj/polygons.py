@@ -0,0 +1,287 @@
+"""Compact storage of OBJ points, lines and faces.
+
+Polygons are stored in a compressed sparse row layout.
+The corners of all polygons are stored in a single integer array
+with the shape (corners, 3), containing the vertex, texture coordinate
+and normal index of each corner. Missing indices are -1.
+The corners of polygon 'n' are in the range
+offsets[ n ] : offsets[ n + 1 ].
+
+Statements are stored as strings when they are parsed and are
+converted to integers in batches.
+"""
+
+import re
+
+import numpy
+
+from common import count_tokens
+
+
+# an index separator with no following index, ie. '1/2/'
+_trailing_separator = re.compile( r'/(?=\s|$)' )
+
+
+def parse_corner_text( text ):
+    """Converts newline separated polygon statement values into
+    corner indices.
+
+    @param text: the values of each statement, ie. '1/1/1 2/2/2 3/3/3'.
+    @return: a tuple of the OBJ indices of each corner with the shape
+    (corners, 3) and the number of corners of each line.
+    The indices are not converted, missing indices are 0.
+    """
+    # '//' indicates a missing texture coordinate
+    # OBJ indices begin at 1, so use 0 for missing values
+    text = text.replace( '//', '/0/' )
+    if _trailing_separator.search( text ):
+        text = _trailing_separator.sub( '/0', text )
+
+    counts, starts = count_tokens( text, text.count( '\n' ) + 1 )
+    num_corners = counts.sum()
+
+    # count the indices of each corner
+    chars = numpy.frombuffer( text, dtype = 'uint8' )
+    corner_ids = numpy.cumsum( starts ) - 1
+    fields = numpy.bincount(
+        corner_ids[ chars == ord( '/' ) ],
+        minlength = num_corners
+        ) + 1
+
+    values = numpy.fromstring( text.replace( '/', ' ' ), dtype = 'int64', sep = ' ' )
+    if len( values ) != fields.sum() or numpy.any( fields > 3 ):
+        raise ValueError( 'Invalid polygon indices' )
+
+    corners = numpy.zeros( (num_corners, 3), dtype = 'int64' )
+    offsets = numpy.cumsum( fields ) - fields
+    for column in range( 3 ):
+        present = fields > column
+        corners[ present, column ] = values[ offsets[ present ] + column ]
+
+    return corners, counts.astype( 'int64' )
+
+
+class OBJ_Polygons( object ):
+    """A list of OBJ polygons.
+
+    For compatibility, the polygons can also be accessed as a list.
+    Each polygon is a tuple of (vertex, texture coord, normal) tuples,
+    with None for missing indices.
+    If created with 'points' set to True, each corner is a separate
+    polygon and is returned as a single (vertex, texture coord, normal)
+    tuple.
+    """
+
+    # the number of statements stored as strings before
+    # they are converted
+    batch_size = 65536
+
+    def __init__( self, points = False ):
+        super( OBJ_Polygons, self ).__init__()
+
+        self.points = points
+
+        self._corners = numpy.empty( (0, 3), dtype = 'int32' )
+        self._counts = numpy.empty( 0, dtype = 'int64' )
+        self._offsets = None
+        self._chunks = []
+        self._lines = []
+        self._num_polygons = 0
+
+    @classmethod
+    def from_arrays( cls, corners, counts, points = False ):
+        """Creates a polygon list from existing corner and
+        count arrays. The arrays are not copied.
+        """
+        polygons = cls( points )
+        polygons._corners = corners
+        polygons._counts = counts
+        polygons._num_polygons = len( counts )
+        return polygons
+
+    def __len__( self ):
+        return self._num_polygons
+
+    def __iter__( self ):
+        corners = self.corners
+        offsets = self.offsets
+        for index in xrange( len( self ) ):
+            yield self._polygon( corners, offsets, index )
+
+    def __getitem__( self, index ):
+        if isinstance( index, slice ):
+            return [ self[ i ] for i in xrange( *index.indices( len( self ) ) ) ]
+
+        if index < 0:
+            index += len( self )
+        if not 0 <= index < len( self ):
+            raise IndexError( 'Polygon index out of range' )
+        return self._polygon( self.corners, self.offsets, index )
+
+    def _polygon( self, corners, offsets, index ):
+        polygon = tuple(
+            tuple( value if value >= 0 else None for value in corner )
+            for corner in corners[ offsets[ index ] : offsets[ index + 1 ] ].tolist()
+            )
+        if self.points:
+            return polygon[ 0 ]
+        return polygon
+
+    def append( self, values, num_lines = 1 ):
+        """Adds a statement's indices to the list.
+
+        @param values: the values of the statement, ie. '1/1/1 2/2/2 3/3/3'.
+        Relative (negative) indices must already be converted to
+        absolute indices.
+        Multiple statements can be added at once by separating
+        them with newlines.
+        @param num_lines: the number of statements in 'values'.
+        """
+        self._lines.append( values )
+        if self.points:
+            self._num_polygons += len( values.split() )
+        else:
+            self._num_polygons += num_lines
+
+        if len( self._lines ) >= OBJ_Polygons.batch_size:
+            self._convert_lines()
+
+    def extend( self, polygons ):
+        """Appends the polygons of another OBJ_Polygons object.
+        """
+        # keep our pending statements before the new polygons
+        if self._lines:
+            self._convert_lines()
+
+        if len( polygons ):
+            self._chunks.append( (polygons.corners, polygons.counts) )
+            self._num_polygons += len( polygons )
+
+    def remap( self, column, mapping ):
+        """Maps the indices of a column through an array.
+
+        Missing indices are not changed.
+
+        @param column: 0 for vertices, 1 for texture coordinates
+        and 2 for normals.
+        @param mapping: an array with the new value of each index.
+        """
+        # the corners may be a view of a shared array
+        corners = self.corners.copy()
+        present = corners[ :, column ] >= 0
+        corners[ present, column ] = mapping[ corners[ present, column ] ]
+        self._corners = corners
+
+    def replace_column( self, column, values ):
+        """Replaces the indices of a column.
+
+        @param column: 0 for vertices, 1 for texture coordinates
+        and 2 for normals.
+        @param values: the new index of each corner, -1 for missing.
+        """
+        # the corners may be a view of a shared array
+        corners = self.corners.copy()
+        corners[ :, column ] = values
+        self._corners = corners
+
+    @property
+    def corners( self ):
+        """The indices of each corner as an array with the
+        shape (corners, 3).
+        """
+        self._compile()
+        return self._corners
+
+    @property
+    def counts( self ):
+        """The number of corners of each polygon.
+        """
+        self._compile()
+        return self._counts
+
+    @property
+    def offsets( self ):
+        """The offset of each polygon's first corner, followed
+        by the total number of corners.
+        """
+        self._compile()
+        if self._offsets is None:
+            self._offsets = numpy.zeros( len( self._counts ) + 1, dtype = 'int64' )
+            numpy.cumsum( self._counts, out = self._offsets[ 1: ] )
+        return self._offsets
+
+    def _compile( self ):
+        if self._lines:
+            self._convert_lines()
+
+        if self._chunks:
+            chunks = [ (self._corners, self._counts) ] + self._chunks
+            self._corners = numpy.concatenate( [ corners for corners, counts in chunks ] )
+            self._counts = numpy.concatenate( [ counts for corners, counts in chunks ] )
+            self._offsets = None
+            self._chunks = []
+
+    def _convert_lines( self ):
+        lines = self._lines
+        self._lines = []
+
+        corners, counts = parse_corner_text( '\n'.join( lines ) )
+
+        # convert to 0 based indices
+        # missing values become -1
+        corners -= 1
+
+        if self.points:
+            counts = numpy.ones( len( corners ), dtype = 'int64' )
+
+        self._chunks.append( (corners.astype( 'int32' ), counts) )
+
+
+def convert_pending( polygons ):
+    """Converts the pending statements of many polygon lists at once.
+
+    Converting each list separately is slow when there are many
+    small lists, such as the sub-meshes of a file with many groups.
+
+    @param polygons: a list of OBJ_Polygons objects.
+    """
+    # only lists with nothing but pending statements can be split
+    # from a single conversion
+    pending = [
+        values for values in polygons
+        if values._lines and not values._chunks and len( values._corners ) == 0
+        ]
+    if not pending:
+        return
+
+    for points in [ True, False ]:
+        batch = [ values for values in pending if values.points == points ]
+        if not batch:
+            continue
+
+        corners, counts = parse_corner_text(
+            '\n'.join( [ '\n'.join( values._lines ) for values in batch ] )
+            )
+        corners -= 1
+        corners = corners.astype( 'int32' )
+
+        # split the result by the polygons of each list
+        sizes = [ len( values ) for values in batch ]
+        if points:
+            counts = numpy.ones( len( corners ), dtype = 'int64' )
+        polygon_offsets = numpy.zeros( len( batch ) + 1, dtype = 'int64' )
+        polygon_offsets[ 1: ] = numpy.cumsum( sizes )
+        corner_offsets = numpy.zeros( len( counts ) + 1, dtype = 'int64' )
+        numpy.cumsum( counts, out = corner_offsets[ 1: ] )
+        corner_offsets = corner_offsets[ polygon_offsets ]
+
+        if polygon_offsets[ -1 ] != len( counts ):
+            raise ValueError( 'Invalid polygon indices' )
+
+        polygon_offsets = polygon_offsets.tolist()
+        corner_offsets = corner_offsets.tolist()
+        for index, values in enumerate( batch ):
+            values._lines = []
+            values._corners = corners[ corner_offsets[ index ] : corner_offsets[ index + 1 ] ]
+            values._counts = counts[ polygon_offsets[ index ] : polygon_offsets[ index + 1 ] ]
+            values._offsets = None
@@ -0,0 +1,656 @@
+"""Reads OBJ statements from a memory mapped file.
+
+The file is scanned as an array of bytes. Line boundaries are found
+with numpy and each line is classified by its leading keyword in a
+single step.
+
+Consecutive lines of the same vertex data or polygon statement are
+passed to OBJ_Mesh.parse_block as a single block of text, which
+converts them in bulk. All other statements, and very short runs,
+are passed to OBJ_Mesh.parse_statement one line at a time.
+
+Lines continued with a '\\' are joined before scanning.
+Comments and empty lines are ignored.
+
+Files can also be read in two passes with 'preallocate'.
+The first pass counts the vertex data and polygon corners of the
+file. Exact size arrays are then allocated and filled by the second
+pass, and each sub-mesh's polygons are slices of these arrays.
+The file is processed in chunks of 'chunk_size' bytes, so the memory
+used while loading is the size of the final arrays plus a small
+constant.
+
+'call' statements are not supported by the reader.
+"""
+
+from collections import namedtuple
+import mmap
+import re
+
+import numpy
+
+from mesh import parse_float_lines, parse_position_lines
+from polygons import OBJ_Polygons, parse_corner_text
+
+
+_call_statement = re.compile( r'^[ \t]*call[ \t]', re.M )
+_continuation = re.compile( r'^([ \t]*[^#\s][^\n]*?)[ \t]*\\[ \t\r]*\n', re.M )
+
+# line types
+# block statements follow these
+_skip, _other = 0, 1
+
+# the keyword and block type of each block statement
+_keywords = [
+    ('v', 'v'),
+    ('vt', 'vt'),
+    ('vn', 'vn'),
+    ('p', 'p'),
+    ('l', 'l'),
+    ('f', 'f'),
+    ('fo', 'f'),
+    ]
+
+# the block types of the two pass reader, and the block
+# code of each line type
+_blocks = [ None, 'v', 'vt', 'vn', 'p', 'l', 'f' ]
+_block_codes = numpy.array(
+    [ 0, 0 ] + [ _blocks.index( block ) for keyword, block in _keywords ],
+    dtype = 'uint8'
+    )
+
+# runs shorter than this are parsed line by line
+min_block_size = 8
+
+# the number of bytes processed at once by the two pass reader
+chunk_size = 4 * 1024 * 1024
+
+
+scan_layout = namedtuple(
+    'OBJ_Scan',
+    [
+        'vertices',
+        'texture_coords',
+        'texture_coord_size',
+        'normals',
+        'points',
+        'lines',
+        'line_corners',
+        'faces',
+        'face_corners',
+        'groups'
+        ]
+    )
+
+
+def has_call_statements( data ):
+    """Returns True if the data contains a 'call' statement.
+    """
+    # a plain search is much faster than the pattern
+    if data.find( 'call' ) < 0:
+        return False
+    return _call_statement.search( data ) is not None
+
+
+def join_continuations( data ):
+    """Joins lines that are continued with a '\\'.
+
+    Returns the data unchanged if there are no continued lines.
+    """
+    if data.find( '\\' ) < 0 or not _continuation.search( data ):
+        return data
+
+    data = data[:]
+    while True:
+        joined = _continuation.sub( r'\1 ', data )
+        if joined == data:
+            return data
+        data = joined
+
+
+def split_ranges( data, num_ranges ):
+    """Splits a buffer into byte ranges at line boundaries.
+
+    Lines that are continued with a '\\' are kept in the
+    same range as the following line.
+
+    @return: a list of (start, end) tuples.
+    """
+    size = len( data )
+    boundaries = [ 0 ]
+    for index in range( 1, num_ranges ):
+        position = max( boundaries[ -1 ], size * index // num_ranges )
+        while True:
+            position = data.find( '\n', position )
+            if position < 0:
+                position = size
+                break
+            position += 1
+
+            # check if the line continues on the next line
+            line_start = data.rfind( '\n', 0, position - 1 ) + 1
+            if not data[ line_start : position ].rstrip().endswith( '\\' ):
+                break
+        if position >= size:
+            break
+        if position > boundaries[ -1 ]:
+            boundaries.append( position )
+    boundaries.append( size )
+    return zip( boundaries[ :-1 ], boundaries[ 1: ] )
+
+
+def _whitespace( c ):
+    return (c == ord( ' ' )) | (c == ord( '\t' )) | (c == ord( '\r' )) | (c == ord( '\n' ))
+
+
+def _line_chars( chars, starts, lengths, offset ):
+    """Returns the character at an offset of each line,
+    or a newline if the line is too short.
+    """
+    result = chars[ numpy.minimum( starts + offset, len( chars ) - 1 ) ]
+    result[ lengths <= offset ] = ord( '\n' )
+    return result
+
+
+def classify_lines( chars ):
+    """Finds the lines of a buffer and their statement types.
+
+    @param chars: the buffer as a uint8 array.
+    @return: a tuple of the start and end of each line and its type.
+    Types are _skip, _other, or the index into _keywords plus 2.
+    """
+    size = len( chars )
+    newlines = numpy.flatnonzero( chars == ord( '\n' ) )
+    starts = numpy.concatenate( ([ 0 ], newlines + 1) )
+    ends = numpy.concatenate( (newlines, [ size ]) )
+    if starts[ -1 ] == size:
+        starts, ends = starts[ :-1 ], ends[ :-1 ]
+    lengths = ends - starts
+
+    # skip any indentation, which is rare
+    indented = numpy.flatnonzero(
+        (lengths > 0) &
+        ((chars[ numpy.minimum( starts, size - 1 ) ] == ord( ' ' )) | (chars[ numpy.minimum( starts, size - 1 ) ] == ord( '\t' )))
+        )
+    for line in indented.tolist():
+        start, end = starts[ line ], ends[ line ]
+        while start < end and chars[ start ] in ( ord( ' ' ), ord( '\t' ) ):
+            start += 1
+        starts[ line ] = start
+    lengths = ends - starts
+
+    first, second, third = [ _line_chars( chars, starts, lengths, offset ) for offset in range( 3 ) ]
+
+    types = numpy.empty( len( starts ), dtype = 'int8' )
+    types[:] = _other
+    types[ (first == ord( '#' )) | (lengths == 0) | ((lengths == 1) & (first == ord( '\r' ))) ] = _skip
+    for index, (keyword, block) in enumerate( _keywords ):
+        if len( keyword ) == 1:
+            match = (first == ord( keyword )) & _whitespace( second )
+        else:
+            match = (first == ord( keyword[ 0 ] )) & (second == ord( keyword[ 1 ] )) & _whitespace( third )
+        types[ match ] = index + 2
+
+    return starts, ends, types
+
+
+def _runs( types ):
+    """Yields the type, first and last line of each run of lines
+    with the same type.
+    """
+    changes = numpy.flatnonzero( types[ 1: ] != types[ :-1 ] ) + 1
+    run_starts = numpy.concatenate( ([ 0 ], changes) ).tolist()
+    run_ends = numpy.concatenate( (changes, [ len( types ) ]) ).tolist()
+    return zip( types[ run_starts ].tolist(), run_starts, run_ends )
+
+
+def _remove_keywords( block, line_starts, keyword ):
+    for offset in range( len( keyword ) ):
+        block[ line_starts + offset ] = ord( ' ' )
+    return block.tostring()
+
+
+def _parse_lines( data, mesh, starts, ends ):
+    for start, end in zip( starts.tolist(), ends.tolist() ):
+        line = data[ start : end ].strip()
+        if not line or line.startswith( '#' ):
+            continue
+        try:
+            mesh.parse_statement( line )
+        except NotImplementedError as e:
+            print e
+
+
+def read_obj_file( filename, mesh, preallocate = False ):
+    """Reads an OBJ file into an OBJ_Mesh using a memory map.
+
+    @param preallocate: if True, the file is read in two passes
+    and the data is stored in exact size arrays.
+    @return: False if the file contains 'call' statements and
+    must be read with a buffer stack instead, otherwise True.
+    """
+    with open( filename, 'rb' ) as f:
+        try:
+            data = mmap.mmap( f.fileno(), 0, access = mmap.ACCESS_READ )
+        except ValueError:
+            # empty files can't be mapped
+            return True
+
+        try:
+            if has_call_statements( data ):
+                return False
+            if preallocate:
+                read_obj_data_preallocated( data, mesh )
+            else:
+                read_obj_data( data, mesh )
+        finally:
+            data.close()
+    return True
+
+
+def read_obj_data( data, mesh ):
+    """Reads OBJ statements from a string or memory map into
+    an OBJ_Mesh.
+
+    'call' statements are not handled.
+    """
+    data = join_continuations( data )
+    chars = numpy.frombuffer( data, dtype = 'uint8' )
+    if len( chars ) == 0:
+        return
+
+    starts, ends, types = classify_lines( chars )
+
+    for type, first_line, last_line in _runs( types ):
+        if type == _skip:
+            continue
+
+        if type == _other or last_line - first_line < min_block_size:
+            _parse_lines( data, mesh, starts[ first_line : last_line ], ends[ first_line : last_line ] )
+            continue
+
+        keyword, block_type = _keywords[ type - 2 ]
+        start, end = starts[ first_line ], ends[ last_line - 1 ]
+        text = _remove_keywords(
+            chars[ start : end ].copy(),
+            starts[ first_line : last_line ] - start,
+            keyword
+            )
+        mesh.parse_block( block_type, text, last_line - first_line )
+
+
+def iter_obj_file( filename, mesh, release = False ):
+    """Reads an OBJ file into an OBJ_Mesh in chunks and yields
+    each sub-mesh once it is complete.
+
+    A sub-mesh is complete when a statement begins a new sub-mesh,
+    or at the end of the file. The vertex data of the mesh is
+    converted after each chunk, so the yielded sub-meshes can be
+    used with the mesh's current vertices, texture coordinates
+    and normals.
+
+    @param release: if True, the points, lines and faces of each
+    sub-mesh are released once the caller has processed it.
+    @return: a generator of sub-mesh dictionaries, or None if the
+    file contains 'call' statements and must be read with a
+    buffer stack instead.
+    """
+    with open( filename, 'rb' ) as f:
+        try:
+            data = mmap.mmap( f.fileno(), 0, access = mmap.ACCESS_READ )
+        except ValueError:
+            # empty files can't be mapped
+            return iter( [] )
+
+    if has_call_statements( data ):
+        data.close()
+        return None
+    return _iter_obj_data( data, mesh, release )
+
+
+def _iter_obj_data( data, mesh, release ):
+    try:
+        yielded = 0
+        ranges = split_ranges( data, max( 1, len( data ) // chunk_size ) )
+
+        # None marks the end of the file
+        for chunk_range in ranges + [ None ]:
+            if chunk_range:
+                start, end = chunk_range
+                read_obj_data( data[ start : end ], mesh )
+
+                # store the vertex data as arrays
+                mesh.vertices
+                mesh.texture_coords
+                mesh.normals
+
+                # the current mesh is the last in the list
+                # every mesh before it is complete
+                completed = mesh.meshes[ yielded : -1 ]
+            else:
+                mesh._current_mesh = None
+                completed = mesh.meshes[ yielded : ]
+
+            yielded += len( completed )
+            for submesh in completed:
+                yield submesh
+                if release:
+                    _release( submesh )
+    finally:
+        data.close()
+
+
+def _release( submesh ):
+    submesh[ 'points' ] = OBJ_Polygons( points = True )
+    submesh[ 'lines' ] = OBJ_Polygons()
+    submesh[ 'faces' ] = OBJ_Polygons()
+
+
+def _chunks( data ):
+    """Yields the chunks of a buffer for the two pass reader.
+    """
+    num_chunks = max( 1, len( data ) // chunk_size )
+    for start, end in split_ranges( data, num_chunks ):
+        chunk = join_continuations( data[ start : end ] )
+        chars = numpy.frombuffer( chunk, dtype = 'uint8' )
+        if len( chars ):
+            yield chunk, chars
+
+
+def scan_obj_data( data ):
+    """Counts the vertex data and polygons of an OBJ file.
+
+    @param data: a string or memory map.
+    @return: a scan_layout.
+    """
+    counts = numpy.zeros( len( _keywords ) + 2, dtype = 'int' )
+    corners = dict( (block, 0) for keyword, block in _keywords )
+    texture_coord_size = 2
+    groups = 0
+
+    for chunk, chars in _chunks( data ):
+        starts, ends, types = classify_lines( chars )
+        counts += numpy.bincount( types, minlength = len( counts ) )
+
+        lengths = ends - starts
+        groups += numpy.count_nonzero(
+            (_line_chars( chars, starts, lengths, 0 ) == ord( 'g' )) &
+            _whitespace( _line_chars( chars, starts, lengths, 1 ) )
+            )
+
+        # count the values of each line
+        # the keyword is the first value
+        spaces = _whitespace( chars )
+        tokens = ~spaces
+        tokens[ 1: ] &= spaces[ :-1 ]
+        lines = numpy.searchsorted( starts, numpy.flatnonzero( tokens ), 'right' ) - 1
+        values = numpy.bincount( lines, minlength = len( starts ) ) - 1
+
+        for index, (keyword, block) in enumerate( _keywords ):
+            match = types == index + 2
+            if block in ( 'p', 'l', 'f' ):
+                corners[ block ] += values[ match ].sum()
+            elif block == 'vt' and numpy.any( match ):
+                texture_coord_size = max( texture_coord_size, min( values[ match ].max(), 3 ) )
+
+    def count( block ):
+        return sum(
+            counts[ index + 2 ]
+            for index, (keyword, value) in enumerate( _keywords )
+            if value == block
+            )
+
+    return scan_layout(
+        count( 'v' ),
+        count( 'vt' ),
+        texture_coord_size,
+        count( 'vn' ),
+        corners[ 'p' ],
+        count( 'l' ),
+        corners[ 'l' ],
+        count( 'f' ),
+        corners[ 'f' ],
+        groups
+        )
+
+
+def scan_obj_file( filename ):
+    """Counts the vertex data and polygons of an OBJ file.
+
+    @return: a scan_layout.
+    """
+    with open( filename, 'rb' ) as f:
+        try:
+            data = mmap.mmap( f.fileno(), 0, access = mmap.ACCESS_READ )
+        except ValueError:
+            return scan_obj_data( '' )
+
+        try:
+            return scan_obj_data( data )
+        finally:
+            data.close()
+
+
+class _Preallocated( object ):
+    """Fills preallocated arrays with the second pass of
+    the two pass reader.
+
+    All statements of each block type in a chunk are converted
+    at once. The polygons of each sub-mesh are then assigned
+    by walking the runs of the chunk.
+    """
+
+    def __init__( self, scan ):
+        super( _Preallocated, self ).__init__()
+
+        self.scan = scan
+        self.values = {
+            'v':    numpy.empty( (scan.vertices, 3), dtype = 'float' ),
+            'vt':   numpy.empty( (scan.texture_coords, scan.texture_coord_size), dtype = 'float' ),
+            'vn':   numpy.empty( (scan.normals, 3), dtype = 'float' ),
+            }
+        self.polygons = {
+            'p':    (
+                numpy.empty( (scan.points, 3), dtype = 'int32' ),
+                numpy.ones( scan.points, dtype = 'int64' )
+                ),
+            'l':    (
+                numpy.empty( (scan.line_corners, 3), dtype = 'int32' ),
+                numpy.empty( scan.lines, dtype = 'int64' )
+                ),
+            'f':    (
+                numpy.empty( (scan.face_corners, 3), dtype = 'int32' ),
+                numpy.empty( scan.faces, dtype = 'int64' )
+                ),
+            }
+        self.keys = { 'p': 'points', 'l': 'lines', 'f': 'faces' }
+
+        # the number of values, corners and polygons filled
+        self.filled = dict( (key, 0) for key in self.values )
+        self.corners_filled = dict( (key, 0) for key in self.polygons )
+        self.counts_filled = dict( (key, 0) for key in self.polygons )
+
+        # the mesh whose polygons are being filled and the
+        # start of its polygons
+        self.current = dict( (key, (None, 0, 0)) for key in self.polygons )
+
+    def _line_owners( self, chars, starts, ends, types ):
+        """Returns the block code of each character.
+
+        Characters of a block statement's values, and its newline,
+        are marked with the statement's block code.
+        Keywords and all other characters are 0.
+        """
+        size = len( chars )
+        line_ends = ends + 1
+        gaps = starts - numpy.concatenate( ([ 0 ], line_ends[ :-1 ]) )
+        codes = _block_codes[ types ]
+
+        owners = numpy.repeat(
+            numpy.column_stack( (numpy.zeros_like( codes ), codes) ).ravel(),
+            numpy.column_stack( (gaps, line_ends - starts) ).ravel()
+            )[ :size ]
+
+        for index, (keyword, block) in enumerate( _keywords ):
+            keyword_starts = starts[ types == index + 2 ]
+            for offset in range( len( keyword ) ):
+                owners[ keyword_starts + offset ] = 0
+        return owners
+
+    def _block_text( self, chars, owners, block ):
+        """Returns the newline separated values of a block's statements.
+        """
+        text = chars[ owners == _blocks.index( block ) ].tostring()
+        if text.endswith( '\n' ):
+            text = text[ :-1 ]
+        return text
+
+    def fill( self, chunk, chars, mesh ):
+        starts, ends, types = classify_lines( chars )
+        owners = self._line_owners( chars, starts, ends, types )
+        line_codes = _block_codes[ types ]
+
+        # the number of each vertex data type before each line
+        bases = []
+        for block in [ 'v', 'vt', 'vn' ]:
+            present = line_codes == _blocks.index( block )
+            bases.append( self.filled[ block ] + numpy.cumsum( present ) - present )
+
+        for block in [ 'v', 'vt', 'vn' ]:
+            if numpy.any( line_codes == _blocks.index( block ) ):
+                self._fill_values( block, self._block_text( chars, owners, block ) )
+
+        # the index of each polygon line within its block
+        block_lines = numpy.zeros( len( types ), dtype = 'int64' )
+        polygon_offsets = {}
+        for block in [ 'p', 'l', 'f' ]:
+            lines = numpy.flatnonzero( line_codes == _blocks.index( block ) )
+            if len( lines ):
+                block_lines[ lines ] = numpy.arange( len( lines ) )
+                polygon_offsets[ block ] = self._fill_polygons(
+                    block,
+                    self._block_text( chars, owners, block ),
+                    numpy.column_stack( bases )[ lines ]
+                    )
+
+        for type, first_line, last_line in _runs( types ):
+            if type == _skip:
+                continue
+
+            if type == _other:
+                _parse_lines( chunk, mesh, starts[ first_line : last_line ], ends[ first_line : last_line ] )
+                continue
+
+            keyword, block = _keywords[ type - 2 ]
+            if block in self.polygons:
+                self._assign_polygons(
+                    block,
+                    block_lines[ first_line ],
+                    block_lines[ last_line - 1 ],
+                    polygon_offsets[ block ],
+                    mesh
+                    )
+
+        # advance past the chunk
+        for block, offsets in polygon_offsets.items():
+            self.corners_filled[ block ] += offsets[ -1, 0 ]
+            self.counts_filled[ block ] += offsets[ -1, 1 ]
+
+    def _fill_values( self, block, text ):
+        array = self.values[ block ]
+        if block == 'vt':
+            values = parse_float_lines( [ text ], (0.0, 0.0, 0.0) )[ :, :array.shape[ 1 ] ]
+        else:
+            values = parse_position_lines( [ text ] )
+
+        start = self.filled[ block ]
+        array[ start : start + len( values ) ] = values
+        self.filled[ block ] += len( values )
+
+    def _fill_polygons( self, block, text, bases ):
+        """Converts and stores all polygons of a block type in a chunk.
+
+        @param bases: the number of vertices, texture coordinates and
+        normals before each line.
+        @return: the corner and polygon offset of each line within
+        the chunk, followed by the totals.
+        """
+        values, counts = parse_corner_text( text )
+
+        # convert to 0 based indices
+        # relative indices are from the values before the line
+        # missing values become -1
+        bases = numpy.repeat( bases, counts, axis = 0 )
+        corners = numpy.where( values > 0, values - 1, values + bases )
+        corners[ values == 0 ] = -1
+
+        corner_array, count_array = self.polygons[ block ]
+        corner_start = self.corners_filled[ block ]
+        count_start = self.counts_filled[ block ]
+        corner_array[ corner_start : corner_start + len( corners ) ] = corners
+
+        offsets = numpy.zeros( (len( counts ) + 1, 2), dtype = 'int64' )
+        numpy.cumsum( counts, out = offsets[ 1:, 0 ] )
+        if block == 'p':
+            # each point is a polygon
+            offsets[ :, 1 ] = offsets[ :, 0 ]
+        else:
+            count_array[ count_start : count_start + len( counts ) ] = counts
+            offsets[ 1:, 1 ] = numpy.arange( 1, len( counts ) + 1 )
+        return offsets
+
+    def _assign_polygons( self, block, first, last, offsets, mesh ):
+        """Adds a run of polygons to the current mesh.
+
+        Each mesh's polygons are a contiguous slice of the arrays.
+        """
+        corner_end = self.corners_filled[ block ] + offsets[ last + 1, 0 ]
+        count_end = self.counts_filled[ block ] + offsets[ last + 1, 1 ]
+
+        mesh._ensure_current_mesh()
+        current, corner_start, count_start = self.current[ block ]
+        if current is not mesh._current_mesh:
+            current = mesh._current_mesh
+            corner_start = self.corners_filled[ block ] + offsets[ first, 0 ]
+            count_start = self.counts_filled[ block ] + offsets[ first, 1 ]
+            self.current[ block ] = (current, corner_start, count_start)
+
+        corner_array, count_array = self.polygons[ block ]
+        current[ self.keys[ block ] ] = OBJ_Polygons.from_arrays(
+            corner_array[ corner_start : corner_end ],
+            count_array[ count_start : count_end ],
+            points = block == 'p'
+            )
+
+    def finish( self, mesh ):
+        if \
+            self.filled[ 'v' ] != self.scan.vertices or \
+            self.filled[ 'vt' ] != self.scan.texture_coords or \
+            self.filled[ 'vn' ] != self.scan.normals or \
+            self.corners_filled[ 'f' ] != self.scan.face_corners:
+            raise ValueError( 'OBJ data changed between passes' )
+
+        # the scan only counts values, so drop the w component
+        # if it is unused, as the sequential reader does
+        texture_coords = self.values[ 'vt' ]
+        if texture_coords.shape[ 1 ] > 2 and not numpy.any( texture_coords[ :, 2 ] != 0.0 ):
+            texture_coords = numpy.ascontiguousarray( texture_coords[ :, :2 ] )
+
+        mesh._vertices = self.values[ 'v' ]
+        mesh._texture_coords = texture_coords
+        mesh._normals = self.values[ 'vn' ]
+
+
+def read_obj_data_preallocated( data, mesh ):
+    """Reads OBJ statements from a string or memory map into
+    an OBJ_Mesh using two passes.
+
+    The first pass counts the data, which is then stored in exact
+    size arrays by the second pass.
+
+    'call' statements are not handled.
+    """
+    fill = _Preallocated( scan_obj_data( data ) )
+    for chunk, chars in _chunks( data ):
+        fill.fill( chunk, chars, mesh )
+    fill.finish( mesh )
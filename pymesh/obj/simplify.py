@@ -0,0 +1,510 @@
+"""Generates levels of detail with quadric error edge collapses.
+
+Faces are triangulated and each unique (vertex, texture coord, normal,
+sub-mesh) corner becomes a wedge. Vertices with identical positions
+are welded first, so seams made from duplicated 'v' statements are
+seams rather than borders. Edges are collapsed onto one of their
+vertices, so the remaining vertices, texture coordinates and normals
+are never moved or interpolated.
+
+Every vertex has a quadric, which measures the squared distance to
+the planes of its faces. The quadrics are initialised for all faces
+at once with numpy.bincount. Edges on borders, UV and normal seams
+and between sub-meshes add planes perpendicular to their face, which
+keep those edges in place.
+
+Collapses are taken from a heap in the order of their error.
+Vertices are classified once:
+    manifold    A single wedge and no border edges.
+                Can collapse onto any neighbour.
+    border      A single wedge on an open border.
+                Can only collapse along the border.
+    seam        Two wedges on a seam.
+                Can only collapse along the seam, both wedges
+                collapse together so the seam stays closed.
+    locked      Anything else, never collapsed.
+
+Collapses that flip a face or change the mesh's topology are rejected.
+
+The error of a collapse is the square root of its quadric error,
+divided by the quadric's total weight. This approximates the distance
+of the collapsed vertex from the planes of the faces that were merged
+into it, in model units. It is not the distance between the original
+and simplified surfaces. A level stops before the first collapse
+whose error is greater than its maximum error.
+
+A level also stops when no valid collapse remains, which can leave it
+with more triangles than its target and the same triangles as the
+previous level. Each level's report_layout has the number of triangles
+and the error it actually reached, so duplicate levels can be dropped.
+
+For example:
+
+    # levels with 5000, 2000 and 500 triangles
+    levels = lod_chain( obj.model, targets = [ 5000, 2000, 500 ] )
+
+    # or the simplest mesh within an error
+    mesh = simplify( obj.model, max_error = 0.01 )
+
+    levels, reports = lod_chain( obj.model, [ 5000, 2000, 500 ], return_reports = True )
+    for report in reports:
+        print '%d triangles, error %f' % (report.triangles, report.error)
+"""
+
+import heapq
+from collections import namedtuple
+
+import numpy
+
+from mesh import OBJ_Mesh
+from polygons import OBJ_Polygons
+from triangulate import triangulate
+from weld import weld_vertices
+
+
+# the weight of the planes that keep borders and seams in place
+border_weight = 10.0
+
+_manifold, _border, _seam, _locked = range( 4 )
+
+
+report_layout = namedtuple(
+    'Simplify_Report',
+    [
+        'triangles',
+        'error'
+        ]
+    )
+"""
+triangles   The number of triangles of the level.
+error       The largest error of the collapses made so far.
+"""
+
+
+def _plane_quadrics( normals, points, weights ):
+    """Returns the quadric of each plane as 10 values.
+
+    @param normals: the unit normal of each plane.
+    @param points: a point on each plane.
+    @param weights: the weight of each plane.
+    """
+    d = -numpy.einsum( 'ij,ij->i', normals, points )
+    x, y, z = normals.T
+    return numpy.column_stack( (
+        x * x, x * y, x * z, x * d,
+        y * y, y * z, y * d,
+        z * z, z * d,
+        d * d
+        ) ) * weights[ :, numpy.newaxis ]
+
+
+def _sum_quadrics( quadrics, weights, owners, size ):
+    """Sums quadrics and their weights into 'size' rows.
+    """
+    result = numpy.empty( (size, 11), dtype = 'float' )
+    for column in range( 10 ):
+        result[ :, column ] = numpy.bincount( owners, weights = quadrics[ :, column ], minlength = size )
+    result[ :, 10 ] = numpy.bincount( owners, weights = weights, minlength = size )
+    return result
+
+
+def _quadric_error( q, r, p ):
+    """Returns the mean squared distance of a point to the planes
+    of the sum of two quadrics.
+    """
+    x, y, z = p
+    error = \
+        (q[ 0 ] + r[ 0 ]) * x * x + (q[ 4 ] + r[ 4 ]) * y * y + (q[ 7 ] + r[ 7 ]) * z * z + q[ 9 ] + r[ 9 ] + \
+        2.0 * (
+            (q[ 1 ] + r[ 1 ]) * x * y + (q[ 2 ] + r[ 2 ]) * x * z + (q[ 5 ] + r[ 5 ]) * y * z +
+            (q[ 3 ] + r[ 3 ]) * x + (q[ 6 ] + r[ 6 ]) * y + (q[ 8 ] + r[ 8 ]) * z
+            )
+    weight = q[ 10 ] + r[ 10 ]
+    return max( error, 0.0 ) / weight if weight > 0.0 else 0.0
+
+
+def _face_normal( a, b, c ):
+    ab = (b[ 0 ] - a[ 0 ], b[ 1 ] - a[ 1 ], b[ 2 ] - a[ 2 ])
+    ac = (c[ 0 ] - a[ 0 ], c[ 1 ] - a[ 1 ], c[ 2 ] - a[ 2 ])
+    return (
+        ab[ 1 ] * ac[ 2 ] - ab[ 2 ] * ac[ 1 ],
+        ab[ 2 ] * ac[ 0 ] - ab[ 0 ] * ac[ 2 ],
+        ab[ 0 ] * ac[ 1 ] - ab[ 1 ] * ac[ 0 ]
+        )
+
+
+class _Simplifier( object ):
+    """Collapses the edges of a triangle mesh.
+    """
+
+    def __init__( self, positions, wedges, triangles ):
+        """
+        @param positions: the vertex positions with the shape (N,3).
+        @param wedges: the vertex of each wedge.
+        @param triangles: the wedges of each triangle with the shape (T,3).
+        """
+        super( _Simplifier, self ).__init__()
+
+        positions = numpy.asarray( positions, dtype = 'float' )
+        size = len( positions )
+        corners = wedges[ triangles ]
+
+        # planes of the faces weighted by area
+        points = positions[ corners ]
+        normals = numpy.cross( points[ :, 1 ] - points[ :, 0 ], points[ :, 2 ] - points[ :, 0 ] )
+        areas = numpy.sqrt( numpy.einsum( 'ij,ij->i', normals, normals ) )
+        normals /= numpy.maximum( areas, 1e-30 )[ :, numpy.newaxis ]
+        areas *= 0.5
+        face_quadrics = _plane_quadrics( normals, points[ :, 0 ], areas )
+        quadrics = _sum_quadrics(
+            numpy.repeat( face_quadrics, 3, axis = 0 ),
+            numpy.repeat( areas, 3 ),
+            corners.ravel(),
+            size
+            )
+
+        # wedge edges used by a single triangle are borders or seams
+        starts = triangles.ravel()
+        ends = numpy.roll( triangles, -1, axis = 1 ).ravel()
+        keys = numpy.minimum( starts, ends ).astype( 'int64' ) * len( wedges ) + numpy.maximum( starts, ends )
+        unique, inverse, counts = numpy.unique( keys, return_inverse = True, return_counts = True )
+        borders = counts[ inverse ] == 1
+        border_starts = starts[ borders ]
+        border_ends = ends[ borders ]
+
+        if numpy.any( borders ):
+            # planes through the edges, perpendicular to their face
+            edges = positions[ wedges[ border_ends ] ] - positions[ wedges[ border_starts ] ]
+            lengths = numpy.sqrt( numpy.einsum( 'ij,ij->i', edges, edges ) )
+            planes = numpy.cross( edges, numpy.repeat( normals, 3, axis = 0 )[ borders ] )
+            planes /= numpy.maximum( lengths, 1e-30 )[ :, numpy.newaxis ]
+            weights = lengths * lengths * border_weight
+            border_quadrics = _plane_quadrics( planes, positions[ wedges[ border_starts ] ], weights )
+            quadrics += _sum_quadrics(
+                numpy.concatenate( (border_quadrics, border_quadrics) ),
+                numpy.concatenate( (weights, weights) ),
+                numpy.concatenate( (wedges[ border_starts ], wedges[ border_ends ]) ),
+                size
+                )
+
+        # classify the vertices
+        wedge_counts = numpy.bincount( wedges, minlength = size )
+        border_counts = numpy.bincount( wedges[ border_starts ], minlength = size ) + \
+            numpy.bincount( wedges[ border_ends ], minlength = size )
+        kinds = numpy.full( size, _locked, dtype = 'int' )
+        kinds[ (wedge_counts == 1) & (border_counts == 0) ] = _manifold
+        kinds[ (wedge_counts == 1) & (border_counts == 2) ] = _border
+        kinds[ (wedge_counts == 2) & (border_counts == 4) ] = _seam
+
+        # seams must have a face on both sides of each seam edge
+        vertex_keys = numpy.minimum( corners, numpy.roll( corners, -1, axis = 1 ) ).astype( 'int64' ) * size + \
+            numpy.maximum( corners, numpy.roll( corners, -1, axis = 1 ) )
+        vertex_keys = vertex_keys.ravel()
+        unique, inverse, counts = numpy.unique( vertex_keys, return_inverse = True, return_counts = True )
+        open_edges = counts[ inverse ] == 1
+        open_vertices = numpy.zeros( size, dtype = 'bool' )
+        open_vertices[ corners.ravel()[ open_edges ] ] = True
+        open_vertices[ numpy.roll( corners, -1, axis = 1 ).ravel()[ open_edges ] ] = True
+        kinds[ (kinds == _seam) & open_vertices ] = _locked
+        kinds[ (kinds == _border) & ~open_vertices ] = _locked
+
+        self.positions = positions.tolist()
+        self.quadrics = quadrics.tolist()
+        self.kinds = kinds.tolist()
+        self.wedges = wedges.tolist()
+        self.triangles = triangles.tolist()
+        self.alive = [ True ] * len( triangles )
+        self.num_triangles = len( triangles )
+        self.versions = [ 0 ] * size
+
+        # the largest squared error of the collapses made
+        self.error = 0.0
+
+        # the triangles that use each vertex
+        self.faces = [ set() for index in range( size ) ]
+        for triangle, values in enumerate( corners.tolist() ):
+            for vertex in values:
+                self.faces[ vertex ].add( triangle )
+
+        self.heap = []
+        for vertex in range( size ):
+            self._push( vertex )
+
+    def _neighbours( self, vertex ):
+        wedges = self.wedges
+        result = set()
+        for triangle in self.faces[ vertex ]:
+            for wedge in self.triangles[ triangle ]:
+                result.add( wedges[ wedge ] )
+        result.discard( vertex )
+        return result
+
+    def _candidates( self, vertex ):
+        """Returns the (error, target) of each collapse of a vertex,
+        in order of their error.
+        """
+        quadrics = self.quadrics
+        positions = self.positions
+        source = quadrics[ vertex ]
+        return sorted(
+            (_quadric_error( source, quadrics[ target ], positions[ target ] ), target)
+            for target in self._neighbours( vertex )
+            )
+
+    def _push( self, vertex ):
+        """Pushes a vertex's best collapse onto the heap.
+
+        Each vertex has a version, which changes whenever its
+        neighbourhood changes, so outdated heap entries can be skipped.
+        """
+        if self.kinds[ vertex ] == _locked:
+            return
+        candidates = self._candidates( vertex )
+        if candidates:
+            heapq.heappush( self.heap, (candidates[ 0 ][ 0 ], vertex, self.versions[ vertex ]) )
+
+    def _collapse_wedges( self, source, target ):
+        """Returns the wedge each of the source's wedges collapses
+        into, the shared triangles, or None if the collapse is invalid.
+        """
+        wedges = self.wedges
+        shared = self.faces[ source ] & self.faces[ target ]
+        mapping = {}
+        for triangle in shared:
+            corners = self.triangles[ triangle ]
+            source_wedge = [ wedge for wedge in corners if wedges[ wedge ] == source ][ 0 ]
+            target_wedge = [ wedge for wedge in corners if wedges[ wedge ] == target ][ 0 ]
+            if mapping.setdefault( source_wedge, target_wedge ) != target_wedge:
+                return None
+
+        kind = self.kinds[ source ]
+        if kind == _border and len( shared ) != 1:
+            return None
+        if kind == _seam and (len( shared ) != 2 or len( mapping ) != 2):
+            return None
+
+        # every wedge of the source must have somewhere to go
+        for triangle in self.faces[ source ]:
+            for wedge in self.triangles[ triangle ]:
+                if wedges[ wedge ] == source and wedge not in mapping:
+                    return None
+        return mapping, shared
+
+    def _valid( self, source, target, shared ):
+        """Checks the topology and face orientation of a collapse.
+        """
+        # the only common neighbours must be the shared triangles' corners
+        opposite = set()
+        for triangle in shared:
+            for wedge in self.triangles[ triangle ]:
+                opposite.add( self.wedges[ wedge ] )
+        common = self._neighbours( source ) & self._neighbours( target )
+        if common != opposite - set( [ source, target ] ):
+            return False
+
+        # the remaining faces must not flip
+        positions = self.positions
+        wedges = self.wedges
+        for triangle in self.faces[ source ] - shared:
+            corners = [ wedges[ wedge ] for wedge in self.triangles[ triangle ] ]
+            before = _face_normal( *[ positions[ vertex ] for vertex in corners ] )
+            after = _face_normal( *[ positions[ target if vertex == source else vertex ] for vertex in corners ] )
+            if sum( a * b for a, b in zip( before, after ) ) <= 0.0:
+                return False
+        return True
+
+    def _collapse( self, source, target, mapping, shared ):
+        for triangle in shared:
+            self.alive[ triangle ] = False
+            for wedge in self.triangles[ triangle ]:
+                self.faces[ self.wedges[ wedge ] ].discard( triangle )
+        self.num_triangles -= len( shared )
+
+        for triangle in self.faces[ source ]:
+            corners = self.triangles[ triangle ]
+            self.triangles[ triangle ] = [ mapping.get( wedge, wedge ) for wedge in corners ]
+            self.faces[ target ].add( triangle )
+        self.faces[ source ] = set()
+
+        self.quadrics[ target ] = [ a + b for a, b in zip( self.quadrics[ source ], self.quadrics[ target ] ) ]
+        self.kinds[ source ] = _locked
+
+        # the collapses around the target have changed
+        changed = self._neighbours( target )
+        changed.add( target )
+        for vertex in changed:
+            self.versions[ vertex ] += 1
+        for vertex in changed:
+            self._push( vertex )
+
+    def simplify( self, target = None, max_error = None ):
+        """Collapses edges until there are 'target' triangles, the
+        next collapse has an error greater than 'max_error' or no
+        valid collapse remains.
+        """
+        target = target or 0
+        max_error = float( 'inf' ) if max_error is None else max_error * max_error
+        heap = self.heap
+        versions = self.versions
+        while heap and self.num_triangles > target:
+            cost, source, version = heap[ 0 ]
+            if versions[ source ] != version:
+                heapq.heappop( heap )
+                continue
+            if cost > max_error:
+                break
+            heapq.heappop( heap )
+
+            # use the best valid collapse, unless another
+            # vertex has a better collapse.
+            # vertices without a valid collapse are pushed again
+            # when their neighbourhood changes
+            for cost, destination in self._candidates( source ):
+                if cost > max_error:
+                    break
+                if heap and cost > heap[ 0 ][ 0 ]:
+                    heapq.heappush( heap, (cost, source, version) )
+                    break
+                result = self._collapse_wedges( source, destination )
+                if result is not None and self._valid( source, destination, result[ 1 ] ):
+                    self._collapse( source, destination, *result )
+                    self.error = max( self.error, cost )
+                    break
+
+    def remaining( self ):
+        """Returns the indices of the remaining triangles and their wedges.
+        """
+        indices = [ index for index, alive in enumerate( self.alive ) if alive ]
+        triangles = [ self.triangles[ index ] for index in indices ]
+        return (
+            numpy.array( indices, dtype = 'int64' ),
+            numpy.array( triangles, dtype = 'int64' ).reshape( -1, 3 )
+            )
+
+
+def _mesh_triangles( mesh, welded ):
+    """Returns the corners and sub-mesh of each triangle.
+
+    @param welded: the welded vertex of each vertex.
+    """
+    corners = [ numpy.empty( (0, 3, 3), dtype = 'int32' ) ]
+    owners = [ numpy.empty( 0, dtype = 'int64' ) ]
+    for index, submesh in enumerate( mesh.meshes ):
+        triangles = triangulate( submesh[ 'faces' ], mesh.vertices )[ 0 ]
+        corners.append( triangles )
+        owners.append( numpy.repeat( index, len( triangles ) ) )
+    corners = numpy.concatenate( corners )
+    owners = numpy.concatenate( owners )
+
+    # triangles with a repeated vertex have no area
+    vertices = welded[ corners[ :, :, 0 ] ]
+    valid = \
+        (vertices[ :, 0 ] != vertices[ :, 1 ]) & \
+        (vertices[ :, 1 ] != vertices[ :, 2 ]) & \
+        (vertices[ :, 2 ] != vertices[ :, 0 ])
+    return corners[ valid ], owners[ valid ]
+
+
+def _copy_mesh( mesh, corners, owners ):
+    """Creates an OBJ_Mesh that shares a mesh's vertex data,
+    with new triangles for each sub-mesh.
+    """
+    result = OBJ_Mesh( mesh._ignore_smoothing_groups )
+    result._vertices = mesh.vertices
+    result._texture_coords = mesh.texture_coords
+    result._normals = mesh.normals
+    result.names = set( mesh.names )
+    result.groups = set( mesh.groups )
+    result.materials = set( mesh.materials )
+    result.textures = set( mesh.textures )
+    result.shadow = mesh.shadow
+    result.trace = mesh.trace
+    result.merging_groups = dict( mesh.merging_groups )
+
+    order = numpy.argsort( owners, kind = 'mergesort' )
+    corners = corners[ order ]
+    starts = numpy.searchsorted( owners[ order ], numpy.arange( len( mesh.meshes ) + 1 ) ).tolist()
+    for index, submesh in enumerate( mesh.meshes ):
+        values = dict( (key, submesh[ key ]) for key in OBJ_Mesh.state_keys )
+        values[ 'points' ] = submesh[ 'points' ]
+        values[ 'lines' ] = submesh[ 'lines' ]
+        triangles = corners[ starts[ index ] : starts[ index + 1 ] ]
+        values[ 'faces' ] = OBJ_Polygons.from_arrays(
+            numpy.ascontiguousarray( triangles.reshape( -1, 3 ), dtype = 'int32' ),
+            numpy.repeat( numpy.int64( 3 ), len( triangles ) )
+            )
+        result.meshes.append( values )
+    return result
+
+
+def lod_chain( mesh, targets = None, errors = None, return_reports = False ):
+    """Generates levels of detail of an OBJ mesh.
+
+    Each level continues simplifying the previous level, so a chain
+    costs the same as simplifying to the last level.
+
+    @param mesh: an OBJ_Mesh.
+    @param targets: the number of triangles of each level, in
+    decreasing order, or None.
+    @param errors: the maximum error of each level, in increasing
+    order, or None.
+    A level stops at its target or its maximum error, whichever
+    is reached first, or earlier if no valid collapse remains.
+    @param return_reports: if True, a report_layout is also returned
+    for each level.
+    @return: a list with an OBJ_Mesh for each level, or a tuple of
+    the list and a list of report_layouts.
+    """
+    if targets is None and errors is None:
+        raise ValueError( 'A target or maximum error is required' )
+    levels = len( targets if targets is not None else errors )
+    targets = targets if targets is not None else [ None ] * levels
+    errors = errors if errors is not None else [ None ] * levels
+    if len( targets ) != len( errors ):
+        raise ValueError( 'Targets and errors must be the same length' )
+
+    # vertices that share a position are a single vertex,
+    # their wedges keep the original vertex indices
+    welded = weld_vertices( mesh.vertices, 0.0 )[ 0 ]
+    corners, owners = _mesh_triangles( mesh, welded )
+
+    # wedges are unique corners within a sub-mesh
+    keys = numpy.column_stack( (corners.reshape( -1, 3 ), numpy.repeat( owners, 3 )) )
+    if len( keys ):
+        unique, inverse = numpy.unique( keys, axis = 0, return_inverse = True )
+    else:
+        unique, inverse = numpy.empty( (0, 4), dtype = 'int64' ), numpy.empty( 0, dtype = 'int64' )
+
+    simplifier = _Simplifier( mesh.vertices, welded[ unique[ :, 0 ] ], inverse.reshape( -1, 3 ) )
+
+    result = []
+    reports = []
+    for target, max_error in zip( targets, errors ):
+        simplifier.simplify( target, max_error )
+        indices, triangles = simplifier.remaining()
+        result.append( _copy_mesh( mesh, unique[ triangles, :3 ], owners[ indices ] ) )
+        reports.append( report_layout( len( indices ), numpy.sqrt( simplifier.error ) ) )
+
+    if return_reports:
+        return result, reports
+    return result
+
+
+def simplify( mesh, target = None, max_error = None, return_report = False ):
+    """Simplifies an OBJ mesh.
+
+    The result has more than 'target' triangles if no valid
+    collapse remains.
+
+    @param mesh: an OBJ_Mesh.
+    @param target: the number of triangles to simplify to, or None.
+    @param max_error: the maximum error, or None.
+    @param return_report: if True, a report_layout is also returned.
+    @return: a new OBJ_Mesh, or a tuple of the mesh and a report_layout.
+    """
+    if target is None and max_error is None:
+        raise ValueError( 'A target or maximum error is required' )
+    meshes, reports = lod_chain( mesh, [ target ], [ max_error ], True )
+    if return_report:
+        return meshes[ 0 ], reports[ 0 ]
+    return meshes[ 0 ]
@@ -0,0 +1,169 @@
+"""Triangulates OBJ polygons.
+
+Polygons are grouped by their number of corners.
+Each group is checked for convexity in a single step and the
+convex polygons are fan triangulated together.
+Concave polygons are triangulated individually by ear clipping.
+
+For example:
+
+    mesh = obj.model.meshes[ 0 ]
+    triangles, faces = triangulate( mesh[ 'faces' ], obj.model.vertices )
+    # per-face data can be carried over to the triangles
+    triangle_materials = face_materials[ faces ]
+"""
+
+import numpy
+
+
+def triangulate( polygons, vertices ):
+    """Triangulates a set of polygons.
+
+    Polygons with less than 3 corners do not create any triangles.
+
+    @param polygons: an OBJ_Polygons object.
+    @param vertices: the vertex positions the polygons refer to.
+    @return: a tuple of the triangle corners with the shape
+    (triangles, 3, 3) and the index of the polygon each triangle
+    was created from. Triangles are in the order of their polygons.
+    Each corner contains the vertex, texture coordinate and normal
+    index, with -1 for missing indices.
+    """
+    corners = polygons.corners
+    counts = polygons.counts
+    offsets = polygons.offsets
+    vertices = numpy.asarray( vertices, dtype = 'float' )
+
+    triangles = []
+    faces = []
+
+    for size in numpy.unique( counts ):
+        if size < 3:
+            continue
+
+        # the corner indices of each polygon (polygons, size)
+        polygon_indices = numpy.nonzero( counts == size )[ 0 ]
+        polygon_corners = offsets[ polygon_indices ][ :, numpy.newaxis ] + numpy.arange( size )
+
+        if size > 3:
+            positions = vertices[ corners[ polygon_corners, 0 ] ]
+            convex = _convex( positions )
+        else:
+            convex = numpy.ones( len( polygon_indices ), dtype = 'bool' )
+
+        # fan triangulate the convex polygons
+        fan = numpy.empty( (size - 2, 3), dtype = 'int' )
+        fan[ :, 0 ] = 0
+        fan[ :, 1 ] = numpy.arange( 1, size - 1 )
+        fan[ :, 2 ] = numpy.arange( 2, size )
+
+        triangles.append( polygon_corners[ convex ][ :, fan ].reshape( -1, 3 ) )
+        faces.append( numpy.repeat( polygon_indices[ convex ], size - 2 ) )
+
+        # ear clip the concave polygons
+        for index, polygon, points in zip(
+            polygon_indices[ ~convex ],
+            polygon_corners[ ~convex ],
+            positions[ ~convex ] if size > 3 else []
+            ):
+            ears = _ear_clip( points )
+            triangles.append( polygon[ ears ] )
+            faces.append( numpy.repeat( index, len( ears ) ) )
+
+    if not triangles:
+        return numpy.empty( (0, 3, 3), dtype = corners.dtype ), numpy.empty( 0, dtype = 'int' )
+
+    triangles = numpy.concatenate( triangles )
+    faces = numpy.concatenate( faces )
+
+    # restore the polygon order
+    order = numpy.argsort( faces, kind = 'mergesort' )
+    return corners[ triangles[ order ] ], faces[ order ]
+
+
+def _normals( positions ):
+    """Calculates the normal of each polygon using Newell's method.
+
+    @param positions: an array with the shape (polygons, corners, 3).
+    """
+    return numpy.cross(
+        positions,
+        numpy.roll( positions, -1, axis = -2 )
+        ).sum( axis = -2 )
+
+
+def _convex( positions ):
+    """Returns True for each polygon that is convex.
+
+    A polygon is convex if every corner turns in the same
+    direction as the polygon's normal.
+
+    @param positions: an array with the shape (polygons, corners, 3).
+    """
+    normals = _normals( positions )
+    edges = numpy.roll( positions, -1, axis = -2 ) - positions
+    turns = numpy.cross( edges, numpy.roll( edges, -1, axis = -2 ) )
+    turns = numpy.einsum( 'pci,pi->pc', turns, normals )
+    return numpy.all( turns >= 0.0, axis = -1 )
+
+
+def _ear_clip( positions ):
+    """Triangulates a single polygon by ear clipping.
+
+    @param positions: the positions of the polygon's corners.
+    @return: the corners of each triangle as an array with
+    the shape (triangles, 3).
+    """
+    # project onto the plane with the largest area
+    normal = _normals( positions[ numpy.newaxis ] )[ 0 ]
+    axis = numpy.argmax( numpy.abs( normal ) )
+    points = numpy.delete( positions, axis, axis = -1 )
+
+    # ensure the polygon is counter-clockwise in the plane
+    if normal[ axis ] * (1.0 if axis != 1 else -1.0) < 0.0:
+        points = points[ :, ::-1 ]
+
+    # python floats are faster than numpy scalars here
+    points = points.tolist()
+
+    def cross( a, b, c ):
+        return (b[ 0 ] - a[ 0 ]) * (c[ 1 ] - a[ 1 ]) - (b[ 1 ] - a[ 1 ]) * (c[ 0 ] - a[ 0 ])
+
+    remaining = range( len( points ) )
+    triangles = []
+
+    while len( remaining ) > 3:
+        count = len( remaining )
+        for i in range( count ):
+            a, b, c = remaining[ i - 1 ], remaining[ i ], remaining[ (i + 1) % count ]
+
+            # the corner must be convex
+            if cross( points[ a ], points[ b ], points[ c ] ) <= 0.0:
+                continue
+
+            # no other corner may be inside the ear
+            inside = False
+            for other in remaining:
+                if other in (a, b, c):
+                    continue
+                p = points[ other ]
+                if \
+                    cross( points[ a ], points[ b ], p ) >= 0.0 and \
+                    cross( points[ b ], points[ c ], p ) >= 0.0 and \
+                    cross( points[ c ], points[ a ], p ) >= 0.0:
+                    inside = True
+                    break
+            if inside:
+                continue
+
+            triangles.append( (a, b, c) )
+            remaining.pop( i )
+            break
+        else:
+            # degenerate polygon, fan the remaining corners
+            break
+
+    for i in range( 1, len( remaining ) - 1 ):
+        triangles.append( (remaining[ 0 ], remaining[ i ], remaining[ i + 1 ]) )
+
+    return numpy.array( triangles, dtype = 'int' ).reshape( -1, 3 )
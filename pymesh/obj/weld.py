@@ -0,0 +1,222 @@
+"""Welds vertices that are within a tolerance of each other.
+
+Vertices are quantised into a grid with cells the size of the
+tolerance. Any vertex within the tolerance of another vertex is in the
+same or a neighbouring cell. The cells are packed, or hashed, into
+integer keys which are sorted once. The vertices of each neighbouring
+cell are then found with a binary search of the sorted keys, so all
+candidate pairs are found without any python loops over the vertices.
+
+Vertices are merged with every vertex within the tolerance, so a
+chain of close vertices is merged into a single vertex. Each vertex
+is mapped to the lowest index in its group.
+
+For example:
+
+    merged = weld_mesh( obj.model, 0.001 )
+    print 'merged %d vertices' % merged
+"""
+
+import numpy
+
+
+# the number of vertices searched at once, which bounds the
+# memory used by the candidate pairs
+batch_size = 1024 * 1024
+
+# the neighbouring cells that are searched
+# only half of the neighbours are required as each pair is found
+# from one side
+_offsets = numpy.array( [
+    (x, y, z)
+    for x in [ -1, 0, 1 ]
+    for y in [ -1, 0, 1 ]
+    for z in [ -1, 0, 1 ]
+    if (x, y, z) >= (0, 0, 0)
+    ], dtype = 'int64' )
+
+# large primes used to hash the grid cells
+_primes = numpy.array( [ 73856093, 19349663, 83492791 ], dtype = 'int64' )
+
+
+def _cell_scale( cells ):
+    """Returns the scale that converts cells to integer keys.
+
+    A key is the dot product of a cell and the scale, so the key of a
+    neighbouring cell is the key plus the dot product of the offset.
+    Cells are packed into a single integer when possible, which keeps
+    the keys of neighbouring cells in the same order. Otherwise the
+    cells are hashed, collisions only create extra candidates which
+    are removed by the distance test.
+    """
+    ranges = cells.max( axis = 0 ) - cells.min( axis = 0 ) + 3
+    if numpy.prod( ranges.astype( 'float' ) ) < 2 ** 62:
+        return numpy.array( [ ranges[ 1 ] * ranges[ 2 ], ranges[ 2 ], 1 ], dtype = 'int64' )
+    return _primes
+
+
+def _ranges( lo, hi ):
+    """Returns the indices of every range and the range they are from.
+    """
+    counts = hi - lo
+    owners = numpy.repeat( numpy.arange( len( lo ) ), counts )
+    starts = numpy.cumsum( counts ) - counts
+    indices = numpy.arange( counts.sum() ) - starts[ owners ] + lo[ owners ]
+    return indices, owners
+
+
+def _components( size, first, second ):
+    """Labels the connected components of a set of pairs.
+
+    Each index is labelled with the lowest index in its component.
+    """
+    labels = numpy.arange( size )
+    while len( first ):
+        lowest = numpy.minimum( labels[ first ], labels[ second ] )
+
+        # lower the label of both sides of each pair
+        targets = numpy.concatenate( (labels[ first ], labels[ second ]) )
+        values = numpy.concatenate( (lowest, lowest) )
+        order = numpy.lexsort( (values, targets) )
+        targets = targets[ order ]
+        values = values[ order ]
+        starts = numpy.flatnonzero( numpy.concatenate( ([ True ], targets[ 1: ] != targets[ :-1 ]) ) )
+        labels[ targets[ starts ] ] = numpy.minimum( labels[ targets[ starts ] ], values[ starts ] )
+
+        # follow the labels to their lowest index
+        while True:
+            jumped = labels[ labels ]
+            if numpy.array_equal( jumped, labels ):
+                break
+            labels = jumped
+
+        # only pairs with different labels need another pass
+        different = labels[ first ] != labels[ second ]
+        first = first[ different ]
+        second = second[ different ]
+    return labels
+
+
+def weld_vertices( vertices, tolerance ):
+    """Finds the vertices that are within a tolerance of each other.
+
+    @param vertices: the vertex positions with the shape (N,3).
+    @param tolerance: the maximum distance between merged vertices.
+    If 0, only identical vertices are merged.
+    @return: a tuple of the index each vertex is merged into and
+    the number of vertices that were merged.
+    """
+    vertices = numpy.asarray( vertices, dtype = 'float' )
+    size = len( vertices )
+    if size == 0:
+        return numpy.empty( 0, dtype = 'int' ), 0
+
+    if tolerance <= 0.0:
+        # merge identical vertices
+        unique, first, inverse = numpy.unique(
+            vertices,
+            axis = 0,
+            return_index = True,
+            return_inverse = True
+            )
+        mapping = first[ inverse ]
+        return mapping, int( numpy.count_nonzero( mapping != numpy.arange( size ) ) )
+
+    cells = numpy.floor( vertices / tolerance ).astype( 'int64' )
+    cells -= cells.min( axis = 0 ) - 1
+    scale = _cell_scale( cells )
+    keys = numpy.dot( cells, scale )
+    del cells
+
+    order = numpy.argsort( keys )
+    keys = keys[ order ]
+    vertices = vertices[ order ]
+
+    # the range of the sorted vertices in each occupied cell
+    boundaries = numpy.flatnonzero( keys[ 1: ] != keys[ :-1 ] ) + 1
+    cell_starts = numpy.concatenate( ([ 0 ], boundaries) )
+    cell_ends = numpy.concatenate( (boundaries, [ size ]) )
+    unique_keys = keys[ cell_starts ]
+
+    firsts = []
+    seconds = []
+    for offset in _offsets:
+        # packed keys of the sorted vertices' neighbours are also
+        # sorted, which makes the binary searches much faster
+        delta = numpy.dot( offset, scale )
+        for start in range( 0, size, batch_size ):
+            positions = numpy.arange( start, min( start + batch_size, size ) )
+            neighbours = keys[ start : start + batch_size ] + delta
+            found = numpy.searchsorted( unique_keys, neighbours )
+            found = numpy.minimum( found, len( unique_keys ) - 1 )
+            occupied = unique_keys[ found ] == neighbours
+            positions = positions[ occupied ]
+            found = found[ occupied ]
+
+            second, owners = _ranges( cell_starts[ found ], cell_ends[ found ] )
+            first = positions[ owners ]
+
+            if not offset.any():
+                # pairs within a cell are found from both sides
+                keep = first < second
+                first = first[ keep ]
+                second = second[ keep ]
+
+            distances = vertices[ first ] - vertices[ second ]
+            close = numpy.einsum( 'ij,ij->i', distances, distances ) <= tolerance * tolerance
+            firsts.append( order[ first[ close ] ] )
+            seconds.append( order[ second[ close ] ] )
+
+    mapping = _components( size, numpy.concatenate( firsts ), numpy.concatenate( seconds ) )
+    return mapping, int( numpy.count_nonzero( mapping != numpy.arange( size ) ) )
+
+
+def weld_mesh( mesh, tolerance, meshes = None ):
+    """Welds the vertices of an OBJ mesh's polygons.
+
+    Only vertices used by the sub-meshes are welded. The vertex
+    indices of their points, lines and faces are updated to the
+    merged vertices. The vertex array is not changed.
+
+    @param mesh: an OBJ_Mesh.
+    @param tolerance: the maximum distance between merged vertices.
+    @param meshes: the sub-meshes to weld, or None for all sub-meshes.
+    @return: the number of vertices that were merged.
+    """
+    if meshes is None:
+        meshes = mesh.meshes
+
+    polygons = [
+        submesh[ key ]
+        for submesh in meshes
+        for key in [ 'points', 'lines', 'faces' ]
+        if len( submesh[ key ] )
+        ]
+    if not polygons:
+        return 0
+
+    used = numpy.unique( numpy.concatenate( [ values.corners[ :, 0 ] for values in polygons ] ) )
+    used = used[ used >= 0 ]
+
+    used_mapping, merged = weld_vertices( mesh.vertices[ used ], tolerance )
+    if merged == 0:
+        return 0
+
+    mapping = numpy.arange( mesh.num_vertices )
+    mapping[ used ] = used[ used_mapping ]
+    for values in polygons:
+        values.remap( 0, mapping )
+    return merged
+
+
+def weld_merging_groups( mesh ):
+    """Welds the sub-meshes of each merging group set by 'mg'
+    statements.
+
+    @return: the number of vertices that were merged.
+    """
+    merged = 0
+    for group, tolerance in sorted( mesh.merging_groups.items() ):
+        meshes = [ submesh for submesh in mesh.meshes if submesh[ 'merge_group' ] == group ]
+        merged += weld_mesh( mesh, tolerance, meshes )
+    return merged
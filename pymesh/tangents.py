@@ -0,0 +1,202 @@
+"""Generates tangents for normal mapping.
+
+Tangents are calculated in the same way as MikkTSpace.
+Each triangle's texture space tangent and bitangent are projected
+onto the plane of each corner's normal, normalised and weighted by
+the corner's angle. The weighted values are summed into the
+corner's vertex with numpy.bincount.
+
+The final tangent is orthogonalised against the vertex normal.
+The fourth component is the bitangent sign, the bitangent is
+calculated in a shader as cross( normal, tangent.xyz ) * tangent.w.
+
+Tangents are only shared by corners that share a vertex.
+Vertices on a UV seam have a different texture coordinate on each
+side of the seam, so they must be split before tangents are
+calculated. index_buffer and md2_tangents already do this.
+
+Positions and normals may have leading dimensions, such as the
+frames of an animation, which are all processed at once.
+
+For example:
+
+    buffer = index_buffer( obj.model )
+    tangents = obj_tangents( buffer )
+
+    md2 = MD2()
+    md2.load( 'sydney.md2' )
+    md2_buffer = md2_tangents( md2 )
+"""
+
+from collections import namedtuple
+
+import numpy
+
+
+md2_layout = namedtuple(
+    'MD2_Tangents',
+    [
+        'vertex_indices',
+        'tc_indices',
+        'indices',
+        'tangents'
+        ]
+    )
+"""
+vertex_indices  The MD2 vertex of each render vertex.
+tc_indices      The MD2 texture coordinate of each render vertex.
+indices         Triangle indices of the render vertices.
+tangents        The tangents of each frame with the shape (frames, vertices, 4).
+"""
+
+
+def _normalise( vectors ):
+    lengths = numpy.sqrt( (vectors * vectors).sum( axis = -1 ) )
+    lengths[ lengths == 0.0 ] = 1.0
+    return vectors / lengths[ ..., numpy.newaxis ]
+
+
+def _project( vectors, normals ):
+    """Removes the component of each vector along its normal.
+    """
+    dots = (vectors * normals).sum( axis = -1 )
+    return vectors - normals * dots[ ..., numpy.newaxis ]
+
+
+def _sum_rows( values, indices, size ):
+    """Sums the rows of values with the shape (..., C, D) into
+    'size' rows per leading index.
+    """
+    leading = values.shape[ :-2 ]
+    batches = int( numpy.prod( leading ) )
+    keys = (numpy.arange( batches )[ :, numpy.newaxis ] * size + indices).ravel()
+    values = values.reshape( batches * len( indices ), -1 )
+
+    result = numpy.empty( (batches * size, values.shape[ 1 ]), dtype = 'float' )
+    for column in range( values.shape[ 1 ] ):
+        result[ :, column ] = numpy.bincount( keys, weights = values[ :, column ], minlength = batches * size )
+    return result.reshape( leading + (size, values.shape[ 1 ]) )
+
+
+def vertex_tangents( positions, normals, texture_coords, indices ):
+    """Calculates the tangent of each vertex of a triangle mesh.
+
+    @param positions: the vertex positions with the shape (..., V, 3).
+    @param normals: the vertex normals with the shape (..., V, 3).
+    @param texture_coords: the vertex texture coordinates with the
+    shape (V, 2) or (..., V, 2).
+    @param indices: triangle vertex indices, 3 per triangle.
+    @return: the tangents with the shape (..., V, 4). The fourth
+    component is the bitangent sign, 1.0 or -1.0.
+    """
+    positions = numpy.asarray( positions, dtype = 'float' )
+    normals = _normalise( numpy.asarray( normals, dtype = 'float' ) )
+    texture_coords = numpy.asarray( texture_coords, dtype = 'float' )
+    indices = numpy.asarray( indices, dtype = 'int64' ).ravel()
+    if len( indices ) % 3:
+        raise ValueError( 'Indices must be a multiple of 3' )
+
+    size = positions.shape[ -2 ]
+    leading = positions.shape[ :-2 ]
+    corner_shape = leading + (len( indices ) // 3, 3)
+
+    # the values of each triangle corner with the shape (..., T, 3, D)
+    corner_positions = positions[ ..., indices, : ].reshape( corner_shape + (3,) )
+    corner_normals = normals[ ..., indices, : ].reshape( corner_shape + (3,) )
+    corner_coords = texture_coords[ ..., indices, : ].reshape( texture_coords.shape[ :-2 ] + corner_shape[ -2: ] + (2,) )
+
+    # the texture space directions of each triangle
+    edges = corner_positions[ ..., 1:, : ] - corner_positions[ ..., :1, : ]
+    deltas = corner_coords[ ..., 1:, : ] - corner_coords[ ..., :1, : ]
+    du1, dv1, du2, dv2 = [
+        deltas[ ..., row, column, numpy.newaxis, numpy.newaxis ]
+        for row, column in [ (0, 0), (0, 1), (1, 0), (1, 1) ]
+        ]
+    tangents = dv2 * edges[ ..., :1, : ] - dv1 * edges[ ..., 1:, : ]
+    bitangents = du1 * edges[ ..., 1:, : ] - du2 * edges[ ..., :1, : ]
+
+    # flip both directions when the texture space is mirrored
+    signs = numpy.where( du1 * dv2 - du2 * dv1 < 0.0, -1.0, 1.0 )
+    tangents = tangents * signs
+    bitangents = bitangents * signs
+
+    # project onto each corner's normal plane
+    tangents = _normalise( _project( tangents, corner_normals ) )
+    bitangents = _normalise( _project( bitangents, corner_normals ) )
+
+    # weight by the angle of each corner
+    to_next = numpy.roll( corner_positions, -1, axis = -2 ) - corner_positions
+    to_previous = numpy.roll( corner_positions, 1, axis = -2 ) - corner_positions
+    cosines = (_normalise( to_next ) * _normalise( to_previous )).sum( axis = -1 )
+    angles = numpy.arccos( numpy.clip( cosines, -1.0, 1.0 ) )[ ..., numpy.newaxis ]
+
+    weighted = numpy.concatenate( (tangents * angles, bitangents * angles), axis = -1 )
+    weighted = weighted.reshape( leading + (len( indices ), 6) )
+    sums = _sum_rows( weighted, indices, size )
+
+    # orthogonalise against the vertex normal
+    tangent = _normalise( _project( sums[ ..., :3 ], normals ) )
+    result = numpy.empty( leading + (size, 4), dtype = 'float' )
+    result[ ..., :3 ] = tangent
+    handedness = (numpy.cross( normals, tangent ) * sums[ ..., 3: ]).sum( axis = -1 )
+    result[ ..., 3 ] = numpy.where( handedness < 0.0, -1.0, 1.0 )
+    return result
+
+
+def obj_tangents( buffer ):
+    """Calculates the tangents of an OBJ index buffer.
+
+    The buffer must have texture coordinates and normals.
+
+    @param buffer: an index buffer created by pymesh.obj.index_buffer.
+    @return: the tangent of each buffer vertex with the shape (V,4).
+    """
+    columns = dict( (name, (offset, size)) for name, offset, size in buffer.format )
+    for name in [ 'position', 'texture_coord', 'normal' ]:
+        if name not in columns:
+            raise ValueError( 'Index buffer has no %s data' % name )
+
+    def column( name, size = None ):
+        offset, count = columns[ name ]
+        return buffer.vertices[ :, offset : offset + (size or count) ]
+
+    return vertex_tangents(
+        column( 'position' ),
+        column( 'normal' ),
+        column( 'texture_coord', 2 ),
+        buffer.indices
+        )
+
+
+def md2_tangents( md2, frames = None ):
+    """Calculates the tangents of a loaded MD2 model.
+
+    MD2 triangles index vertices and texture coordinates separately.
+    Each unique (vertex, texture coordinate) pair becomes a render
+    vertex, which splits vertices along UV seams.
+    The tangents of every frame are calculated at once.
+
+    @param md2: a loaded MD2 object.
+    @param frames: the indices of the frames to use, or None for
+    all frames.
+    @return: an md2_layout named tuple.
+    """
+    if frames is None:
+        frames = range( len( md2.frames ) )
+
+    vertex_indices = md2.triangles.vertex_indices.astype( 'int64' )
+    tc_indices = md2.triangles.tc_indices.astype( 'int64' )
+    keys = vertex_indices * len( md2.tcs ) + tc_indices
+    keys, first, inverse = numpy.unique( keys, return_index = True, return_inverse = True )
+    vertex_indices = vertex_indices[ first ]
+    tc_indices = tc_indices[ first ]
+
+    positions = numpy.array( [ md2.frames[ frame ].vertices for frame in frames ] )
+    normals = numpy.array( [ md2.frames[ frame ].normals for frame in frames ] )
+    tangents = vertex_tangents(
+        positions[ :, vertex_indices ],
+        normals[ :, vertex_indices ],
+        md2.tcs[ tc_indices ],
+        inverse
+        )
+    return md2_layout( vertex_indices, tc_indices, inverse, tangents )
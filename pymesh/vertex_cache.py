@@ -0,0 +1,310 @@
+"""Optimises triangle index buffers for the post-transform vertex cache.
+
+Exporters emit triangles in an arbitrary order, which causes the
+GPU to transform the same vertex many times. Triangles are reordered
+with Tipsify (Sander, Nehab and Barczak, 2007), which fans around
+vertices that are likely to still be in the cache. The vertices are
+then renumbered in the order they are first used, so vertex fetches
+read memory sequentially.
+
+Tipsify and the FIFO cache simulation are inherently sequential and
+loop over python lists. Everything else is done with numpy.
+
+The average cache miss ratio (ACMR) is the number of transformed
+vertices per triangle, which is 0.5 at best for large regular meshes
+and 3.0 at worst.
+The average transform to vertex ratio (ATVR) is the number of
+transformed vertices per unique vertex, which is 1.0 at best.
+
+For example:
+
+    buffer, report = optimise_obj_buffer( index_buffer( obj.model ) )
+    print 'ACMR %.3f -> %.3f' % (report.acmr_before, report.acmr_after)
+
+    report = optimise_md2( md2 )
+    report = optimise_md5_submesh( md5.mesh.meshes[ 0 ] )
+"""
+
+from collections import namedtuple
+
+import numpy
+
+
+# the number of vertices in the simulated FIFO cache
+cache_size = 16
+
+
+report_layout = namedtuple(
+    'VertexCache_Report',
+    [
+        'acmr_before',
+        'acmr_after',
+        'atvr_before',
+        'atvr_after'
+        ]
+    )
+
+
+def cache_misses( indices, size = cache_size ):
+    """Counts the vertices transformed when rendering triangles
+    with a FIFO vertex cache.
+
+    @param indices: triangle vertex indices, 3 per triangle.
+    @param size: the number of vertices in the cache.
+    @return: the number of cache misses.
+    """
+    indices = numpy.asarray( indices ).ravel()
+    if len( indices ) == 0:
+        return 0
+
+    # the miss count when each vertex was added to the cache
+    added = [ -size - 1 ] * (int( indices.max() ) + 1)
+    misses = 0
+    for index in indices.tolist():
+        if added[ index ] < misses - size:
+            added[ index ] = misses
+            misses += 1
+    return misses
+
+
+def acmr( indices, size = cache_size ):
+    """Returns the average cache miss ratio of a triangle list.
+    """
+    triangles = len( numpy.asarray( indices ).ravel() ) // 3
+    if triangles == 0:
+        return 0.0
+    return cache_misses( indices, size ) / float( triangles )
+
+
+def atvr( indices, size = cache_size ):
+    """Returns the average transform to vertex ratio of a triangle list.
+    """
+    vertices = len( numpy.unique( indices ) )
+    if vertices == 0:
+        return 0.0
+    return cache_misses( indices, size ) / float( vertices )
+
+
+def tipsify( indices, size = cache_size ):
+    """Reorders triangles to improve vertex cache hits.
+
+    @param indices: triangle vertex indices, 3 per triangle.
+    @param size: the number of vertices in the cache.
+    @return: the order of the triangles.
+    """
+    indices = numpy.asarray( indices ).ravel()
+    num_triangles = len( indices ) // 3
+    if num_triangles == 0:
+        return numpy.empty( 0, dtype = 'int64' )
+
+    # compact the vertices so the arrays only cover used vertices
+    inverse = numpy.unique( indices, return_inverse = True )[ 1 ]
+    num_vertices = int( inverse.max() ) + 1
+
+    # the triangles that use each vertex
+    corners = numpy.argsort( inverse, kind = 'mergesort' )
+    starts = numpy.zeros( num_vertices + 1, dtype = 'int64' )
+    starts[ 1: ] = numpy.cumsum( numpy.bincount( inverse, minlength = num_vertices ) )
+    adjacency = (corners // 3).tolist()
+    starts = starts.tolist()
+
+    triangles = inverse.reshape( -1, 3 ).tolist()
+    live = numpy.bincount( inverse, minlength = num_vertices ).tolist()
+    cache_time = [ 0 ] * num_vertices
+    emitted = [ False ] * num_triangles
+    dead_end = []
+    output = []
+
+    timestamp = size + 1
+    cursor = 0
+    fanning = -1
+    while True:
+        if fanning < 0:
+            # skip dead ends, then fall back to the next live vertex
+            while dead_end:
+                vertex = dead_end.pop()
+                if live[ vertex ] > 0:
+                    fanning = vertex
+                    break
+            while fanning < 0 and cursor < num_vertices:
+                if live[ cursor ] > 0:
+                    fanning = cursor
+                cursor += 1
+            if fanning < 0:
+                break
+
+        # emit the remaining triangles around the fanning vertex
+        candidates = []
+        for triangle in adjacency[ starts[ fanning ] : starts[ fanning + 1 ] ]:
+            if emitted[ triangle ]:
+                continue
+            emitted[ triangle ] = True
+            output.append( triangle )
+            for vertex in triangles[ triangle ]:
+                dead_end.append( vertex )
+                candidates.append( vertex )
+                live[ vertex ] -= 1
+                if timestamp - cache_time[ vertex ] > size:
+                    cache_time[ vertex ] = timestamp
+                    timestamp += 1
+
+        # fan around the candidate that will still be in the cache
+        # after its remaining triangles are emitted
+        fanning = -1
+        best = -1
+        for vertex in candidates:
+            if live[ vertex ] > 0:
+                priority = 0
+                if timestamp - cache_time[ vertex ] + 2 * live[ vertex ] <= size:
+                    priority = timestamp - cache_time[ vertex ]
+                if priority > best:
+                    best = priority
+                    fanning = vertex
+
+    return numpy.array( output, dtype = 'int64' )
+
+
+def reorder_vertices( indices, num_vertices = None ):
+    """Renumbers vertices in the order they are first used.
+
+    @param indices: triangle vertex indices.
+    @param num_vertices: the number of vertices, unused vertices
+    are placed at the end. Defaults to the highest index plus one.
+    @return: a tuple of the new indices and the original index of
+    each new vertex. Vertex data is reordered with data[ order ].
+    """
+    indices = numpy.asarray( indices )
+    flat = indices.ravel()
+    if num_vertices is None:
+        num_vertices = int( flat.max() ) + 1 if len( flat ) else 0
+
+    unique, first = numpy.unique( flat, return_index = True )
+    used = numpy.zeros( num_vertices, dtype = 'bool' )
+    used[ unique ] = True
+    order = numpy.concatenate( (unique[ numpy.argsort( first ) ], numpy.flatnonzero( ~used )) )
+
+    remap = numpy.empty( num_vertices, dtype = 'int64' )
+    remap[ order ] = numpy.arange( num_vertices )
+    return remap[ indices ].astype( indices.dtype ), order
+
+
+def triangle_order( indices, ranges = None, size = cache_size ):
+    """Returns the Tipsify order of the triangles of each range.
+
+    Ranges that are already better ordered than Tipsify's result,
+    which is common for meshes from cache aware exporters, keep
+    their original order.
+
+    @param indices: triangle vertex indices, 3 per triangle.
+    @param ranges: the (start, count) of each draw call's indices.
+    None for a single range.
+    @return: the order of the triangles.
+    """
+    indices = numpy.asarray( indices ).ravel()
+    if ranges is None:
+        ranges = [ (0, len( indices )) ]
+
+    triangles = indices.reshape( -1, 3 )
+    orders = [ numpy.empty( 0, dtype = 'int64' ) ]
+    for start, count in ranges:
+        original = numpy.arange( start // 3, (start + count) // 3 )
+        order = tipsify( indices[ start : start + count ], size ) + start // 3
+        if cache_misses( triangles[ order ], size ) > cache_misses( triangles[ original ], size ):
+            order = original
+        orders.append( order )
+    return numpy.concatenate( orders )
+
+
+def _report( before, after, size ):
+    return report_layout(
+        acmr( before, size ),
+        acmr( after, size ),
+        atvr( before, size ),
+        atvr( after, size )
+        )
+
+
+def optimise_indices( indices, num_vertices = None, ranges = None, size = cache_size ):
+    """Reorders triangles for the vertex cache and renumbers the
+    vertices in first use order.
+
+    @param indices: triangle vertex indices, 3 per triangle.
+    @param num_vertices: the number of vertices.
+    @param ranges: the (start, count) of each draw call's indices.
+    Triangles are only reordered within a range.
+    None for a single range.
+    @param size: the number of vertices in the cache.
+    @return: a tuple of the new indices, the original index of each
+    new vertex and a report_layout.
+    """
+    indices = numpy.asarray( indices )
+    flat = indices.ravel()
+    order = triangle_order( flat, ranges, size )
+    optimised, vertex_order = reorder_vertices( flat.reshape( -1, 3 )[ order ].ravel(), num_vertices )
+
+    report = _report( flat, optimised, size )
+    return optimised.reshape( indices.shape ), vertex_order, report
+
+
+def optimise_obj_buffer( buffer, size = cache_size ):
+    """Optimises an OBJ index buffer.
+
+    Triangles stay within their sub-mesh's range.
+
+    @param buffer: an index buffer created by pymesh.obj.index_buffer.
+    @return: a tuple of the new index buffer and a report_layout.
+    """
+    indices, order, report = optimise_indices(
+        buffer.indices,
+        len( buffer.vertices ),
+        buffer.ranges.tolist(),
+        size
+        )
+    return buffer._replace( vertices = buffer.vertices[ order ], indices = indices ), report
+
+
+def optimise_md2( md2, size = cache_size ):
+    """Optimises the triangles and vertices of a loaded MD2 in place.
+
+    The vertices and normals of every frame are reordered.
+    Texture coordinates are indexed separately and are not reordered.
+
+    @param md2: a loaded MD2 object.
+    @return: a report_layout.
+    """
+    vertex_indices = md2.triangles.vertex_indices
+    tc_indices = md2.triangles.tc_indices
+
+    # the texture coordinates follow their triangles
+    triangles = triangle_order( vertex_indices, size = size )
+    indices, order = reorder_vertices(
+        vertex_indices.reshape( -1, 3 )[ triangles ].ravel(),
+        md2.header.num_vertices
+        )
+    report = _report( vertex_indices, indices, size )
+
+    md2.triangles = md2.triangles._replace(
+        vertex_indices = indices,
+        tc_indices = tc_indices.reshape( -1, 3 )[ triangles ].ravel()
+        )
+    md2.frames = [
+        frame._replace( vertices = frame.vertices[ order ], normals = frame.normals[ order ] )
+        for frame in md2.frames
+        ]
+    return report
+
+
+def optimise_md5_submesh( submesh, size = cache_size ):
+    """Optimises the triangles and vertices of an MD5_SubMesh in place.
+
+    @param submesh: an MD5_SubMesh.
+    @return: a report_layout.
+    """
+    tris, order, report = optimise_indices( submesh.tris, submesh.num_verts, size = size )
+    submesh.tris = tris
+
+    submesh._vertices = submesh._vertices[ order ]
+    submesh.tcs = submesh._vertices[ 'tcs' ]
+    submesh.start_weights = submesh._vertices[ 'start_weight' ]
+    submesh.weight_counts = submesh._vertices[ 'weight_count' ]
+    return report
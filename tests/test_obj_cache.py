@@ -0,0 +1,82 @@
+import os
+import shutil
+import stat
+import struct
+import tempfile
+import unittest
+
+import numpy
+
+from pymesh.obj import OBJ
+from pymesh.obj.cache import cache_filename, _prefix
+
+
+class TestCache( unittest.TestCase ):
+
+    def setUp( self ):
+        self.path = tempfile.mkdtemp()
+        self.filename = os.path.join( self.path, 'quads.obj' )
+
+        lines = []
+        for index in range( 200 ):
+            lines.append( 'v %d.0 0.5 %d.25' % (index, index % 7) )
+            lines.append( 'vt %d.5 0.25' % (index % 3) )
+        for index in range( 1, 198, 2 ):
+            lines.append( 'f %d/%d %d/%d %d/%d %d/%d' % ((index, index, index + 1, index + 1, index + 2, index + 2, index + 3, index + 3)) )
+        with open( self.filename, 'wb' ) as f:
+            f.write( '\n'.join( lines ) + '\n' )
+
+    def tearDown( self ):
+        shutil.rmtree( self.path )
+
+    def _assert_loaded( self, obj ):
+        expected = OBJ()
+        expected.load( self.filename )
+        self.assertTrue( numpy.array_equal( obj.model.vertices, expected.model.vertices ) )
+        self.assertTrue( numpy.array_equal( obj.model.texture_coords, expected.model.texture_coords ) )
+        self.assertEqual(
+            obj.model.meshes[ 0 ][ 'faces' ].corners.tolist(),
+            expected.model.meshes[ 0 ][ 'faces' ].corners.tolist()
+            )
+
+    def test_missing_directory( self ):
+        directory = os.path.join( self.path, 'missing', 'cache' )
+        obj = OBJ()
+        obj.load( self.filename, cache = directory )
+        self._assert_loaded( obj )
+        self.assertTrue( os.path.exists( cache_filename( self.filename, directory ) ) )
+
+    def test_unwritable_directory( self ):
+        # a file where the cache directory should be
+        directory = os.path.join( self.path, 'file' )
+        open( directory, 'wb' ).close()
+
+        obj = OBJ()
+        obj.load( self.filename, cache = directory )
+        self._assert_loaded( obj )
+
+    def test_file_mode( self ):
+        umask = os.umask( 0o022 )
+        try:
+            OBJ().load( self.filename, cache = True )
+        finally:
+            os.umask( umask )
+        mode = stat.S_IMODE( os.stat( cache_filename( self.filename ) ).st_mode )
+        self.assertEqual( mode, 0o644 )
+
+    def test_truncated_arrays( self ):
+        OBJ().load( self.filename, cache = True )
+        output = cache_filename( self.filename )
+        with open( output, 'rb' ) as f:
+            data = f.read()
+        header_size = _prefix.unpack( data[ :_prefix.size ] )[ 2 ]
+        with open( output, 'wb' ) as f:
+            f.write( data[ :_prefix.size + header_size + 200 ] )
+
+        obj = OBJ()
+        obj.load( self.filename, cache = True )
+        self._assert_loaded( obj )
+
+
+if __name__ == '__main__':
+    unittest.main()
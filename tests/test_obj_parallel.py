@@ -0,0 +1,57 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from pymesh.obj import OBJ
+from pymesh.obj.mesh import OBJ_Mesh
+from pymesh.obj.parallel import load_parallel
+from pymesh.obj.reader import split_ranges
+
+
+def _submeshes( mesh ):
+    return [
+        [ submesh[ key ] for key in OBJ_Mesh.state_keys ] + [ submesh[ 'faces' ].corners.tolist() ]
+        for submesh in mesh.meshes
+        ]
+
+
+class TestParallel( unittest.TestCase ):
+
+    workers = 3
+
+    def setUp( self ):
+        self.path = tempfile.mkdtemp()
+        self.filename = os.path.join( self.path, 'ranges.obj' )
+
+        # most lines are 's' statements, so ranges begin with them
+        lines = []
+        for index in range( 400 ):
+            lines.extend( 's %d' % (index % 5 + 1) for repeat in range( 20 ) )
+            lines.append( 'g grp%d' % (index % 5) )
+            if index % 3 == 0:
+                lines.append( 'usemtl material%d' % (index % 4) )
+            for corner in range( 3 ):
+                lines.append( 'v %d.0 %d.5 %d.25' % (index, corner, index % 7) )
+            lines.append( 'f -3 -2 -1' )
+        with open( self.filename, 'wb' ) as f:
+            f.write( '\n'.join( lines ) + '\n' )
+
+    def tearDown( self ):
+        shutil.rmtree( self.path )
+
+    def test_range_begins_with_s( self ):
+        with open( self.filename, 'rb' ) as f:
+            data = f.read()
+        starts = [ start for start, end in split_ranges( data, self.workers * 4 ) ]
+        self.assertTrue( any( data.startswith( 's ', start ) for start in starts[ 1: ] ) )
+
+        for ignore_smoothing_groups in [ True, False ]:
+            obj = OBJ()
+            obj.load( self.filename, ignore_smoothing_groups )
+            parallel = load_parallel( self.filename, self.workers, ignore_smoothing_groups )
+            self.assertEqual( _submeshes( parallel ), _submeshes( obj.model ) )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from pymesh.obj import OBJ
+
+
+class TestPreallocated( unittest.TestCase ):
+
+    def setUp( self ):
+        self.path = tempfile.mkdtemp()
+        self.filename = os.path.join( self.path, 'texture_coords.obj' )
+
+    def tearDown( self ):
+        shutil.rmtree( self.path )
+
+    def _load( self, lines ):
+        with open( self.filename, 'wb' ) as f:
+            f.write( '\n'.join( lines ) + '\n' )
+
+        results = []
+        for preallocate in [ False, True ]:
+            obj = OBJ()
+            obj.load( self.filename, preallocate = preallocate )
+            results.append( obj.model.texture_coords )
+        return results
+
+    def test_unused_w( self ):
+        sequential, preallocated = self._load( [ 'vt 0.5 0.5 0', 'vt 0.25 0.75 0.0', 'vt 1 1' ] )
+        self.assertEqual( sequential.shape, (3, 2) )
+        self.assertEqual( preallocated.shape, sequential.shape )
+        self.assertTrue( numpy.array_equal( preallocated, sequential ) )
+
+    def test_used_w( self ):
+        sequential, preallocated = self._load( [ 'vt 0.5 0.5', 'vt 0.25 0.75 0.5' ] )
+        self.assertEqual( sequential.shape, (2, 3) )
+        self.assertEqual( preallocated.shape, sequential.shape )
+        self.assertTrue( numpy.array_equal( preallocated, sequential ) )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from pymesh.obj import OBJ, lod_chain
+
+
+class TestSimplify( unittest.TestCase ):
+
+    def setUp( self ):
+        self.path = tempfile.mkdtemp()
+        self.filename = os.path.join( self.path, 'tetrahedron.obj' )
+
+        lines = [
+            'v 0.0 0.0 0.0',
+            'v 1.0 0.0 0.0',
+            'v 0.0 1.0 0.0',
+            'v 0.0 0.0 1.0',
+            'usemtl a',
+            'f 1 3 2',
+            'usemtl b',
+            'f 1 2 4',
+            'usemtl c',
+            'f 2 3 4',
+            'usemtl d',
+            'f 3 1 4',
+            ]
+        with open( self.filename, 'wb' ) as f:
+            f.write( '\n'.join( lines ) + '\n' )
+
+    def tearDown( self ):
+        shutil.rmtree( self.path )
+
+    def test_reports( self ):
+        obj = OBJ()
+        obj.load( self.filename )
+
+        # every vertex is on three sub-meshes, so none can collapse
+        levels, reports = lod_chain( obj.model, [ 2, 1 ], return_reports = True )
+        self.assertEqual( len( levels ), 2 )
+        self.assertEqual( [ report.triangles for report in reports ], [ 4, 4 ] )
+        self.assertEqual( [ report.error for report in reports ], [ 0.0, 0.0 ] )
+        for level, report in zip( levels, reports ):
+            self.assertEqual( sum( len( submesh[ 'faces' ].counts ) for submesh in level.meshes ), report.triangles )
+
+
+if __name__ == '__main__':
+    unittest.main()